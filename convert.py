@@ -5,25 +5,58 @@
 # Usage:
 # python3 convert.py
 #   This begins or continues the conversion process for the only *.v file in the current directory.
+# python3 convert.py --auto [--model MODEL] [--max-attempts N] [--candidates N]
+#   As above, but without user interaction. Each refactoring step is accepted automatically once FEV passes and the LLM
+#   reports that the step is complete. Exits with status 2 if a step cannot be completed automatically. With --candidates,
+#   each attempt speculatively requests multiple LLM candidates concurrently (see the "S" command).
+# python3 convert.py --batch MANIFEST [-j JOBS] [--model MODEL] [--max-attempts N] [--candidates N] [--fev-portfolio] [--predict] [--edits] [--no-stream] [--no-trace]
+#   Run --auto conversions in parallel for each module directory listed (one per line) in MANIFEST. Output for each is
+#   logged to <dir>/auto.log and results are recorded in MANIFEST.status.json. Rerunning resumes unfinished modules.
+#   The options following --candidates are passed on to each --auto worker.
+# python3 convert.py --trace-summary [DIR ...]
+#   Summarize the time spent in each phase (span) of the flow, from the trace.json files under the given directories (default
+#   ".", which may be a batch of module directories).
+# Options:
+#   --fev-portfolio: For --auto/--batch, run FEV using a portfolio of engines and solvers concurrently (as the "P" command),
+#                    taking the first conclusive result. Per-engine timing is recorded in history/fev_engines.json.
+#   --predict: Pass the current Verilog as a predicted output of LLM requests (for models that support it), so unchanged
+#              code is returned faster. Accepted/rejected prediction tokens are recorded in status.json ("tokens").
+#   --edits: Have the LLM respond with a compact list of anchored edits to the Verilog, rather than the full updated Verilog
+#            (for models using the "o" API), reducing output tokens. Edits that do not apply cleanly reject the response.
+#   --no-stream: Wait for complete LLM responses. By default, responses are streamed, displayed as they arrive, and
+#                aborted early if they are malformed.
+#   --no-trace: Do not record span traces (history/#/mod_#/trace.json).
 
 # This script works with these files:
 #  - <module_name>_orig.v: The trusted Verilog module to convert. This is the original file for the current conversion step.
 #  - <module_name>.v: The current WIP refactored/modified Verilog module, against which FEV will be run.
 #  - prompt_id.txt: A file containing, e.g. {"id": 5, "desc": "Update clocks"}, the ID and desc field of the current prompt.
 #                  (Formerly, this was just an ID number.) (Note, the actual prompt may have been modified manually.)
-#  - messages.<api>.json: The messages to be sent to the LLM API (as in the ChatGPT API).
+#  - messages.<api>.json: The messages to be sent to the LLM API (as in the ChatGPT API). These hold only the static parts
+#                         of the request (system message, background, and prompt); "needs" fields, the plan, and the Verilog
+#                         are appended when the request is made, so requests share a cacheable prefix.
 #  - current/feved.v: A link to the most-recent successfully FEVed Verilog file.
 #  - current/chkpt.v: A link to the last checkpointed Verilog file.
-# Additionally, these files may be created and captured in the process:
-#  - tmp/fev.sby & tmp/fev.eqy: The FEV script for this conversion job.
-#  - tmp/m5/*: Temporary files used for M5 preprocessing of a prompt.
-#  - tmp/pre_llm.v: The Verilog file sent to the LLM API.
-#  - tmp/llm_resp.v: The Verilog response field from the LLM (if any).
-#  - tmp/diff.v: The diff of pre_llm.v and llm_resp.v (if response contained Verilog field).
-#  - tmp/diff_mod.v: A modification of diff.v to ignore "..." diffs (if response contained Verilog field).
-#  - tmp/llm_upd.v: The updated Verilog file after applying diff_mod.v (if response contained Verilog field).
-#  - tmp/llm.v: The updated (or not) Verilog (llm_upd.v or pre_llm.v).
+# Additionally, these files may be created and captured in the process. Each job (an FEV run, LLM response merge, M5
+# rendering, etc.) works in its own scratch workspace, tmp/<kind>.<unique>/ (see ScratchDir), so jobs can run concurrently.
+# The most recent workspace of each kind is kept, linked as tmp/<kind>:
+#  - tmp/fev/: The FEV script (fev.eqy), logs, output (fev/), and counterexample (tmp/fev.vcd) of the last FEV run.
+#  - tmp/fev/portfolio/<engine>/: The script, log ("log"), and output of each engine of a portfolio FEV run.
+#  - tmp/sim/: The simulation miter, testbench, and logs of the last pre-FEV checks.
+#  - tmp/m5.<what>.<api>/: Files used for M5 preprocessing of a prompt or system message.
+#  - tmp/llm/pre_llm.v: The Verilog file sent to the LLM API.
+#  - tmp/llm/llm.v: The updated (or not) Verilog (the LLM's Verilog response with "..." lines expanded, or pre_llm.v).
+#  - tmp/llm_stream/llm_stream.v: The "verilog" field of the LLM response, written as the response is streamed.
 #  - llm_response.txt: The LLM response file.
+#  - tmp/spec/<n>/: Candidate <n> of a speculative LLM run ("S" command), with its FEV run and log.
+#  - history/fev_engines.json: Per-engine timing of portfolio FEV runs for this module.
+#
+# Some results are cached in ~/.cache/conversion-to-TLV (or $CONVERT_CACHE_DIR), shared by all conversion directories:
+#  - models/: Lists of the models available from the API, refreshed daily.
+#  - m5/: M5 renderings of system messages and prompts, keyed on the text and the M5 variables it references.
+#  - llm/: LLM responses, keyed on a hash of the model, API format, JSON schema, messages, and Verilog.
+#  - fev/: FEV verdicts and logs, keyed on hashes of the original and modified Verilog (ignoring comments and whitespace),
+#          the module name, the FEV script, and the engine.
 #
 # A history of all refactoring steps is stored in history/#, where "#" is the "refactoring step", starting with history/1.
 # This directory is initialized when the step is begun, and fully populated when the refactoring change is accepted.
@@ -42,6 +75,8 @@
 #   - history/#/mod_#/<module_name>.v: The modified Verilog file.
 #   - history/#/mod_#/messages.<api>.json: The messages sent to the LLM API (for LLM modifications only).
 #   - history/#/mod_#/status.json: Metadata about the modification, as below, written after testing.
+#   - history/#/mod_#/trace.json: Timing of the phases (M5, LLM API calls, merges, checkpointing, FEV, etc.) leading up to
+#                                 (and testing) the modification, in Chrome trace-event format (see Tracer).
 #
 # history/#/mod_0 are checkpoints of the initial code for each refactoring step. Thus, history/1/mod_0/<module_name>.v is the initial
 # code for the entire conversion.
@@ -49,15 +84,30 @@
 # history/#/mod_# can also be a symlink to a prior history/#/mod_#, recording a code reversion. A reversion will not reference
 # another reversion.
 #
+# Files in history/#/mod_#/ are read-only hard links into a content-addressed store, history/objects/, so identical files
+# are stored once (see ObjectStore). They must not be modified in place.
+#
+# history/index.jsonl is an append-only journal indexing the status, parent, reversion target, and content hash of every modification
+# (see HistoryIndex). It is rebuilt from the history/ tree if missing or inconsistent, so it can be deleted at any time.
+#
 # The status.json file reflects the status of the modification, including the following (and others that are sticky):
 #   {
 #     "by": "human"|"llm",
 #     "api": ... if "by" is "llm",
 #     "compile": "passed"|"failed" (or non-existent if not compiled),
+#     "sim": "passed"|"failed"|"skipped" Result of random co-simulation against the most recently FEVed code before FEV (or non-existent if not run),
+#            "skipped" if the design could not be simulated meaningfully (e.g. its clock could not be identified),
 #     "fev": "passed"|"failed" (or non-existent if not run),
 #     "incomplete": true|false A sticky field (held for each checkpoint of the refactoring step) assigned or updated by each LLM run,
 #                              indicating whether the LLM response was incomplete.
 #     "accepted": true|non-existent Exists as true for the final modification of a refactoring step that was accepted.
+#     "tokens": {"in": #, "out": #, "cached": #} Prompt, completion, and (provider) cached prompt tokens of the API call for an LLM modification (if not cached),
+#               and, with --predict, "prediction": {"accepted": #, "rejected": #} predicted tokens. "continuations": # is the number of
+#               requests made to continue a response truncated by the completion token limit (if any). For a chunked request, these
+#               are totals over the chunks' API calls, whose number is given by "requests": #.
+#     "llm_cache_keys": [...] The llm_cache keys of the request(s) for an LLM modification, whose cached responses are removed if it fails FEV.
+#     "fev_depth": # (opt) A sticky override of the FEV depth (cycles, including reset) derived from the design's structure.
+#     "fev_reset_cycles": # (opt) A sticky override of the number of cycles of reset for FEV.
 #   }
 #
 # With each rejected refactoring step, a new candidate is captured under a new candidate number under the next history number directory.
@@ -96,7 +146,6 @@
 
 import os
 import subprocess
-from openai import OpenAI
 import sys
 import termios
 import tty
@@ -108,7 +157,23 @@ import json
 import re
 import shutil
 import stat
+import tempfile
 import copy
+import hashlib
+import argparse
+import collections
+import concurrent.futures
+import asyncio
+import random
+import difflib
+import threading
+import pickle
+import types
+import time
+import fcntl
+import contextlib
+import functools
+import resource
 
 # Confirm that we're using Python 3.7 or later (as we rely on dictionaries to be ordered).
 if sys.version_info < (3, 7):
@@ -145,6 +210,813 @@ class FileLocked:
         os.chmod(self.filepath, self.original_permissions)
 
 
+# An isolated scratch workspace for one job (an FEV run, response merge, M5 rendering, etc.), so jobs, even for the same
+# module, can run concurrently. Each workspace is a fresh directory, <parent>/<kind>.<unique>. When closed, the workspace
+# is published as <parent>/<kind> (a symlink) for inspection, replacing (and deleting) the previously-published workspace
+# of that kind, or, if not keep, it is deleted. A workspace whose job failed (with an exception from the "with" block, or
+# as marked by fail()) is published regardless, so the failure can be investigated.
+# Usage:
+#   with ScratchDir("fev") as scratch:
+#     scratch.render("fev.eqy", template, {"<MODULE_NAME>": module_name})
+#     subprocess.run(cmd, cwd=scratch.dir)
+class ScratchDir:
+  lock = threading.Lock()   # For publishing.
+
+  def __init__(self, kind, parent="tmp", keep=True):
+    self.kind = kind
+    self.parent = parent
+    self.keep = keep
+    os.makedirs(parent, exist_ok=True)
+    self.dir = tempfile.mkdtemp(prefix=kind + ".", dir=parent)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      self.fail()
+    self.close()
+
+  # Mark the job as failed, so the workspace is kept (published) when closed.
+  def fail(self):
+    self.keep = True
+
+  # Return the path of the given file in the workspace.
+  def path(self, file_name):
+    return self.dir + "/" + file_name
+
+  # Write the given text to the given file in the workspace, applying the given {placeholder: value} substitutions.
+  # Return the path of the file.
+  def render(self, file_name, text, substitutions={}):
+    for placeholder, value in substitutions.items():
+      text = text.replace(placeholder, value)
+    with open(self.path(file_name), "w") as file:
+      file.write(text)
+    return self.path(file_name)
+
+  def close(self):
+    if self.dir is None:
+      return
+    if not self.keep:
+      shutil.rmtree(self.dir, ignore_errors=True)
+    else:
+      link = self.parent + "/" + self.kind
+      with ScratchDir.lock:
+        prev = None
+        if os.path.islink(link):
+          prev = self.parent + "/" + os.readlink(link)
+        elif os.path.isdir(link):
+          # (From a version without workspaces.)
+          shutil.rmtree(link, ignore_errors=True)
+        # Replace the link atomically.
+        tmp_link = self.dir + ".link"
+        os.symlink(os.path.basename(self.dir), tmp_link)
+        os.replace(tmp_link, link)
+        if prev is not None and os.path.basename(prev) != os.path.basename(self.dir):
+          shutil.rmtree(prev, ignore_errors=True)
+    self.dir = None
+
+
+# Lightweight span tracing of the phases of the flow (M5, LLM calls, merges, checkpoints, FEV, etc.), to find where time is
+# spent. Each span records wall time, the CPU time of its thread, and the CPU time of subprocesses that completed during
+# the span (which, for concurrent spans, may include those of other spans). A span within an asyncio task records only
+# wall time (and "async": true), as its thread's CPU time would exclude time awaited and include other tasks. If the peak
+# memory of completed subprocesses rose during the span, the new peak is recorded as "peak_child_rss_kb". (This is the
+# largest resident set size of any subprocess completed so far in the session, not memory used by the span itself.)
+# Spans nest by time within a thread (or asyncio task). Completed spans are written, in Chrome trace-event format (viewable in chrome://tracing or
+# https://ui.perfetto.dev), to history/#/mod_#/trace.json for the current modification as its status is written (see
+# writeStatus(..)), so spans leading up to a checkpoint are recorded with it. "python3 convert.py --trace-summary [DIR ...]"
+# aggregates the traces under the given directories.
+# Usage:
+#   with tracer.span("fev", engine="eqy"):
+#     ...
+#   tracer.flush(mod_path())
+class Tracer:
+  file_name = "trace.json"
+
+  def __init__(self):
+    self.enabled = True
+    self.events = []   # Completed events not yet written.
+    self.lock = threading.Lock()
+    self.tids = {}     # Small trace IDs for threads/tasks.
+
+  # Return the running asyncio task, or None.
+  @staticmethod
+  def current_task():
+    try:
+      return asyncio.current_task()
+    except RuntimeError:
+      return None   # (No running event loop.)
+
+  # A small ID for the current thread, or asyncio task.
+  def tid(self):
+    task = Tracer.current_task()
+    key = threading.get_ident() if task is None else id(task)
+    with self.lock:
+      return self.tids.setdefault(key, len(self.tids) + 1)
+
+  @contextlib.contextmanager
+  def span(self, name, **args):
+    if not self.enabled:
+      yield
+      return
+    tid = self.tid()
+    in_task = Tracer.current_task() is not None
+    ts = time.time()
+    start = time.perf_counter()
+    cpu = time.thread_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+      yield
+    finally:
+      children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+      if in_task:
+        args["async"] = True
+      else:
+        args["cpu_ms"] = round((time.thread_time() - cpu) * 1000, 3)
+      child_cpu = (children_end.ru_utime + children_end.ru_stime) - (children.ru_utime + children.ru_stime)
+      if child_cpu > 0:
+        args["child_cpu_ms"] = round(child_cpu * 1000, 3)
+      if children_end.ru_maxrss > children.ru_maxrss:
+        args["peak_child_rss_kb"] = children_end.ru_maxrss
+      event = {"name": name, "cat": name.split(".")[0], "ph": "X", "ts": int(ts * 1000000),
+               "dur": int((time.perf_counter() - start) * 1000000), "pid": os.getpid(), "tid": tid, "args": args}
+      with self.lock:
+        self.events.append(event)
+
+  # Append completed events to <dir>/trace.json.
+  def flush(self, dir):
+    with self.lock:
+      events = self.events
+      self.events = []
+    if not events or not os.path.isdir(dir):
+      with self.lock:
+        self.events = events + self.events
+      return
+    trace = Tracer.read(dir + "/" + Tracer.file_name)
+    trace["traceEvents"] += events
+    tmp_file_name = dir + "/." + Tracer.file_name + "." + str(os.getpid())
+    with open(tmp_file_name, "w") as file:
+      json.dump(trace, file)
+    os.replace(tmp_file_name, dir + "/" + Tracer.file_name)
+
+  # Read a trace file (or return an empty trace).
+  @staticmethod
+  def read(file_name):
+    try:
+      with open(file_name) as file:
+        return json.load(file)
+    except (OSError, ValueError):
+      return {"traceEvents": [], "displayTimeUnit": "ms"}
+
+  # Print, for each span name, the count and total/mean/max wall time, total CPU time (of the thread, for spans not in an
+  # asyncio task, and of subprocesses), and the highest peak subprocess memory of the spans in the trace files under the
+  # given directories, sorted by total wall time.
+  @staticmethod
+  def summarize(dirs):
+    totals = {}
+    num_files = 0
+    for dir in dirs:
+      for root, subdirs, files in os.walk(dir):
+        subdirs[:] = [subdir for subdir in subdirs if subdir not in ("objects", "tmp")]
+        if Tracer.file_name not in files:
+          continue
+        num_files += 1
+        for event in Tracer.read(root + "/" + Tracer.file_name)["traceEvents"]:
+          if event.get("ph") != "X":
+            continue
+          total = totals.setdefault(event["name"], {"count": 0, "wall": 0, "max": 0, "cpu": 0, "child_cpu": 0, "peak_rss": 0})
+          total["count"] += 1
+          total["wall"] += event["dur"] / 1000
+          total["max"] = max(total["max"], event["dur"] / 1000)
+          total["cpu"] += event["args"].get("cpu_ms", 0)
+          total["child_cpu"] += event["args"].get("child_cpu_ms", 0)
+          total["peak_rss"] = max(total["peak_rss"], event["args"].get("peak_child_rss_kb", 0))
+    print("Spans from " + str(num_files) + " trace file(s) (times in ms, memory in KB):")
+    print("%-28s %8s %12s %10s %10s %12s %12s %16s" % ("span", "count", "total", "mean", "max", "cpu", "child cpu", "peak child rss"))
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]["wall"]):
+      print("%-28s %8d %12.1f %10.1f %10.1f %12.1f %12.1f %16s" % (name, total["count"], total["wall"], total["wall"] / total["count"], total["max"], total["cpu"], total["child_cpu"], total["peak_rss"] or "-"))
+
+# A decorator tracing each call of the decorated function (or coroutine function) as a span of the given name (see Tracer).
+def traced(name):
+  def decorator(fn):
+    if asyncio.iscoroutinefunction(fn):
+      @functools.wraps(fn)
+      async def async_wrapper(*args, **kwargs):
+        with tracer.span(name):
+          return await fn(*args, **kwargs)
+      return async_wrapper
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      with tracer.span(name):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+
+# A persistent, content-addressed cache on disk, shared across conversion directories (under cache_dir).
+# Each entry is a JSON file, <cache_dir>/<name>/<key[:2]>/<key>.json, holding a JSON-serializable value.
+# Entries older than max_age seconds are discarded, and the least-recently-used entries are evicted when the
+# cache exceeds max_bytes. Hit/miss statistics are accumulated in <cache_dir>/<name>/stats.json.
+# Usage:
+#   key = DiskCache.key({"model": model, ...})
+#   value = cache.get(key)   # None on a miss
+#   cache.put(key, value)
+class DiskCache:
+  def __init__(self, name, max_bytes, max_age):
+    self.name = name
+    self.dir = cache_dir + "/" + name
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self.puts = 0   # Puts since the last eviction check.
+
+  # Return the key for the given JSON-serializable object, which should capture everything the cached value depends on.
+  @staticmethod
+  def key(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+  def entry_path(self, key):
+    return self.dir + "/" + key[:2] + "/" + key + ".json"
+
+  # Return the cached value for the given key, or None if there is no (fresh) entry.
+  def get(self, key):
+    path = self.entry_path(key)
+    value = None
+    try:
+      if time.time() - os.path.getmtime(path) > self.max_age:
+        os.remove(path)
+      else:
+        with open(path) as file:
+          value = json.load(file)["value"]
+        # Touch the entry to reflect its use for LRU eviction.
+        os.utime(path)
+    except (OSError, ValueError, KeyError):
+      value = None
+    self.record_stat("hits" if value is not None else "misses")
+    return value
+
+  # Cache the given value under the given key.
+  def put(self, key, value):
+    path = self.entry_path(key)
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      # Write atomically, so concurrent readers (e.g. other conversion jobs) never see a partial entry.
+      tmp_path = path + "." + str(os.getpid()) + ".tmp"
+      with open(tmp_path, "w") as file:
+        json.dump({"created": time.time(), "value": value}, file)
+      os.replace(tmp_path, path)
+    except OSError as e:
+      print("Warning: Failed to write " + self.name + " cache entry due to: " + str(e))
+      return
+    # Check for eviction periodically, rather than on every put.
+    self.puts += 1
+    if self.puts >= 20:
+      self.evict()
+
+  # Remove the entry for the given key (if any), e.g. for a response that was rejected.
+  def delete(self, key):
+    try:
+      os.remove(self.entry_path(key))
+    except OSError:
+      pass
+
+  # Remove expired entries, then least-recently-used entries until the cache fits within max_bytes.
+  def evict(self):
+    self.puts = 0
+    entries = []   # [(mtime, size, path), ...]
+    now = time.time()
+    for root, dirs, files in os.walk(self.dir):
+      for file in files:
+        if not file.endswith(".json") or file == "stats.json":
+          continue
+        path = os.path.join(root, file)
+        try:
+          st = os.stat(path)
+          if now - st.st_mtime > self.max_age:
+            os.remove(path)
+          else:
+            entries.append((st.st_mtime, st.st_size, path))
+        except OSError:
+          pass
+    total = sum(entry[1] for entry in entries)
+    entries.sort()
+    for mtime, size, path in entries:
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      total -= size
+
+  # Increment the given statistic ("hits" or "misses") in stats.json (with locking, as the cache is shared).
+  def record_stat(self, stat_name):
+    try:
+      os.makedirs(self.dir, exist_ok=True)
+      with open(self.dir + "/stats.json", "a+") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        file.seek(0)
+        contents = file.read()
+        stats = json.loads(contents) if contents else {}
+        stats[stat_name] = stats.get(stat_name, 0) + 1
+        file.seek(0)
+        file.truncate()
+        json.dump(stats, file)
+    except (OSError, ValueError):
+      pass
+
+  # Return the accumulated statistics as {"hits": #, "misses": #}.
+  def stats(self):
+    try:
+      with open(self.dir + "/stats.json") as file:
+        return json.load(file)
+    except (OSError, ValueError):
+      return {}
+
+
+
+# A long-lived Yosys process for FEV, driven through the Yosys command shell over a pipe. This performs the same proof as
+# fev.tcl, but avoids starting Yosys for every proof and keeps the elaborated original ("gold") design stashed (as "orig"),
+# re-reading it only when the original code changes. So, successive proofs against the same original only elaborate the
+# modified ("gate") design.
+# Proofs are serialized (with a lock) as there is a single Yosys process. If the process dies, it is restarted for the
+# next proof.
+class YosysFEVServer:
+  sentinel = "@@YOSYS_FEV_SERVER_DONE@@"
+
+  def __init__(self):
+    self.proc = None
+    self.gold_key = None   # Identifies the stashed gold design.
+    self.lock = threading.Lock()
+
+  def start(self):
+    self.proc = subprocess.Popen(["yosys", "-Q"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+    self.gold_key = None
+
+  def stop(self):
+    if self.proc is not None and self.proc.poll() is None:
+      try:
+        self.proc.stdin.write("exit\n")
+        self.proc.stdin.flush()
+        self.proc.wait(timeout=5)
+      except (OSError, subprocess.TimeoutExpired):
+        self.proc.kill()
+    self.proc = None
+
+  # Run the given Yosys commands, returning [ok, output], where ok is False if a command failed (or Yosys died).
+  def run(self, commands):
+    if self.proc is None or self.proc.poll() is not None:
+      self.start()
+    try:
+      for command in commands + ["log " + self.sentinel]:
+        self.proc.stdin.write(command + "\n")
+      self.proc.stdin.flush()
+    except OSError:
+      self.proc = None
+      return [False, "Error: Yosys FEV server died."]
+    output = []
+    while True:
+      line = self.proc.stdout.readline()
+      if line == "":
+        # Yosys exited (e.g. due to a fatal error).
+        self.proc = None
+        return [False, "".join(output)]
+      if line.rstrip().endswith(self.sentinel) and "Running command" not in line:
+        break
+      output.append(line)
+    output = "".join(output)
+    return [re.search(r"^ERROR:", output, re.MULTILINE) is None, output]
+
+  # Prove equivalence of the modified file vs. the original file for the given top-level module, as in fev.tcl.
+  # vcd_file: The file in which to dump a counterexample.
+  # depth: (opt) The FEV depth (see fev_depth(..)), proven by iterative deepening (see fev_depth_schedule(..)).
+  # Return [passed, log].
+  @traced("fev.yosys.prove")
+  def prove(self, top, orig_file_name, modified_file_name, vcd_file, depth=None):
+    with self.lock:
+      ok, log = self.load(top, orig_file_name, modified_file_name)
+      if not ok:
+        return [False, log]
+
+      # Prove equivalence, with early exit on a counterexample.
+      ok, output = self.run([
+        "design -reset",
+        "design -copy-from orig -as orig " + top,
+        "design -copy-from modified -as modified " + top,
+        "miter -equiv -make_assert -flatten orig modified miter"
+      ])
+      log += output
+      passed = ok
+      for step_depth in fev_depth_schedule(depth or fev_default_depth):
+        if not passed:
+          break
+        ok, output = self.run([yosys_sat_command(os.path.abspath(vcd_file), step_depth)])
+        log += output
+        passed = ok and re.search(r"SAT proof finished - no model found: SUCCESS!", output) is not None
+      return [passed, log]
+
+  # Return the flattened Yosys JSON netlist (parsed) of the given file for the given top-level module, or None if it
+  # cannot be elaborated. (The stashed designs are unaffected.)
+  def netlist(self, top, file_name):
+    json_file = os.path.abspath(file_name) + ".netlist.json"
+    with self.lock:
+      ok, output = self.run([
+        "design -reset",
+        "read_verilog -sv " + os.path.abspath(file_name),
+        "hierarchy -top " + top,
+        "proc",
+        "flatten",
+        "opt_clean",
+        "write_json " + json_file
+      ])
+    if not ok:
+      return None
+    try:
+      with open(json_file) as file:
+        return json.load(file)
+    except (OSError, ValueError):
+      return None
+    finally:
+      if os.path.exists(json_file):
+        os.remove(json_file)
+
+  # Elaborate the original design (unless it is already stashed) and the modified design, stashing them as "orig" and
+  # "modified". (The caller must hold the lock.)
+  # Return [ok, log].
+  def load(self, top, orig_file_name, modified_file_name):
+    log = ""
+    # (Re)load the gold design if needed.
+    with open(orig_file_name, "rb") as file:
+      gold_key = [top, hashlib.sha256(file.read()).hexdigest()]
+    if gold_key != self.gold_key or self.proc is None or self.proc.poll() is not None:
+      ok, output = self.run([
+        "design -reset",
+        "read_verilog -sv " + os.path.abspath(orig_file_name),
+        "hierarchy -top " + top,
+        "proc",
+        "clean",
+        "design -stash orig"
+      ])
+      log += output
+      if not ok:
+        self.gold_key = None
+        return [False, log]
+      self.gold_key = gold_key
+    else:
+      log += "(Reusing the elaborated original design.)\n"
+
+    # Elaborate the modified design.
+    ok, output = self.run([
+      "design -reset",
+      "read_verilog -sv " + os.path.abspath(modified_file_name),
+      "hierarchy -top " + top,
+      "proc",
+      "clean",
+      "design -stash modified"
+    ])
+    return [ok, log + output]
+
+  # Check that the modified design elaborates, and write a miter of the two designs as Verilog to the given file, for
+  # simulation (see precheck_fev(..)). As for FEV, flip-flops are zero-initialized. The miter, "miter", has inputs
+  # "in_<input>" and an output, "trigger", that is 1 when outputs differ (and the original's outputs are not X).
+  # Return [compiled, log], where compiled is None if the original design failed to elaborate.
+  def write_sim_miter(self, top, orig_file_name, modified_file_name, miter_file):
+    with self.lock:
+      ok, log = self.load(top, orig_file_name, modified_file_name)
+      if not ok:
+        return [None if self.gold_key is None else False, log]
+      ok, output = self.run([
+        "design -reset",
+        "design -copy-from orig -as orig " + top,
+        "design -copy-from modified -as modified " + top,
+        "miter -equiv -flatten -ignore_gold_x orig modified miter",
+        "select miter",
+        "setundef -zero -init",
+        "write_verilog -selected -noattr " + os.path.abspath(miter_file),
+        "select -clear"
+      ])
+      return [True, log + output]
+
+  # Incremental FEV. As prove(..), but equivalence is proven separately for the logic cone of each output (the output's
+  # transitive fan-in, through flip-flops), and only for cones that changed. A cone whose (normalized) netlist is identical
+  # in the two designs needs no proof, and the verdict for a pair of differing cone netlists is cached in fev_cache, so
+  # proof time tracks the size of the edit rather than the size of the module. (Equivalence of every output cone is
+  # equivalence of the module, since each output's assertion in the miter depends only on its cone.)
+  # Falls back to prove(..) if the outputs of the designs differ or cannot be addressed individually.
+  # Return [passed, log].
+  @traced("fev.yosys.cones")
+  def prove_cones(self, top, orig_file_name, modified_file_name, vcd_file, depth=None):
+    with self.lock:
+      ok, log = self.load(top, orig_file_name, modified_file_name)
+      if not ok:
+        return [False, log]
+      copy_cmds = ["design -reset", "design -copy-from orig -as orig " + top, "design -copy-from modified -as modified " + top]
+      ok, output = self.run(copy_cmds + ["select -list orig/o:*", "select -list modified/o:*"])
+      outputs = {"orig": [], "modified": []}
+      for match in re.finditer(r"^(orig|modified)/(\S+)$", output, re.MULTILINE):
+        outputs[match.group(1)].append(match.group(2))
+    if not ok or sorted(outputs["orig"]) != sorted(outputs["modified"]) or \
+       not all(re.match(r"^[A-Za-z_][\w$]*$", output) for output in outputs["orig"]):
+      print("Output ports cannot be compared individually. Proving equivalence of the whole module.")
+      passed, output = self.prove(top, orig_file_name, modified_file_name, vcd_file, depth)
+      return [passed, log + output]
+
+    with self.lock:
+      cone_dir = os.path.dirname(os.path.abspath(vcd_file))
+      sat_cmd = yosys_sat_command(os.path.abspath(vcd_file), depth)
+      summary = []
+      for output in sorted(outputs["orig"]):
+        # Reduce each design to the cone of this output.
+        cmds = copy_cmds[:]
+        for design in ["orig", "modified"]:
+          cmds.append("delete -port " + design + "/o:* " + design + "/w:" + output + " %d")
+        cmds.append("opt_clean -purge")
+        for design in ["orig", "modified"]:
+          cmds += ["select " + design, "write_rtlil -selected " + cone_dir + "/cone." + design + ".il"]
+        cmds.append("select -clear")
+        ok, output_log = self.run(cmds)
+        log += output_log
+        if not ok:
+          return [False, log]
+        cones = {}
+        for design in ["orig", "modified"]:
+          with open(cone_dir + "/cone." + design + ".il") as file:
+            cones[design] = normalize_rtlil(file.read())
+        if cones["orig"] == cones["modified"]:
+          summary.append("  " + output + ": unchanged")
+          continue
+        cache_key = DiskCache.key({
+          "orig": hashlib.sha256(cones["orig"].encode()).hexdigest(),
+          "modified": hashlib.sha256(cones["modified"].encode()).hexdigest(),
+          "sat": yosys_sat_command("<VCD>", depth),
+          "engine": "yosys-cone"
+        })
+        if fev_cache.get(cache_key) is not None:
+          summary.append("  " + output + ": proven previously")
+          continue
+        ok, output_log = self.run(["miter -equiv -make_assert -flatten orig modified miter", sat_cmd])
+        log += output_log
+        if not ok or re.search(r"SAT proof finished - no model found: SUCCESS!", output_log) is None:
+          summary.append("  " + output + ": FAILED")
+          print("Output cone proofs:\n" + "\n".join(summary))
+          return [False, log + "Output cone proofs:\n" + "\n".join(summary) + "\n"]
+        fev_cache.put(cache_key, {"passed": True})
+        summary.append("  " + output + ": proven")
+      print("Output cone proofs:\n" + "\n".join(summary))
+      return [True, log + "Output cone proofs:\n" + "\n".join(summary) + "\n"]
+
+
+
+# An index of the modification history (history/#/mod_#), so history lookups need not scan and parse history/#/mod_#/status.json
+# files. The index is an append-only journal, history/index.jsonl, of JSON records, each applying to modification "mod" of
+# refactoring step "step":
+#   {"step": #, "mod": #, "parent": #|null, "hash": "<sha256 of Verilog>"}: A new modification, where "parent" is the modification it was made from.
+#   {"step": #, "mod": #, "target": #}: A reversion (symlink) to modification "target".
+#   {"step": #, "mod": #, "status": {...}}: New status.json contents of (non-reversion) modification "mod".
+#   {"step": #, "begin": true}: Refactoring step "step" was begun.
+#   {"step": #, "drop": true}: Refactoring step "step" was deleted.
+# The journal is replayed on first use. The history/ tree remains the authoritative, readable record; if the journal is missing,
+# damaged, or inconsistent with the tree (e.g. a history created without it), it is rebuilt from the tree.
+# Lookups of the most recent modification satisfying a lineage predicate (lineage_predicates) are memoized.
+class HistoryIndex:
+  # Predicates on status for last(..).
+  lineage_predicates = {
+    "feved": lambda status: status.get("fev") == "passed",
+    "modified": lambda status: status.get("modified", False)
+  }
+
+  def __init__(self, history_dir):
+    self.history_dir = history_dir
+    self.index_file = history_dir + "/index.jsonl"
+    self.steps = None   # {step: {mod: {"status": {...}, "parent": #, "hash": "..."} or {"target": #}}} (loaded on first use)
+    self.memo = {}      # {(step, kind): {mod: result of last(step, mod, kind)}}
+
+  def load(self):
+    if self.steps is not None:
+      return
+    self.steps = {}
+    try:
+      with open(self.index_file) as file:
+        for line in file:
+          self.apply(json.loads(line))
+      ok = self.consistent()
+    except FileNotFoundError:
+      ok = False
+    except (ValueError, KeyError, TypeError, AttributeError):
+      print("Warning: " + self.index_file + " is damaged. Rebuilding it.")
+      ok = False
+    if not ok:
+      self.rebuild()
+
+  # Check the index against the history tree. (Only the directory listings of the last refactoring step are checked.)
+  def consistent(self):
+    steps = [int(step) for step in os.listdir(self.history_dir) if step.isdigit()]
+    if set(steps) != set(self.steps):
+      return False
+    if len(steps) == 0:
+      return True
+    step = max(steps)
+    mods = set(int(mod[4:]) for mod in os.listdir(self.history_dir + "/" + str(step)) if mod.startswith("mod_"))
+    return mods == set(self.steps[step])
+
+  # Rebuild the index from the history tree.
+  def rebuild(self):
+    self.steps = {}
+    self.memo = {}
+    records = []
+    steps = sorted(int(step) for step in os.listdir(self.history_dir) if step.isdigit())
+    for step in steps:
+      step_dir = self.history_dir + "/" + str(step)
+      records.append({"step": step, "begin": True})
+      mods = sorted(int(mod[4:]) for mod in os.listdir(step_dir) if mod.startswith("mod_") and mod[4:].isdigit())
+      prev_mod = None
+      for mod in mods:
+        mod_dir = step_dir + "/mod_" + str(mod)
+        if os.path.islink(mod_dir):
+          prev_mod = int(os.readlink(mod_dir)[4:])
+          records.append({"step": step, "mod": mod, "target": prev_mod})
+          continue
+        try:
+          with open(mod_dir + "/status.json") as file:
+            status = json.load(file)
+        except (OSError, ValueError):
+          status = {}
+        content_hash = None
+        for verilog_file in os.listdir(mod_dir):
+          if is_verilog(verilog_file):
+            content_hash = file_sha256(mod_dir + "/" + verilog_file)
+        records.append({"step": step, "mod": mod, "parent": prev_mod, "hash": content_hash})
+        records.append({"step": step, "mod": mod, "status": status})
+        prev_mod = mod
+    for record in records:
+      self.apply(record)
+    # Write the index atomically.
+    tmp_file = self.index_file + ".tmp"
+    with open(tmp_file, "w") as file:
+      for record in records:
+        file.write(json.dumps(record) + "\n")
+    os.replace(tmp_file, self.index_file)
+
+  # Apply a record to the in-memory index.
+  def apply(self, record):
+    step = record["step"]
+    if record.get("begin") or record.get("drop"):
+      if record.get("begin"):
+        self.steps[step] = {}
+      else:
+        self.steps.pop(step, None)
+      self.invalidate(step, 0)
+      return
+    mod = record["mod"]
+    mods = self.steps.setdefault(step, {})
+    if "target" in record:
+      mods[mod] = {"target": record["target"]}
+    else:
+      entry = mods.setdefault(mod, {"status": {}})
+      for field in ["status", "parent", "hash"]:
+        if field in record:
+          entry[field] = record[field]
+    self.invalidate(step, mod)
+
+  # Forget memoized lookups that may depend on the given mod (those from this mod or later).
+  def invalidate(self, step, mod):
+    for (memo_step, kind), results in self.memo.items():
+      if memo_step == step:
+        for m in [m for m in results if m >= mod]:
+          del results[m]
+
+  # Apply a record and append it to the journal.
+  def append(self, record):
+    self.load()
+    self.apply(record)
+    with open(self.index_file, "a") as file:
+      file.write(json.dumps(record) + "\n")
+
+  def add_mod(self, step, mod, parent, content_hash):
+    self.append({"step": step, "mod": mod, "parent": parent, "hash": content_hash})
+
+  def add_reversion(self, step, mod, target):
+    self.append({"step": step, "mod": mod, "target": target})
+
+  def set_status(self, step, mod, status):
+    mod = self.actual(step, mod)
+    if self.steps.get(step, {}).get(mod, {}).get("status") != status:
+      self.append({"step": step, "mod": mod, "status": copy.deepcopy(status)})
+
+  def set_hash(self, step, mod, content_hash):
+    mod = self.actual(step, mod)
+    if self.steps.get(step, {}).get(mod, {}).get("hash") != content_hash:
+      self.append({"step": step, "mod": mod, "hash": content_hash})
+
+  def begin_step(self, step):
+    self.append({"step": step, "begin": True})
+
+  def drop_step(self, step):
+    self.append({"step": step, "drop": True})
+
+  # The maximum mod number of the given refactoring step (or -1 if none).
+  def max_mod(self, step):
+    self.load()
+    return max(self.steps.get(step, {}), default=-1)
+
+  # The given mod or, if it is a reversion, the mod it reverts to.
+  def actual(self, step, mod):
+    self.load()
+    return self.steps.get(step, {}).get(mod, {}).get("target", mod)
+
+  def is_reversion(self, step, mod):
+    self.load()
+    return "target" in self.steps.get(step, {}).get(mod, {})
+
+  # The (non-reversion) mod entry ({"status": ..., "parent": ..., "hash": ...}) of the given mod, following a reversion (or {}).
+  def entry(self, step, mod):
+    self.load()
+    return self.steps.get(step, {}).get(self.actual(step, mod), {})
+
+  # A copy of the status of the given mod.
+  def status(self, step, mod):
+    return copy.deepcopy(self.entry(step, mod).get("status", {}))
+
+  # Reversion mods to the given mod.
+  def reversions_to(self, step, mod):
+    self.load()
+    return sorted(m for m, entry in self.steps.get(step, {}).items() if entry.get("target") == mod)
+
+  # The most recent (actual) mod, tracing backward from the given mod, with status satisfying lineage_predicates[kind] (or None).
+  # (Equivalent to most_recent(lambda mn: predicate(readStatus(mn)), mod).)
+  def last(self, step, mod, kind):
+    self.load()
+    predicate = self.lineage_predicates[kind]
+    results = self.memo.setdefault((step, kind), {})
+    path = []
+    result = None
+    while mod >= 0:
+      if mod in results:
+        result = results[mod]
+        break
+      path.append(mod)
+      mod = self.actual(step, mod)
+      if predicate(self.entry(step, mod).get("status", {})):
+        result = mod
+        break
+      mod -= 1
+    for m in path:
+      results[m] = result
+    return result
+
+
+
+# A content-addressed store of files (like Git's objects), history/objects/<hash[:2]>/<hash>, so each distinct version of a
+# checkpointed file (Verilog, messages.<api>.json, llm_response.txt) is stored once, however many modifications it appears in.
+# Files in history/#/mod_#/ are hard links to read-only objects (or read-only copies if hard links are not supported), so
+# history/ remains readable as plain files. Since objects are shared, history files must never be modified in place (though
+# they may be replaced, as by "sed -i").
+class ObjectStore:
+  def __init__(self, objects_dir):
+    self.dir = objects_dir
+
+  def object_path(self, content_hash):
+    return self.dir + "/" + content_hash[:2] + "/" + content_hash
+
+  # Add the contents of the given file to the store (if not already present). Return its hash.
+  def put(self, file_name):
+    content_hash = file_sha256(file_name)
+    obj = self.object_path(content_hash)
+    if not os.path.exists(obj):
+      os.makedirs(os.path.dirname(obj), exist_ok=True)
+      tmp_file = obj + ".tmp" + str(os.getpid())
+      shutil.copyfile(file_name, tmp_file)
+      os.chmod(tmp_file, 0o444)
+      os.replace(tmp_file, obj)
+    return content_hash
+
+  # Add the given file to the store and place it (read-only) at dest, replacing dest if it exists. Return its hash.
+  def store(self, file_name, dest):
+    content_hash = self.put(file_name)
+    obj = self.object_path(content_hash)
+    tmp_file = dest + ".tmp" + str(os.getpid())
+    try:
+      os.link(obj, tmp_file)
+    except OSError:
+      shutil.copyfile(obj, tmp_file)
+      os.chmod(tmp_file, 0o444)
+    os.replace(tmp_file, dest)
+    return content_hash
+
+  # Delete objects that are no longer referenced from history/ (e.g. after a refactoring step is deleted). Objects are
+  # referenced by hard link, so unreferenced objects have a single link. (Where copies are used, every object appears
+  # unreferenced, but is also unneeded.)
+  def gc(self):
+    if not os.path.isdir(self.dir):
+      return
+    for subdir in os.listdir(self.dir):
+      for name in os.listdir(self.dir + "/" + subdir):
+        path = self.dir + "/" + subdir + "/" + name
+        if os.stat(path).st_nlink <= 1:
+          os.remove(path)
+
+
 
 # Abstract Base Class for LLM API.
 class LLM_API(ABC):
@@ -212,9 +1084,36 @@ class OpenAI_API(LLM_API):
   name = "OpenAI"
   model = "gpt-3.5-turbo"   # default model (can be overridden in run(..))
                             # Reasoning models: "o1-preview", "o1-mini"
+  last_cache_key = None     # The llm_cache key of the most recent run(..).
+  last_usage = None         # {"in": <prompt-tokens>, "out": <completion-tokens>, "cached": <cached-prompt-tokens>, ...} for the most recent run(..) (or None if not from the API).
+  min_completion_overhead = 1000   # Tokens beyond the Verilog that must be available for the response (see fit_context(..)).
+  completion_scale = 1.5    # Completion tokens to allow per token of request Verilog (see max_completion_tokens(..)).
+  min_completion_budget = 4000     # The minimum completion tokens to allow (if the model permits).
+  reasoning_completion_tokens = 16000   # Additional completion tokens to allow for models with the "reasoning" property.
+  max_continuations = 3     # Continuation requests to complete a response truncated by the completion token limit.
+  min_splice_overlap = 16   # Minimum characters of a continuation repeating its predecessor to be dropped (see splice(..)).
+  continuation_prompt = "Your response was cut off by the output token limit. Continue it from exactly where it stopped, without repeating any of it and without any other commentary."
+  background_re = re.compile(r"^## background\n\n.*?\n\n(?=## )", re.MULTILINE | re.DOTALL)
+  elided_turn = "(This earlier message has been omitted to fit the context window.)"
+  summarized_turn = "(This earlier message has been summarized to fit the context window.)\n\n"   # (Prefix of a summary.)
+  max_summary_tokens = 300  # The maximum size of the summary of an earlier turn (see summarize_turn(..)).
+  predict = False           # Use Predicted Outputs for models that support them (--predict).
 
   def __init__(self):
     super().__init__()
+    self.org_id = None
+    self.sync_client = None   # Created on first use (see connect()).
+    self.model_ids = None     # {<model-id>: True} for available models (see available_models()).
+    self.prediction_unsupported = set()   # Models that rejected a prediction (so predictions are no longer sent).
+    self.prompt_tokens_total = 0   # Prompt tokens of API calls this session.
+    self.cached_tokens_total = 0   # Of which, served from the provider's prompt cache.
+
+  # Obtain credentials and create the client. This is deferred until the LLM is first used, so sessions that do not use the
+  # LLM start quickly (without importing openai), need no API key, and make no network requests.
+  def connect(self):
+    if self.sync_client is not None:
+      return
+    from openai import OpenAI   # (Slow to import, so imported on first use.)
 
     # if OPENAI_API_KEY env var does not exist, get it from ~/.openai/key.txt or input prompt.
     if not os.getenv("OPENAI_API_KEY"):
@@ -234,16 +1133,36 @@ class OpenAI_API(LLM_API):
           self.org_id = file.read()
     
     # Init OpenAI.
-    self.client = OpenAI() if self.org_id is None else OpenAI(organization=self.org_id)
-    models = self.client.models
-    self.models = self.client.models.list()
-  
+    self.sync_client = OpenAI() if self.org_id is None else OpenAI(organization=self.org_id)
+
+  @property
+  def client(self):
+    self.connect()
+    return self.sync_client
+
+  # Return a dict whose keys are the IDs of the models available from the API (in the order listed by the API).
+  # The list is cached on disk (in models_cache) for models_list_ttl seconds.
+  # refresh: Fetch the list from the API, even if cached.
+  def available_models(self, refresh=False):
+    if self.model_ids is None or refresh:
+      self.connect()
+      # (The list of models depends on the account.)
+      cache_key = DiskCache.key({"org": self.org_id, "key": hashlib.sha256(os.environ["OPENAI_API_KEY"].encode()).hexdigest()})
+      cached = None if refresh else models_cache.get(cache_key)
+      if cached is not None and time.time() - cached["time"] <= models_list_ttl:
+        ids = cached["ids"]
+      else:
+        ids = [item.id for item in self.client.models.list().data if hasattr(item, 'id')]
+        models_cache.put(cache_key, {"time": time.time(), "ids": ids})
+      self.model_ids = dict.fromkeys(ids, True)
+    return self.model_ids
+
   def validateModel(self, model):
-    # Get the data for the model (or None if not found)
-    model_data = next((item for item in self.models.data if hasattr(item, 'id') and item.id == model), None)
-    if model_data is None:
-      print("Error: Model " + model + " not found.")
-      fail()
+    if model not in self.available_models():
+      # The cached list may be out of date.
+      if model not in self.available_models(refresh=True):
+        print("Error: Model " + model + " not found.")
+        fail()
 
   # Set up the initial messages object for the current refactoring step based on the given system message and message parameter.
   def initPrompt(self, api, system, message):   
@@ -257,22 +1176,57 @@ class OpenAI_API(LLM_API):
   def run(self, messages, verilog, model=None):
     if model == None:
       model = self.model
+    params, cache_key = self.prepare_request(messages, verilog, model)
+    if params is None:
+      return ""
+    response_str = self.cached_response(cache_key)
+    if response_str is None:
+      with tracer.span("llm.api", model=model):
+        responses = [self.client.chat.completions.create(**self.request_params(params))]
+      while True:
+        continuation_params = self.continuation_params(params, responses)
+        if continuation_params is None:
+          break
+        with tracer.span("llm.api", model=model, continuation=len(responses)):
+          responses.append(self.client.chat.completions.create(**continuation_params))
+      response_str = self.process_response(self.combine_responses(responses), model, cache_key)
+    return response_str
+
+  # Return the parameters to send for the given prepared parameters. ("max_completion_tokens" is not supported with
+  # predictions, but is retained in prepared parameters for rate budgeting and for a retry without the prediction.)
+  @staticmethod
+  def request_params(params):
+    if "prediction" not in params:
+      return params
+    return {key: value for key, value in params.items() if key != "max_completion_tokens"}
+
+  # Prepare a request for the API, adding the verilog to the last message.
+  # sample: (opt) An index distinguishing otherwise-identical requests for independent samples (which are cached separately).
+  # Return [params, cache_key], where params are the parameters for chat.completions.create(..) and cache_key is the
+  # llm_cache key for the request (also recorded as self.last_cache_key), or [None, None] if the request cannot fit
+  # within the model's context window.
+  @traced("llm.prepare")
+  def prepare_request(self, messages, verilog, model, sample=None):
     self.validateModel(model)
+    self.last_usage = None
     
     # Add verilog to the last message.
     get_message_bundler_for_model(model).add_verilog(messages, verilog)
     api_properties = apis[models[model]["api"]]
 
     # Call the API.
-    # TODO: Consider the new "prediction" parameter (https://platform.openai.com/docs/api-reference/chat/create#chat-create-prediction).
     print("\nCalling " + model + "...")
-    desired_max = 8000
-    max_completion_tokens = api_properties.get('max_output_tokens')
-    if (max_completion_tokens is not None) and max_completion_tokens > desired_max:
-      max_completion_tokens = desired_max
+    max_completion_tokens = self.max_completion_tokens(model, verilog)
+    # Fit the request within the context window.
+    fit = self.fit_context(messages, verilog, model, max_completion_tokens)
+    if fit is None:
+      self.last_cache_key = None
+      return [None, None]
+    input_tokens, max_completion_tokens = fit
+    print("Request: " + str(input_tokens) + " input tokens" + ("" if max_completion_tokens is None else ", up to " + str(max_completion_tokens) + " completion tokens") + ".")
     #-api_response = self.client.chat.completions.create(model=model, messages=messages, max_completion_tokens=4096)
     
-    my_json_schema = copy.deepcopy(json_schema)
+    my_json_schema = copy.deepcopy(edits_json_schema if api_properties.get("edits") else json_schema)
     # Add extra_fields to my_json_schema.
     if "must_produce" in prompts[prompt_id]:
       # Add extra_fields to the schema.
@@ -309,28 +1263,611 @@ class OpenAI_API(LLM_API):
         params["response_format"] = {
           "type": "json_object"
         }
-    api_response = self.client.chat.completions.create(**params)
+    # Most refactoring steps return Verilog that is largely unchanged, so, if enabled and supported, predict a response
+    # containing the current Verilog (https://platform.openai.com/docs/guides/predicted-outputs). Matching tokens are
+    # accepted without being generated. (The response itself is unaffected, so the cache key is too.) Edit-script responses
+    # do not repeat the Verilog, so there is nothing to predict.
+    if self.predict and model_property(model, "prediction") and model not in self.prediction_unsupported and not api_properties.get("edits"):
+      params["prediction"] = {
+        "type": "content",
+        "content": get_message_bundler_for_model(model).obj_to_response({"verilog": verilog})
+      }
+
+    key_obj = {
+      "model": model,
+      "format": api_properties["format"],
+      "schema": my_json_schema,
+      "messages": messages,
+      "verilog": verilog
+    }
+    if sample:
+      key_obj["sample"] = sample
+    self.last_cache_key = DiskCache.key(key_obj)
+    return [params, self.last_cache_key]
+
+  # The maximum number of completion tokens to request from the given model (or None for no limit).
+  # verilog: (opt) The request's Verilog, in which case the limit is sized for a response rewriting it, rather than being
+  #          the model's limit. (A response that is truncated nonetheless is continued; see continuation_params(..).)
+  def max_completion_tokens(self, model, verilog=None):
+    model_max = model_property(model, 'max_output_tokens')
+    if verilog is None:
+      return model_max
+    desired_max = max(self.min_completion_budget, int(count_tokens(verilog, model) * self.completion_scale) + self.min_completion_overhead)
+    if model_property(model, "reasoning"):
+      desired_max += self.reasoning_completion_tokens
+    return desired_max if model_max is None else min(desired_max, model_max)
+
+  # Return the parameters for a request continuing a response truncated by the completion token limit, or None if the
+  # response is not truncated or has been continued max_continuations times. Continuations are requested as plain text
+  # (structured output would force each part to be a complete response) and spliced together (see splice(..)).
+  # params: The parameters of the original request.
+  # responses: The API responses thus far (the original, then continuations).
+  def continuation_params(self, params, responses):
+    choice = responses[-1].choices[0]
+    if choice.finish_reason != "length" or getattr(choice.message, "refusal", None):
+      return None
+    model = params["model"]
+    if len(responses) > self.max_continuations:
+      print("Warning: The response from " + model + " is still truncated after " + str(self.max_continuations) + " continuations.")
+      return None
+    continuation_params = {key: value for key, value in params.items() if key not in ("prediction", "response_format")}
+    continuation_params["messages"] = params["messages"] + [
+      {"role": "assistant", "content": self.combine_responses(responses).choices[0].message.content},
+      {"role": "user", "content": self.continuation_prompt}
+    ]
+    # Allow up to the model's limit, within the context window.
+    max_completion_tokens = self.max_completion_tokens(model)
+    context_window = model_property(model, "context_window")
+    if context_window is not None:
+      room = context_window - count_message_tokens(continuation_params["messages"], model)
+      if room < self.min_completion_overhead:
+        print("Warning: The response from " + model + " was truncated, and there is no room in the context window to continue it.")
+        return None
+      max_completion_tokens = room if max_completion_tokens is None else min(max_completion_tokens, room)
+    continuation_params["max_completion_tokens"] = max_completion_tokens
+    print("Warning: The response from " + model + " was truncated. Requesting continuation " + str(len(responses)) + " of up to " + str(self.max_continuations) + ".")
+    return continuation_params
+
+  # Splice a continuation onto the text it continues, dropping any repetition of the end of the text.
+  @classmethod
+  def splice(cls, text, more):
+    for overlap in range(min(len(text), len(more)), cls.min_splice_overlap - 1, -1):
+      if text.endswith(more[:overlap]):
+        return text + more[overlap:]
+    return text + more
+
+  # Combine an API response and its continuations (see continuation_params(..)) into an object resembling a single API
+  # response, with spliced content, the final finish reason, and total usage.
+  def combine_responses(self, responses):
+    if len(responses) == 1:
+      return responses[0]
+    content = ""
+    for response in responses:
+      content = self.splice(content, response.choices[0].message.content or "")
+    usages = [response.usage for response in responses if response.usage is not None]
+    usage = None
+    if usages:
+      usage = types.SimpleNamespace(
+        prompt_tokens=sum(u.prompt_tokens for u in usages),
+        completion_tokens=sum(u.completion_tokens for u in usages),
+        total_tokens=sum(u.total_tokens for u in usages),
+        prompt_tokens_details=types.SimpleNamespace(cached_tokens=sum(getattr(getattr(u, "prompt_tokens_details", None), "cached_tokens", None) or 0 for u in usages)),
+        completion_tokens_details=getattr(usages[0], "completion_tokens_details", None)
+      )
+    message = types.SimpleNamespace(content=content, refusal=None)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message, finish_reason=responses[-1].choices[0].finish_reason)], usage=usage, continuations=len(responses) - 1)
+
+  # Return the total of the given usages (as recorded in last_usage) of several requests (e.g. for the chunks of a chunked
+  # request), or None if there are none.
+  @staticmethod
+  def total_usage(usages):
+    usages = [usage for usage in usages if usage is not None]
+    if not usages:
+      return None
+    total = {"in": 0, "out": 0, "cached": 0}
+    for usage in usages:
+      for field, value in usage.items():
+        if field == "prediction":
+          prediction = total.setdefault("prediction", {"accepted": 0, "rejected": 0})
+          for kind in prediction:
+            prediction[kind] += value.get(kind, 0)
+        else:
+          total[field] = total.get(field, 0) + value
+    total["requests"] = len(usages)
+    return total
+
+  # Return True if the given request is too large to be handled well in a single request: either it would not fit the
+  # context window, or a response rewriting all of the Verilog would exceed the maximum completion tokens.
+  def too_large(self, messages, verilog, model):
+    verilog_tokens = count_tokens(verilog, model)
+    max_completion_tokens = self.max_completion_tokens(model)
+    context_window = model_property(model, "context_window")
+    return (max_completion_tokens is not None and verilog_tokens + self.min_completion_overhead > max_completion_tokens) or \
+           (context_window is not None and count_message_tokens(messages, model) + 2 * verilog_tokens + self.min_completion_overhead > context_window)
+
+  # Fit the request (messages, to which verilog has been added) within the model's context window (if known), leaving room
+  # for a response at least as large as the Verilog. Strategies are applied in this order until the request fits:
+  #   - Drop the (optional) "background" field from the prompt.
+  #   - Summarize earlier turns of the conversation (between the system message and the last message), oldest first
+  #     (see summarize_turn(..)).
+  #   - Elide earlier turns, oldest first.
+  # (Verilog too large for the model is instead refactored in chunks. See too_large(..) and run_chunked(..).)
+  # messages are modified in place.
+  # Return [input_tokens, max_completion_tokens], where max_completion_tokens is reduced (or set) to fit the context window,
+  # or None if the request cannot fit.
+  def fit_context(self, messages, verilog, model, max_completion_tokens):
+    input_tokens = count_message_tokens(messages, model)
+    context_window = model_property(model, "context_window")
+    if context_window is None:
+      return [input_tokens, max_completion_tokens]
+    min_completion_tokens = count_tokens(verilog, model) + self.min_completion_overhead
+    if max_completion_tokens is not None:
+      min_completion_tokens = min(min_completion_tokens, max_completion_tokens)
+
+    # Drop background.
+    if input_tokens + min_completion_tokens > context_window:
+      for message in messages[1:]:
+        content = self.background_re.sub("", message["content"])
+        if content != message["content"]:
+          print("Warning: Dropping the \"background\" field of the prompt to fit " + model + "'s context window.")
+          message["content"] = content
+      input_tokens = count_message_tokens(messages, model)
+    # Summarize earlier turns.
+    for message in messages[1:-1]:
+      if input_tokens + min_completion_tokens <= context_window:
+        break
+      if message["content"] != self.elided_turn and not message["content"].startswith(self.summarized_turn):
+        summary = self.summarized_turn + self.summarize_turn(message["content"], model)
+        if count_tokens(summary, model) < count_tokens(message["content"], model):
+          print("Warning: Summarizing an earlier " + message["role"] + " message to fit " + model + "'s context window.")
+          message["content"] = summary
+          input_tokens = count_message_tokens(messages, model)
+    # Elide earlier turns.
+    for message in messages[1:-1]:
+      if input_tokens + min_completion_tokens <= context_window:
+        break
+      if message["content"] != self.elided_turn:
+        print("Warning: Eliding an earlier " + message["role"] + " message to fit " + model + "'s context window.")
+        message["content"] = self.elided_turn
+        input_tokens = count_message_tokens(messages, model)
+
+    if input_tokens + min_completion_tokens > context_window:
+      print("Error: The request (" + str(input_tokens) + " tokens, plus at least " + str(min_completion_tokens) + " for the response) does not fit " + model + "'s context window (" + str(context_window) + " tokens).")
+      return None
+    room = context_window - input_tokens
+    return [input_tokens, room if max_completion_tokens is None else min(max_completion_tokens, room)]
+
+  # Return an (extractive) summary of the given earlier turn of the conversation (see fit_context(..)). Its fields (in
+  # pseudo-Markdown or JSON) are kept, but code is omitted and each field is cut to its first paragraph, and the summary
+  # as a whole is cut to max_summary_tokens.
+  def summarize_turn(self, content, model):
+    try:
+      fields = json.loads(content)
+    except ValueError:
+      fields = None
+    if not isinstance(fields, dict):
+      parts = re.split(r"^## (\w+)\n\n", content, flags=re.MULTILINE)
+      fields = dict(zip(parts[1::2], parts[2::2]))
+      if parts[0].strip():
+        fields = dict({"message": parts[0]}, **fields)
+    lines = []
+    for field, value in fields.items():
+      if field == "verilog":
+        value = "(code omitted)"
+      value = re.sub(r"```.*?(```|\Z)", "(code omitted)", str(value), flags=re.DOTALL)
+      value = re.sub(r"^[ \t]*module\b.*?(^[ \t]*endmodule\b|\Z)", "(code omitted)", value, flags=re.MULTILINE | re.DOTALL)
+      lines.append(field + ": " + value.strip().split("\n\n")[0])
+    summary = "\n".join(lines)
+    tokens = count_tokens(summary, model)
+    if tokens > self.max_summary_tokens:
+      summary = summary[:len(summary) * self.max_summary_tokens // tokens].rstrip() + " ..."
+    return summary
+
+  # Return a cached response if this exact request was made before (in any conversion directory), or None.
+  def cached_response(self, cache_key):
+    response_str = llm_cache.get(cache_key)
+    if response_str is not None:
+      stats = llm_cache.stats()
+      print("Using cached response. (LLM cache hits/misses: " + str(stats.get("hits", 0)) + "/" + str(stats.get("misses", 0)) + ")")
+    return response_str
 
+  # Extract the response string from the given API response (caching it), or return "" for a refusal.
+  def process_response(self, api_response, model, cache_key):
     print("Response received from " + model)
 
     # Parse the response.
     try:
       if api_response.choices[0].message.refusal:
         print("Error: LLM refused to provide a complete response with the following message:")
-        print("       " + api_response.choices[0].message.content + "\n")
+        print("       " + api_response.choices[0].message.refusal + "\n")
         response_str = ""
       else:
         response_str = api_response.choices[0].message.content
         finish_reason = api_response.choices[0].finish_reason
-        completion_tokens = api_response.usage.completion_tokens
-        print("API response finish reason: " + finish_reason)
-        print("API response completion tokens: " + str(completion_tokens))
+        print("API response finish reason: " + str(finish_reason))
+        # (Usage may be missing from an interrupted stream.)
+        if api_response.usage is not None:
+          completion_tokens = api_response.usage.completion_tokens
+          self.last_usage = {"in": api_response.usage.prompt_tokens, "out": completion_tokens}
+          # Prompt tokens served from the provider's prompt cache (see add_request_context(..)).
+          cached = getattr(getattr(api_response.usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+          self.last_usage["cached"] = cached
+          continuations = getattr(api_response, "continuations", 0)
+          if continuations:
+            self.last_usage["continuations"] = continuations
+          self.prompt_tokens_total += api_response.usage.prompt_tokens
+          self.cached_tokens_total += cached
+          print("API response prompt tokens: " + str(api_response.usage.prompt_tokens) + " (" + str(cached) + " cached)")
+          print("API response completion tokens: " + str(completion_tokens))
+          print("Prompt cache hit rate this session: " + str(round(100 * self.cached_tokens_total / max(1, self.prompt_tokens_total))) + "% of prompt tokens")
+          details = getattr(api_response.usage, "completion_tokens_details", None)
+          accepted = getattr(details, "accepted_prediction_tokens", None) or 0
+          rejected = getattr(details, "rejected_prediction_tokens", None) or 0
+          if accepted or rejected:
+            self.last_usage["prediction"] = {"accepted": accepted, "rejected": rejected}
+            print("API response prediction tokens: " + str(accepted) + " accepted, " + str(rejected) + " rejected")
     except Exception as e:
       print("Error: API response is invalid.")
       print(str(e))
       fail()
+    # Cache the response (unless refusal).
+    if response_str != "":
+      llm_cache.put(cache_key, response_str)
+    return response_str
+
+
+# Incremental parsing of a streamed LLM response (in "json" or "md" format), to present the response as it arrives and
+# to abort it as soon as it is clearly malformed, rather than paying for the rest of it. A response is malformed if:
+#   - it does not begin in the expected format (a JSON object, or "## <field>" headers), or
+#   - its "verilog" field is not a string, is empty, or has "..." lines that cannot be merged with the request's Verilog.
+# The "verilog" field is written to a file (if given) as it arrives.
+# Usage:
+#   monitor = ResponseStreamMonitor(format, verilog, verilog_file_name, display)
+#   monitor.reset()
+#   error = monitor.feed(text)   # for each piece of the response; error is None or a reason to abort
+#   monitor.close()
+class ResponseStreamMonitor:
+  max_preamble = 400   # Characters permitted before the first "## " header of an "md" response.
+  verilog_key_re = re.compile(r'"verilog"\s*:\s*')
+  header_re = re.compile(r"## +(\w+)")
+
+  def __init__(self, format, verilog, verilog_file_name=None, display=False):
+    self.format = format
+    self.verilog_lines = verilog.splitlines()
+    self.verilog_file_name = verilog_file_name
+    self.display = display
+    self.reset()
+
+  def reset(self):
+    self.text = ""          # The response so far.
+    self.pos = 0            # The position in text to parse next.
+    self.started = False    # Whether the format of the response has been recognized.
+    self.in_verilog = False # Whether parsing the "verilog" field.
+    self.verilog = []       # Pieces of the "verilog" field so far.
+    self.verilog_done = False
+    self.file = None
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+  # Process the next piece of the response. Return None, or a reason to abort the response.
+  def feed(self, text):
+    self.text += text
+    return self.parse_json() if self.format == "json" else self.parse_md()
+
+  def parse_md(self):
+    while True:
+      eol = self.text.find("\n", self.pos)
+      if eol < 0:
+        break
+      line = self.text[self.pos:eol]
+      self.pos = eol + 1
+      match = self.header_re.match(line)
+      if match:
+        self.started = True
+        if self.in_verilog:
+          error = self.end_verilog()
+          if error is not None:
+            return error
+        if self.display:
+          print(line)
+        if match.group(1).lower() == "verilog" and not self.verilog_done:
+          self.begin_verilog()
+      elif self.in_verilog:
+        self.add_verilog(line + "\n")
+      elif self.display:
+        print(line)
+    if not self.started and len(self.text) > self.max_preamble:
+      return "The response does not begin with \"## <field>\" headers."
+    return None
+
+  def parse_json(self):
+    if not self.started:
+      if self.text.strip() == "":
+        return None
+      if self.text.lstrip()[0] != "{":
+        return "The response is not a JSON object."
+      self.started = True
+    if not self.in_verilog and not self.verilog_done:
+      match = self.verilog_key_re.search(self.text, max(0, self.pos - 20))
+      if match is None:
+        self.pos = len(self.text)
+        return None
+      if match.end() >= len(self.text):
+        self.pos = match.start()
+        return None
+      if self.text[match.end()] != '"':
+        return "The \"verilog\" field is not a string."
+      self.pos = match.end() + 1
+      self.begin_verilog()
+    if self.in_verilog:
+      # Decode the complete characters of the JSON string so far.
+      i = self.pos
+      while i < len(self.text) and self.text[i] != '"':
+        if self.text[i] == "\\":
+          length = 6 if self.text[i + 1:i + 2] == "u" else 2
+          if i + length > len(self.text):
+            break
+          i += length
+        else:
+          i += 1
+      self.add_verilog(json.loads('"' + self.text[self.pos:i] + '"'))
+      self.pos = i
+      if i < len(self.text) and self.text[i] == '"':
+        self.pos = i + 1
+        return self.end_verilog()
+    return None
+
+  def begin_verilog(self):
+    self.in_verilog = True
+    if self.verilog_file_name is not None:
+      self.file = open(self.verilog_file_name, "w", errors="replace")
+      if self.display:
+        print("(Writing the \"verilog\" field to " + self.verilog_file_name + " as it arrives.)")
+
+  def add_verilog(self, text):
+    self.verilog.append(text)
+    if self.file is not None:
+      self.file.write(text)
+      self.file.flush()
+
+  # End the "verilog" field, returning None or a reason to abort.
+  def end_verilog(self):
+    self.in_verilog = False
+    self.verilog_done = True
+    self.close()
+    body = "".join(self.verilog).strip("\n")
+    # Strip block quotes (as response_to_obj(..) does).
+    body = re.sub(r"^```(verilog)?\n(.*)\n+```$", r"\2", body, flags=re.DOTALL)
+    if self.display:
+      print("(" + str(len(body.splitlines())) + " lines of Verilog.)")
+    if body.strip() == "":
+      return "The \"verilog\" field is empty."
+    if body.strip() == "...":
+      return None
+    merged, error = ChangeMerger.merge_lines(body.splitlines(), self.verilog_lines)
+    if error is not None:
+      return "The \"verilog\" field cannot be merged with the original code (line " + str(error["line"]) + ": " + error["message"] + ")."
+    return None
+
+
+# A token-bucket-style budget of requests and tokens per minute for one model, for use by AsyncOpenAI_API.
+class RateBudget:
+  def __init__(self, rpm, tpm):
+    self.rpm = rpm
+    self.tpm = tpm
+    self.window = []   # [[time, tokens], ...] for requests in the last minute.
+
+  # Drop requests older than a minute from the window.
+  def prune(self):
+    now = time.monotonic()
+    while self.window and now - self.window[0][0] >= 60:
+      self.window.pop(0)
+
+  # Wait until a request of the given (estimated) number of tokens fits within the budget, then reserve it.
+  # Return the reservation, which can be passed to adjust(..) once actual usage is known.
+  async def acquire(self, tokens):
+    while True:
+      self.prune()
+      used = sum(entry[1] for entry in self.window)
+      # (An oversized request is permitted when the window is empty, rather than waiting forever.)
+      if not self.window or (len(self.window) < self.rpm and used + tokens <= self.tpm):
+        reservation = [time.monotonic(), tokens]
+        self.window.append(reservation)
+        return reservation
+      # Wait for the oldest request to leave the window.
+      await asyncio.sleep(max(0.1, 60 - (time.monotonic() - self.window[0][0])))
+
+  # Correct a reservation to reflect actual token usage.
+  def adjust(self, reservation, tokens):
+    reservation[1] = tokens
+
+
+# An asyncio variant of OpenAI_API, with a global limit on concurrent requests, per-model requests-per-minute and
+# tokens-per-minute budgets, a timeout on each request, and retries with exponential backoff and jitter for
+# transient failures (including 429 rate-limit errors). Requests can be issued concurrently with run_async(..)
+# (e.g. using asyncio.gather(..)), and in-flight requests can be cancelled with cancel(). run(..) is a synchronous
+# wrapper. A request that ultimately fails is reported and treated as a refusal (returning ""), rather than ending the session.
+class AsyncOpenAI_API(OpenAI_API):
+  max_concurrency = 8   # Maximum concurrent requests (across all models).
+  timeout = 600         # Seconds before a request is abandoned (and retried).
+  max_retries = 6       # Retries after the first attempt.
+  stream = True         # Stream responses (see ResponseStreamMonitor).
+  backoff_base = 2      # Seconds of delay before the first retry (doubling thereafter, with jitter).
+  backoff_max = 120     # Maximum delay between retries.
+
+  def __init__(self):
+    super().__init__()
+    self.budgets = {}    # RateBudget for each model.
+    self.tasks = set()   # In-flight request tasks.
+    # The asyncio client and semaphore are bound to the event loop in which they are used, so these are (re)created
+    # for each event loop.
+    self.loop = None
+    self.async_client = None
+    self.semaphore = None
+
+  # Prepare the asyncio client and semaphore for the current event loop.
+  def bind_loop(self):
+    loop = asyncio.get_running_loop()
+    if loop is not self.loop:
+      from openai import AsyncOpenAI
+      self.connect()
+      self.loop = loop
+      # (Retries are handled here, not by the client.)
+      self.async_client = AsyncOpenAI(max_retries=0) if self.org_id is None else AsyncOpenAI(organization=self.org_id, max_retries=0)
+      self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+  def budget(self, model):
+    if model not in self.budgets:
+      self.budgets[model] = RateBudget(models[model].get("rpm", default_rpm), models[model].get("tpm", default_tpm))
+    return self.budgets[model]
+
+  def run(self, messages, verilog, model=None):
+    # (The streamed Verilog is written to a scratch workspace, published as tmp/llm_stream.)
+    with ScratchDir("llm_stream") as scratch:
+      return asyncio.run(self.run_async(messages, verilog, model, stream_file=scratch.path("llm_stream.v")))
+
+  # Run the LLM API as run(..), but as a coroutine.
+  # sample: (opt) An index to distinguish concurrent samples for the same request (see prepare_request(..)).
+  # cache_keys: (opt) A list to which to append the llm_cache key of the request (as last_cache_key is not reliable for
+  #             concurrent requests).
+  # stream_file: (opt) If streaming, the file to which to write the "verilog" field as it arrives, in which case, the
+  #              response is also displayed as it arrives. (Otherwise, concurrent responses would be interleaved.)
+  async def run_async(self, messages, verilog, model=None, sample=None, cache_keys=None, stream_file=None, usages=None):
+    if model == None:
+      model = self.model
+    params, cache_key = self.prepare_request(messages, verilog, model, sample)
+    if params is None:
+      return ""
+    if cache_keys is not None:
+      cache_keys.append(cache_key)
+    response_str = self.cached_response(cache_key)
+    if response_str is not None:
+      return response_str
+    self.bind_loop()
+    task = asyncio.current_task()
+    self.tasks.add(task)
+    monitor = None
+    if self.stream:
+      monitor = ResponseStreamMonitor(apis[models[model]["api"]]["format"], verilog, stream_file, stream_file is not None)
+    try:
+      api_response = await self.create_with_retries(params, monitor)
+      if api_response is None:
+        return ""
+      # Continue a truncated response (not streamed).
+      responses = [api_response]
+      while True:
+        continuation_params = self.continuation_params(params, responses)
+        if continuation_params is None:
+          break
+        api_response = await self.create_with_retries(continuation_params)
+        if api_response is None:
+          break   # (The truncated response will likely be rejected.)
+        responses.append(api_response)
+    finally:
+      self.tasks.discard(task)
+    response_str = self.process_response(self.combine_responses(responses), model, cache_key)
+    # (last_usage is shared by concurrent requests, so record this request's usage before yielding.)
+    if usages is not None and self.last_usage is not None:
+      usages.append(dict(self.last_usage))
     return response_str
 
+  # Call the API with the given parameters, retrying transient failures. Return the API response or None on failure.
+  # monitor: (opt) A ResponseStreamMonitor, in which case the response is streamed (see create_streaming(..)).
+  async def create_with_retries(self, params, monitor=None):
+    import openai
+    model = params["model"]
+    # Estimate tokens (conservatively, assuming the maximum completion) for the rate budget.
+    tokens = sum(estimate_tokens(message["content"]) for message in params["messages"]) + (params.get("max_completion_tokens") or 0)
+    attempt = 0
+    while True:
+      # (The rate budget is acquired before the semaphore, so requests waiting for a throttled model do not hold up others.)
+      reservation = await self.budget(model).acquire(tokens)
+      async with self.semaphore:
+        delay = None
+        try:
+          with tracer.span("llm.api", model=model, attempt=attempt, stream=monitor is not None):
+            if monitor is None:
+              api_response = await asyncio.wait_for(self.async_client.chat.completions.create(**self.request_params(params)), self.timeout)
+            else:
+              api_response = await asyncio.wait_for(self.create_streaming(self.request_params(params), monitor), self.timeout)
+          if api_response is None:
+            # Aborted.
+            return None
+          if getattr(api_response, "usage", None) is not None:
+            self.budget(model).adjust(reservation, api_response.usage.total_tokens)
+          return api_response
+        except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError, asyncio.TimeoutError) as e:
+          if attempt >= self.max_retries:
+            print("Error: " + model + " request failed after " + str(attempt + 1) + " attempts: " + (str(e) or type(e).__name__))
+            return None
+          # Exponential backoff with full jitter, but no less than the server's requested delay (if any).
+          delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+          response = getattr(e, "response", None)
+          retry_after = response.headers.get("retry-after") if response is not None else None
+          if retry_after is not None:
+            try:
+              delay = max(delay, float(retry_after))
+            except ValueError:
+              pass
+          print("Warning: " + model + " request failed (" + (str(e) or type(e).__name__) + "). Retrying in " + str(round(delay, 1)) + "s.")
+        except openai.BadRequestError as e:
+          if "prediction" not in params:
+            print("Error: " + model + " request failed: " + str(e))
+            return None
+          # Fall back to a request without the prediction (immediately).
+          print("Warning: " + model + " request with a predicted output failed (" + str(e) + "). Retrying without prediction.")
+          self.prediction_unsupported.add(model)
+          params = {key: value for key, value in params.items() if key != "prediction"}
+          self.budget(model).adjust(reservation, 0)
+          delay = 0
+        except openai.APIError as e:
+          print("Error: " + model + " request failed: " + str(e))
+          return None
+      # Sleep outside of the semaphore.
+      attempt += 1
+      await asyncio.sleep(delay)
+
+  # Make a streaming request, feeding the response to the given monitor as it arrives.
+  # Return an object resembling a (non-streaming) API response, or None if the monitor found the response to be malformed,
+  # in which case, the response was aborted.
+  async def create_streaming(self, params, monitor):
+    monitor.reset()
+    stream = await self.async_client.chat.completions.create(**params, stream=True, stream_options={"include_usage": True})
+    content = []
+    refusal = []
+    finish_reason = None
+    usage = None
+    try:
+      async for chunk in stream:
+        if chunk.usage is not None:
+          usage = chunk.usage
+        if not chunk.choices:
+          continue
+        choice = chunk.choices[0]
+        if choice.finish_reason is not None:
+          finish_reason = choice.finish_reason
+        if getattr(choice.delta, "refusal", None):
+          refusal.append(choice.delta.refusal)
+        if choice.delta.content:
+          content.append(choice.delta.content)
+          error = monitor.feed(choice.delta.content)
+          if error is not None:
+            print("Error: Aborting the response from " + params["model"] + ": " + error)
+            return None
+    finally:
+      monitor.close()
+      await stream.close()
+    message = types.SimpleNamespace(content="".join(content), refusal="".join(refusal) if refusal else None)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message, finish_reason=finish_reason)], usage=usage)
+
+  # Cancel all in-flight requests.
+  def cancel(self):
+    for task in list(self.tasks):
+      task.cancel()
+
 
 
 # A message bundler that converts messages to and from the pseudo-Markdown format used in LLM messages.
@@ -356,6 +1893,10 @@ class PseudoMarkdownMessageBundler(MessageBundler):
       separator = "\n\n"
     return content
 
+  # Convert the given response object (as from response_to_obj(..)) back to a response string.
+  def obj_to_response(self, obj):
+    return self.obj_to_request({key: (("true" if value else "false") if type(value) == bool else str(value)) for key, value in obj.items()})
+
   """
   # TODO: Maybe this notion of sections should be replaced with an option for responses to
   # use "\n...\n" to omit portions of code. Yes... do this!
@@ -520,13 +2061,17 @@ class JsonMessageBundler(PseudoMarkdownMessageBundler):
   # Parameters:
   #   response: The response string from the LLM API.
   #   verilog: The original Verilog code, needed to reconstruct sections that are omitted in the response.
+  def obj_to_response(self, obj):
+    return json.dumps(obj, indent=4)
+
   def response_to_obj(self, response, verilog):
     try:
       response = json.loads(response)
     except Exception as e:
       print("Error: API response is not valid JSON.")
       print(str(e))
-      fail()
+      # (Missing "verilog" will result in rejection.)
+      return {}
 
     # Process the "verilog" field (expanding "..." lines).
     if (response.get("verilog") is not None):
@@ -539,185 +2084,422 @@ class JsonMessageBundler(PseudoMarkdownMessageBundler):
     return response
 
 
+# A message bundler for APIs with the "edits" property, whose responses provide an "edits" field (see EditScript) in
+# place of the "verilog" field. A response providing "verilog" is processed as usual (and chunked responses are
+# reassembled that way).
+class EditScriptMessageBundler(JsonMessageBundler):
+
+  def response_to_obj(self, response, verilog):
+    try:
+      obj = json.loads(response)
+    except Exception:
+      return super().response_to_obj(response, verilog)   # (Reports the error.)
+
+    if isinstance(obj, dict) and "edits" in obj:
+      edits = obj.pop("edits")
+      if "verilog" not in obj:
+        code, error = EditScript.apply(edits, verilog)
+        if error:
+          print("Error: Failed to apply the LLM's edits.")
+          print("       (" + error + ")")
+          # (Missing "verilog" will result in rejection.)
+        else:
+          print("Applied " + str(len(edits)) + " edit(s) from the LLM response.")
+          obj["verilog"] = code
+      response = json.dumps(obj)
+    return super().response_to_obj(response, verilog)
+
+
 # A class for incorporating changes from the LLM into the Verilog file.
 #
 # Request to the LLM include Verilog file contents.
 # Responses from the LLM include updated Verilog. This Verilog need not be provided in its entirety. "..." lines
 # can be used by the LLM to represent unchanged portions of the file.
-# We rely of diff and patch to reconstruct the full updated Verilog file as follows:
-#   1) We use diff to identify the changes, including the replacement of sections of code with "..." lines.
-#   2) We modify the diff file to remove the "..." substitutions.
-#   3) We apply the modified diff file to the original Verilog file to produce the updated Verilog file.
+# We reconstruct the full updated Verilog file in memory as follows:
+#   1) We diff the lines of the response against the lines of the original, identifying the changes, including the
+#      replacement of sections of code with "..." lines.
+#   2) We take the response lines, except that a "..." line that replaces a section of the original is substituted
+#      with that section.
+# A "..." line must be surrounded by unchanged context lines, so the omitted section is unambiguous.
+# No files or processes are involved, so merges are fast and can be done concurrently.
 class ChangeMerger:
-  hunk_header_re = re.compile(r'^@@ -(\d+),(\d+) \+(\d+),(\d+) @@')
-  
-  # Helper for adjust_diff (below) to write a hunk to the output file after adjusting its header.
-  def write_hunk(hunk, outfile, orig_offset):
-    # This is now handled by skip_hunk.
-    #if not any(line.startswith(('+', '-')) for line in hunk[1:]):  # Check if hunk has changes
-    #  return  # Skip empty hunks
-
-    # Adjust the hunk header
-    match = ChangeMerger.hunk_header_re.match(hunk[0])
-    if match:
-      orig_start, orig_orig_len, mod_start, orig_mod_len = map(int, match.groups())
-      # Adjust starting line numbers and lengths
-      orig_start += orig_offset
-      #mod_start += mod_offset
-      new_orig_len = sum(1 for line in hunk[1:] if line.startswith(('-', ' ')))
-      new_mod_len = sum(1 for line in hunk[1:] if line.startswith(('+', ' ')))
-      # mod_len should not change
-      if new_mod_len != orig_mod_len:
-        print("Bug: Hunk header length mismatch.")
-        fail()
-      hunk[0] = f"@@ -{orig_start},{new_orig_len} +{mod_start},{new_mod_len} @@\n"
-    outfile.writelines(hunk)
-    return new_orig_len - orig_orig_len
-  
-
-  # Create a modified diff file, removing "..." deltas.
-  # Note that the diff is created in reverse, so that the "..." lines will come first,
-  # for easier processing.
-  #
-  # Deltas are modified as in the following example:
-  #  -...
-  #  +// omitted
-  #  +// code
-  #  +// block
-  # becomes:
-  #   // omitted
-  #   // code
-  #   // block
-  #
-  # Hunk header lines are formatted as:
-  #  @@ -orig_start,orig_len +mod_start,mod_len @@
-  # The modifications reflect a change in the original (LLM response) file that affect
-  # headers as follows:
-  #   - Orig_len is recalculated for each hunk.
-  #   - Subsequent hunks are adjusted as follows:
-  #  3-1 is added to this and all subsequent hunk header's original (LLM response) line
-  #  number and length.
-  #
+  ellipsis_re = re.compile(r'^\s*\.\.\.')  # LLMs like to indent, so allow whitespace.
+
+  # Compute the diff opcodes (as difflib.SequenceMatcher.get_opcodes()) to transform list a into list b.
+  # Common leading and trailing lines are stripped in linear time before sequence matching, which, for the typical
+  # localized changes, leaves little to match.
+  def diff_opcodes(a, b):
+    # Strip common prefix and suffix.
+    start = 0
+    max_start = min(len(a), len(b))
+    while start < max_start and a[start] == b[start]:
+      start += 1
+    end = 0
+    max_end = max_start - start
+    while end < max_end and a[-1 - end] == b[-1 - end]:
+      end += 1
+    opcodes = []
+    if start > 0:
+      opcodes.append(("equal", 0, start, 0, start))
+    # Match the remainder.
+    if start < len(a) - end or start < len(b) - end:
+      matcher = difflib.SequenceMatcher(None, a[start:len(a) - end], b[start:len(b) - end], autojunk=False)
+      for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        opcodes.append((tag, i1 + start, i2 + start, j1 + start, j2 + start))
+    if end > 0:
+      opcodes.append(("equal", len(a) - end, len(a), len(b) - end, len(b)))
+    return opcodes
+
+  # Merge response lines that may contain "..." lines with the original lines.
   # Parameters:
-  #   input_diff: The original diff file path.
-  #   output_diff: The modified diff file path.
+  #   response_lines: The lines of the Verilog response (including "..." lines).
+  #   orig_lines: The lines of the original Verilog.
   # Returns:
-  #   Success (True) or failure (False).
-  def adjust_diff(input_diff, output_diff):
-    success = True
-    hunk = []  # Lines of the current hunk before writing it out with adjusted header
-    skip_hunk = True  # Skip hunks with no deltas
-    llm_line_offset = 0  # Tracks offset adjustments for the original (LLM response) file
-    #-pre_llm_line_offset = 0  # Tracks offset adjustments for the modified (pre-LLM) file
-
-    with open(input_diff, 'r') as infile, open(output_diff, 'w') as outfile:
-      line_type = "file_header"
-      for line in infile:
-        if ChangeMerger.hunk_header_re.match(line):
-          # Handle the previous hunk
-          if not skip_hunk:
-            llm_line_offset += ChangeMerger.write_hunk(hunk, outfile, llm_line_offset)
-          hunk = []  # Start a new hunk
-          skip_hunk = True  # Reset skip flag
-          line_type = "keep"
-        elif line_type == "file_header":
-          # Haven't reached the first hunk yet.
-          outfile.write(line)
-          # line_type remains "file_header".
-        #elif line.startswith('-...'):
-        elif re.match(r'^-\s*\.\.\.', line):  # LLMs like to indent, so allow whitespace.
-          if line_type != "keep":
-            print("Error: Failed to reconstruct '...' line from LLM Verilog response.")
-            print("       (The LLM didn't provide enough context before omitted text.)")
-            success = False
-            break
-          # Update offsets when skipping removed lines
-          #llm_line_offset -= 1
-          line_type = "..."
-        elif line.startswith('+'):
-          if line_type == "..." or line_type == "omitted":
-            # Change line from "+" prefix to " " prefix.
-            line = line.replace('+', ' ', 1)
-            # This line was omitted from original (LLM response) and we're adding it back.
-            #llm_line_offset += 1
-            line_type = "omitted"
-          else:
-            skip_hunk = False
-            line_type = "+"
-        elif line.startswith('-'):
-          if line_type == "...":
-            print("Error: Failed to reconstruct '...' line from LLM Verilog response.")
-            print("       (The LLM didn't provide enough context after omitted text.)")
-            success = False
-            break
-          else:
-            skip_hunk = False
-            line_type = "-"
+  #   [merged_lines, error], where merged_lines is None on error, and error is None or an object:
+  #     {"line": <response line number (1-based) of the offending "..." line>, "context": "before"|"after", "message": <message>}
+  def merge_lines(response_lines, orig_lines):
+    merged = []
+    for tag, i1, i2, j1, j2 in ChangeMerger.diff_opcodes(response_lines, orig_lines):
+      if tag == "equal":
+        merged += response_lines[i1:i2]
+      elif tag == "insert":
+        # Lines of the original were deleted.
+        pass
+      else:
+        # "replace" or "delete": Response lines are new, unless they are "..." lines.
+        segment = response_lines[i1:i2]
+        ellipses = [i for i, line in enumerate(segment) if ChangeMerger.ellipsis_re.match(line)]
+        if not ellipses:
+          merged += segment
+        elif len(segment) == 1:
+          # A "..." line in place of original lines (or no lines), which are restored.
+          merged += orig_lines[j1:j2]
         else:
-          # No delta (context) line.
-          line_type = "keep"
-        if line_type != "..." and line_type != "file_header":
-          hunk.append(line)
+          # A "..." line adjacent to changed lines, so it is not clear which original lines it omits.
+          context = "after" if ellipses[0] == 0 else "before"
+          return [None, {
+            "line": i1 + ellipses[0] + 1,
+            "context": context,
+            "message": "The LLM didn't provide enough context " + context + " omitted text."
+          }]
+    return [merged, None]
 
-      # Handle the final hunk
-      if not skip_hunk:
-        ChangeMerger.write_hunk(hunk, outfile, llm_line_offset)
-
-    return success
-  # Parameters:
-  #   orig_file: The original file path.
-  #   modified_file: The modified file path (including "..." lines).
-  #   diff_file: The path for the diff file.
-  #   modified_diff_file: The path for the modified diff file.
-  #   output_file: The output file path.
-  # Returns:
-  #   Success
-  def merge_changes(orig_file, modified_file, diff_file, modified_diff_file, output_file):
-    # Create a diff file between the original and modified files.
-    status = os.system(f"diff -u {modified_file} {orig_file} > {diff_file}")
-    if status != 0:
-      # Adjust the diff file to remove "..." substitutions.
-      if ChangeMerger.adjust_diff(diff_file, modified_diff_file):
-        # Apply the modified diff file to the original file to produce the output file.
-        rslt = run_command(['patch', '-R', '-o', output_file, orig_file, modified_diff_file])
-        if rslt.returncode == 0:
-          return True
-    else:
-      # No diff.
-      shutil.copyfile(orig_file, output_file)
-    return False
-  
   # Merge updated Verilog changes.
   # Parameters:
   #   body: The updated Verilog file contents with "..." lines.
   #   verilog: The original Verilog file contents.
   # Return:
   #   The updated Verilog file contents, or False on error.
+  @traced("merge")
   def merge_verilog_changes(body, verilog):
     # Make sure the Verilog code ends with a newline (because we pattern match lines ending in newline).
     if body != "" and body[-1] != "\n":
       body += "\n"
 
-    with open("tmp/llm_resp.v", "w") as f:
-      f.write(body)
     if body == "...\n":
-      # Won't use intermediate files. Delete them (if they exist) to avoid confusion.
-      if os.path.exists("tmp/diff.txt"):
-        os.remove("tmp/diff.txt")
-      if os.path.exists("tmp/diff_mod.txt"):
-        os.remove("tmp/diff_mod.txt")
-      if os.path.exists("tmp/llm_upd.v"):
-        os.remove("tmp/llm_upd.v")
-      body = verilog
-    else:
-      if ChangeMerger.merge_changes("tmp/pre_llm.v", "tmp/llm_resp.v", "tmp/diff.txt", "tmp/diff_mod.txt", "tmp/llm_upd.v"):
-        with open("tmp/llm_upd.v") as f:
-          body = f.read()
-      else:
-        body = False
-    return body
+      return verilog
+    merged, error = ChangeMerger.merge_lines(body.splitlines(), verilog.splitlines())
+    if error is not None:
+      print("Error: Failed to reconstruct '...' line " + str(error["line"]) + " from LLM Verilog response.")
+      print("       (" + error["message"] + ")")
+      return False
+    return "\n".join(merged) + "\n" if merged else ""
 
 
+# Application of an edit script, a compact LLM response format (for APIs with the "edits" property) in which the
+# response lists anchored edits to the request's Verilog, rather than providing the updated Verilog. Edits are applied in
+# order, each to the result of the previous ones. Each edit is an object with fields:
+#   kind: "replace" to replace the text "find" (which must occur exactly once) with "replace", or "regex" to substitute
+#         "replace" for every match of the (Python) regular expression "find".
+#   within: If non-empty, text that must occur exactly once, to which the edit is confined.
+# Text ("find" for "replace", and "within") is matched exactly or, failing that, as whole lines, ignoring leading and
+# trailing whitespace on each line (as LLMs are careless with indentation). Like ChangeMerger, this is done in memory.
+# Usage:
+#   code, error = EditScript.apply(edits, verilog)   # error is None or a message identifying the failed edit
+class EditScript:
+
+  # Find the unique occurrence of text in code.
+  # Return: [start, end, None], or [None, None, error-message].
+  @staticmethod
+  def locate(text, code):
+    if text.strip() == "":
+      return [None, None, "text is empty"]
+    cnt = code.count(text)
+    if cnt == 1:
+      start = code.find(text)
+      return [start, start + len(text), None]
+    if cnt > 1:
+      return [None, None, "text is ambiguous (found " + str(cnt) + " times)"]
+
+    # Match whole lines, ignoring leading/trailing whitespace.
+    find_lines = [line.strip() for line in text.strip("\n").split("\n")]
+    code_lines = code.split("\n")
+    offsets = [0]
+    for line in code_lines:
+      offsets.append(offsets[-1] + len(line) + 1)
+    stripped = [line.strip() for line in code_lines]
+    n = len(find_lines)
+    matches = [i for i in range(len(code_lines) - n + 1) if stripped[i:i + n] == find_lines]
+    if len(matches) == 1:
+      i = matches[0]
+      return [offsets[i], offsets[i + n] - 1, None]   # (Excluding the final newline.)
+    if matches:
+      return [None, None, "text is ambiguous (found " + str(len(matches)) + " times, ignoring whitespace)"]
+    return [None, None, "text not found"]
+
+  # Apply a single edit to code.
+  # Return: [code, None] or [None, error-message].
+  @staticmethod
+  def apply_edit(edit, code):
+    if not isinstance(edit, dict):
+      return [None, "edit is not an object"]
+    kind = edit.get("kind", "replace")
+    find = edit.get("find")
+    replace = edit.get("replace", "")
+    within = edit.get("within") or ""
+    if not isinstance(find, str) or not isinstance(replace, str) or not isinstance(within, str):
+      return [None, "\"find\", \"replace\", and \"within\" must be strings"]
+
+    # Confine the edit to "within".
+    start, end = [0, len(code)]
+    if within != "":
+      start, end, error = EditScript.locate(within, code)
+      if error:
+        return [None, "\"within\" " + error]
+    block = code[start:end]
+
+    if kind == "replace":
+      find_start, find_end, error = EditScript.locate(find, block)
+      if error:
+        return [None, "\"find\" " + error]
+      # A whitespace-insensitive match excludes the final newline, so drop it from the replacement, as from "find".
+      if find.endswith("\n") and replace.endswith("\n") and not block[:find_end].endswith("\n"):
+        replace = replace[:-1]
+      block = block[:find_start] + replace + block[find_end:]
+    elif kind == "regex":
+      try:
+        block, cnt = re.subn(find, replace, block, flags=re.MULTILINE)
+      except (re.error, IndexError) as e:
+        return [None, "bad regular expression or replacement (" + str(e) + ")"]
+      if cnt == 0:
+        return [None, "regular expression has no matches"]
+    else:
+      return [None, "unknown kind \"" + str(kind) + "\""]
+    return [code[:start] + block + code[end:], None]
+
+  # Apply a list of edits to code.
+  # Return: [code, None] or [None, error-message].
+  @staticmethod
+  @traced("merge.edits")
+  def apply(edits, code):
+    if not isinstance(edits, list):
+      return [None, "\"edits\" is not a list"]
+    for i in range(len(edits)):
+      code, error = EditScript.apply_edit(edits[i], code)
+      if error:
+        return [None, "Edit " + str(i + 1) + " of " + str(len(edits)) + ": " + error + "."]
+    return [code, None]
+
+
+
+# Splitting of a (large) Verilog module into chunks for separate LLM requests, and stitching of the refactored chunks.
+# The module is split into its header (through the port list), body items (always blocks, generate blocks, declarations,
+# assignments, instances, etc.), and its end (from "endmodule"). Body items are grouped into chunks of limited size.
+# The request for each chunk contains the header, end, and that chunk, with each other chunk replaced by a placeholder
+# comment block listing the other chunk's declarations (for context). Each chunk's response is mapped back to these
+# regions by diffing it with its request, and the refactored chunks are stitched together. Responses must leave
+# placeholders unchanged, and header and end changes from different chunks must agree.
+# Usage:
+#   chunker = VerilogChunker(verilog, max_tokens, count_tokens_fn)
+#   if chunker.chunks: (if the module could be split)
+#     request_lines = chunker.request(i)
+#     stitched_lines, error = chunker.stitch([response_lines_for_chunk_0, ...])
+class VerilogChunker:
+  open_re = re.compile(r"\b(begin|case|casex|casez|fork|generate|function|task)\b")
+  close_re = re.compile(r"\b(end|endcase|join|join_any|join_none|endgenerate|endfunction|endtask)\b")
+  item_end_re = re.compile(r"(;|\b(end|endcase|join|join_any|join_none|endgenerate|endfunction|endtask)\b(\s*:\s*\w+)?)$")
+  else_re = re.compile(r"else\b")
+  decl_re = re.compile(r"^\s*(wire|reg|logic|bit|var|tri|input|output|inout|localparam|parameter|integer|genvar|typedef)\b")
+  placeholder_prefix = "// LLM: Omitted Chunk "
+
+  # verilog: The Verilog code (a single module).
+  # max_tokens: The maximum size of a chunk (unless a single item is larger).
+  # count_tokens_fn: A function returning the number of tokens in the given text.
+  def __init__(self, verilog, max_tokens, count_tokens_fn):
+    self.lines = verilog.splitlines()
+    self.chunks = None   # Chunks as lists of items, which are lists of lines, or None if the module could not be split.
+    split = self.split()
+    if split is not None:
+      self.prefix, items, self.suffix = split
+      self.chunks = []
+      size = 0
+      for item in items:
+        item_size = count_tokens_fn("\n".join(item))
+        if not self.chunks or size + item_size > max_tokens:
+          self.chunks.append([])
+          size = 0
+        self.chunks[-1].append(item)
+        size += item_size
+
+  # Return the lines of the given Verilog lines with comments and strings removed (approximately).
+  def code_lines(lines):
+    ret = []
+    in_comment = False
+    for line in lines:
+      code = ""
+      i = 0
+      while i < len(line):
+        if in_comment:
+          end = line.find("*/", i)
+          if end < 0:
+            break
+          in_comment = False
+          i = end + 2
+        elif line.startswith("/*", i):
+          in_comment = True
+          i += 2
+        elif line.startswith("//", i):
+          break
+        elif line[i] == '"':
+          end = line.find('"', i + 1)
+          i = len(line) if end < 0 else end + 1
+        else:
+          code += line[i]
+          i += 1
+      ret.append(code)
+    return ret
+
+  # Split into [prefix, items, suffix] (see above), or return None if the code is not a single module that can be split.
+  def split(self):
+    code = VerilogChunker.code_lines(self.lines)
+    module_lines = [l for l, c in enumerate(code) if re.search(r"\b(module|macromodule)\b", c)]
+    end_lines = [l for l, c in enumerate(code) if re.search(r"\bendmodule\b", c)]
+    if len(module_lines) != 1 or len(end_lines) != 1 or end_lines[0] < module_lines[0]:
+      return None
+    # Find the end of the header: the first ";" outside of parentheses.
+    header_end = None
+    depth = 0
+    for l in range(module_lines[0], end_lines[0]):
+      for c in code[l]:
+        depth += 1 if c in "([{" else -1 if c in ")]}" else 0
+        if c == ";" and depth == 0:
+          header_end = l
+          break
+      if header_end is not None:
+        break
+    if header_end is None:
+      return None
+
+    # Split the body into items.
+    # A statement may complete at zero depth without completing its item, as in a begin-less "if" body followed by "else",
+    # (e.g. "always @(posedge clk) if (r) q <= 0; else q <= d;"), so an item is only ended once the next line of code is
+    # known not to begin with "else". Comments and blank lines in between go with the next item.
+    items = []
+    item = []
+    item_end = None   # The length of item if it ends before the next line of code (unless "else").
+    depth = 0     # begin/end (etc.) nesting depth
+    parens = 0    # ()[]{} nesting depth
+    for l in range(header_end + 1, end_lines[0]):
+      c = code[l].strip()
+      if item_end is not None and c:
+        if not VerilogChunker.else_re.match(c):
+          items.append(item[:item_end])
+          item = item[item_end:]
+        item_end = None
+      item.append(self.lines[l])
+      depth += len(VerilogChunker.open_re.findall(c)) - len(VerilogChunker.close_re.findall(c))
+      parens += sum(1 if ch in "([{" else -1 if ch in ")]}" else 0 for ch in c)
+      if depth <= 0 and parens <= 0 and (VerilogChunker.item_end_re.search(c) or c.startswith("`")):
+        item_end = len(item)
+        depth = parens = 0
+    if item_end is not None and item_end < len(item):
+      items.append(item[:item_end])
+      item = item[item_end:]
+    if item:
+      items.append(item)
+    if not items:
+      return None
+    return [self.lines[:header_end + 1], items, self.lines[end_lines[0]:]]
+
+  # Return the placeholder lines for chunk j.
+  def placeholder(self, j):
+    lines = [VerilogChunker.placeholder_prefix + str(j) + ": Code is omitted from this request. Keep these comment lines unchanged. Its declarations are:"]
+    for item in self.chunks[j]:
+      code = " ".join(c.strip() for c in VerilogChunker.code_lines(item) if c.strip())
+      if VerilogChunker.decl_re.match(code):
+        lines.append("//   " + code)
+    return lines
+
+  # Return [lines, regions] for the request for chunk i, where regions is a list of [kind, start, end] for each region of
+  # lines, with kind "prefix", "chunk", "omitted", or "suffix".
+  def request_regions(self, i):
+    lines = []
+    regions = []
+    def add(kind, region_lines):
+      regions.append([kind, len(lines), len(lines) + len(region_lines)])
+      lines.extend(region_lines)
+    add("prefix", self.prefix)
+    for j in range(len(self.chunks)):
+      if j == i:
+        add("chunk", [line for item in self.chunks[j] for line in item])
+      else:
+        add("omitted", self.placeholder(j))
+    add("suffix", self.suffix)
+    return [lines, regions]
+
+  # The lines of the request for chunk i.
+  def request(self, i):
+    return self.request_regions(i)[0]
+
+  # Map the response lines for chunk i to the regions of its request.
+  # Return [contents, error], where contents is a list of the new lines of each region (or None on error), and error is
+  # None or an error message.
+  def map_response(self, i, response_lines):
+    request_lines, regions = self.request_regions(i)
+    # The region of each request line.
+    region_of = [r for r, [kind, start, end] in enumerate(regions) for l in range(start, end)]
+    contents = [[] for r in regions]
+    for tag, i1, i2, j1, j2 in ChangeMerger.diff_opcodes(request_lines, response_lines):
+      if tag == "equal":
+        for l in range(i1, i2):
+          contents[region_of[l]].append(request_lines[l])
+        continue
+      if i1 < i2:
+        rs = set(region_of[i1:i2])
+      else:
+        # Insertion between regions. Prefer the chunk, then non-placeholder regions, then the preceding region.
+        candidates = [r for r in [region_of[i1 - 1] if i1 > 0 else None, region_of[i1] if i1 < len(request_lines) else None] if r is not None]
+        rs = {sorted(candidates, key=lambda r: (regions[r][0] != "chunk", regions[r][0] == "omitted"))[0]}
+      if len(rs) > 1:
+        return [None, "The response for chunk " + str(i) + " has an edit spanning regions of the request (at request lines " + str(i1 + 1) + "-" + str(i2) + ")."]
+      contents[rs.pop()] += response_lines[j1:j2]
+    for r, [kind, start, end] in enumerate(regions):
+      if kind == "omitted" and contents[r] != request_lines[start:end]:
+        return [None, "The response for chunk " + str(i) + " modified the placeholder for another chunk."]
+    return [contents, None]
+
+  # Stitch the given response lines for each chunk (after "..." expansion) into the full Verilog.
+  # Return [lines, error], where lines is None on error, and error is None or an error message.
+  def stitch(self, responses):
+    prefixes = []
+    suffixes = []
+    chunks = []
+    for i, response_lines in enumerate(responses):
+      contents, error = self.map_response(i, response_lines)
+      if error is not None:
+        return [None, error]
+      kinds = [kind for kind, start, end in self.request_regions(i)[1]]
+      prefixes.append(contents[kinds.index("prefix")])
+      suffixes.append(contents[kinds.index("suffix")])
+      chunks.append(contents[kinds.index("chunk")])
+    # Header and end changes from different chunks must agree.
+    stitched = []
+    for name, orig, versions in [["header", self.prefix, prefixes], ["end", self.suffix, suffixes]]:
+      changed = [version for version in versions if version != orig]
+      if any(version != changed[0] for version in changed):
+        return [None, "Chunks made conflicting changes to the module " + name + "."]
+      versions.insert(0, changed[0] if changed else orig)
+    return [prefixes[0] + [line for chunk in chunks for line in chunk] + suffixes[0], None]
 
 
 ###############
@@ -732,6 +2514,44 @@ class ChangeMerger:
 ###########
 
 
+# Return the SHA-256 hex digest of the contents of the given file.
+def file_sha256(file_name):
+  with open(file_name, "rb") as file:
+    return hashlib.sha256(file.read()).hexdigest()
+
+# Return the given property of the given model, from models[model] or, if not given there, its API (or None).
+def model_property(model, field):
+  if field in models[model]:
+    return models[model][field]
+  return apis[models[model]["api"]].get(field)
+
+# tiktoken encodings by model (or None to estimate tokens), initialized on first use by count_tokens(..).
+token_encodings = {}
+
+# Return the number of LLM tokens in the given text for the given model. This is exact if the (optional) tiktoken package
+# is installed, or estimated otherwise.
+def count_tokens(text, model):
+  if model not in token_encodings:
+    try:
+      import tiktoken
+      try:
+        token_encodings[model] = tiktoken.encoding_for_model(model)
+      except KeyError:
+        token_encodings[model] = tiktoken.get_encoding("o200k_base")
+    except Exception:
+      # tiktoken is not installed (or its encoding could not be loaded).
+      token_encodings[model] = None
+  encoding = token_encodings[model]
+  return estimate_tokens(text) if encoding is None else len(encoding.encode(text, disallowed_special=()))
+
+# Return the number of LLM tokens in the given messages (including the overhead of each message).
+def count_message_tokens(messages, model):
+  return sum(count_tokens(message["content"], model) + 4 for message in messages) + 3
+
+# Roughly estimate the number of LLM tokens in the given text.
+def estimate_tokens(text):
+  return len(text) // 4 + 1
+
 # Run a system command, reporting the error if it fails and produces stderr output.
 # Return the same structure as subprocess.run.
 def run_command(cmd):
@@ -751,8 +2571,16 @@ def run_command(cmd):
 
 # Report a usage message.
 def usage():
-  print("Usage: python3 .../convert.py")
+  print("Usage: python3 .../convert.py [--auto] [--model MODEL] [--max-attempts N] [--candidates N] [--fev-portfolio] [--predict] [--edits] [--no-stream]")
+  print("       python3 .../convert.py --batch MANIFEST [-j JOBS] [--model MODEL] [--max-attempts N] [--candidates N] [--fev-portfolio] [--predict] [--edits] [--no-stream] [--no-trace]")
+  print("       python3 .../convert.py --trace-summary [DIR ...]")
   print("  Call from a directory containing a single Verilog file to convert or a \"history\" directory.")
+  print("  With --batch, MANIFEST lists such directories, one per line.")
+  print("  With --predict, the current Verilog is passed to the LLM as a predicted output.")
+  print("  With --edits, the LLM responds with edits to the Verilog, rather than the full Verilog.")
+  print("  With --no-stream, LLM responses are not streamed.")
+  print("  With --fev-portfolio, --auto FEV runs a portfolio of engines concurrently.")
+  print("  With --no-trace, span traces (history/#/mod_#/trace.json) are not recorded.")
   fail()
 
 
@@ -799,7 +2627,9 @@ def set_cooked_mode(fd):
     termios.tcsetattr(fd, termios.TCSANOW, attrs)  # set new attributes
 
 # Set to default cooked mode (in case the last run was exited in raw mode).
-set_cooked_mode(sys.stdin.fileno())
+# (stdin is not a terminal for --auto runs.)
+if sys.stdin.isatty():
+  set_cooked_mode(sys.stdin.fileno())
 
 def getch():
   ## Save the current terminal settings
@@ -818,6 +2648,7 @@ def getch():
 
 
 # Prompt the user for a single char input (single keypress).
+# In --auto mode, the default (or "") is returned without prompting.
 def prompt_user(prompt, options=None, default=None):
   p = prompt
   if options:
@@ -825,6 +2656,10 @@ def prompt_user(prompt, options=None, default=None):
     if default:
       p += " (default: " + default + ")"
   print(p)
+  if auto_mode:
+    ch = default if default else ""
+    print("> " + ch + " (auto)")
+    return ch
   while True:
     again = False
     print("> ", end="")
@@ -853,6 +2688,8 @@ def get_command(options):
 
 # Pause for a key press.
 def press_any_key(note=""):
+  if auto_mode:
+    return
   print("Press any key to continue...%s\n>" % note, end="")
   getch()
   print("")
@@ -939,17 +2776,25 @@ def readStatus(mod = None):
   # Default mod to mod_num
   if mod is None:
     mod = mod_num
-  # Read status from latest history change directory.
+  if mod != mod_num:
+    # Prior modifications are read from the history index.
+    return history_index.status(refactoring_step, mod)
+  # Read status from latest history change directory. (It may have been edited manually, in which case, update the index.)
   try:
     with open(mod_path(mod) + "/status.json") as file:
-      return json.load(file)
+      status = json.load(file)
   except:
     return {}
+  history_index.set_status(refactoring_step, mod, status)
+  return status
 
 def writeStatus(status):
   # Write status to latest history change directory.
   with open(mod_path() + "/status.json", "w") as file:
     json.dump(status, file)
+  history_index.set_status(refactoring_step, mod_num, status)
+  # Record the spans leading up to this status.
+  tracer.flush(mod_path())
 
 # Evaluate the given anonymous function, fn(mod), from the most recent modification to the least recent until fn indicates completion.
 # fn(mod) returns False to keep iterating or True to terminate.
@@ -965,14 +2810,20 @@ def most_recent(fn, mod=None):
     mod -= 1
   return None
 
+# Number of the most recent modification that passed FEV or None.
+def most_recently_feved_mod():
+  readStatus()  # (Sync the index with any manual edits to the current status.)
+  return history_index.last(refactoring_step, mod_num, "feved")
+
 def most_recently_feved_verilog_file():
-  last_fev_mod = most_recent(lambda mn: (readStatus(mn).get("fev") == "passed"))
+  last_fev_mod = most_recently_feved_mod()
   assert(last_fev_mod is not None)
   return mod_path(last_fev_mod) + "/" + working_verilog_file_name
 
 # Number of the most recent modification (that actually made a change) or None.
 def most_recent_mod():
-  return most_recent(lambda mod: (readStatus(mod).get("modified", False)))
+  readStatus()  # (Sync the index with any manual edits to the current status.)
+  return history_index.last(refactoring_step, mod_num, "modified")
 
 # The path of the latest modification of this refactoring step.
 def mod_path(mod = None):
@@ -985,9 +2836,7 @@ def mod_path(mod = None):
 # Set mod_num to the maximum for the current refactoring step.
 def set_mod_num():
   global mod_num
-  mod_num = -1
-  while os.path.exists(mod_path(mod_num + 1)):
-    mod_num += 1
+  mod_num = history_index.max_mod(refactoring_step)
 
 
 # Get the actual modification of the given modification number (or current). In other words, if the given mod is a
@@ -995,12 +2844,7 @@ def set_mod_num():
 def actual_mod(mod=None):
   if mod is None:
     mod = mod_num
-  if os.path.islink(mod_path(mod)):
-    tmp1 = os.readlink(mod_path(mod))[4:]
-    tmp2 = int(tmp1)
-    return tmp2
-  else:
-    return mod
+  return history_index.actual(refactoring_step, mod)
 
 
 # Capture Verilog file in a new history/#/mod_#/, and if this was an LLM modification, capture messages.<api>.json and llm_response.txt.
@@ -1008,6 +2852,7 @@ def actual_mod(mod=None):
 #  old_status: For use only for the first checkpoint of a refactoring step. This is the status from the prior refactoring step.
 #  verilog_file: The verilog file to capture (defaulted to working_verilog_file_name and checkpointed as working_verilog_file_name regardless).
 # Sticky status is applied from current status. Status["incomplete"] will be carried over from the prior checkpoint for non-LLM updates.
+@traced("checkpoint")
 def checkpoint(status, old_status = None, verilog_file = None):
   if verilog_file is None:
     verilog_file = working_verilog_file_name
@@ -1025,15 +2870,20 @@ def checkpoint(status, old_status = None, verilog_file = None):
       status[field] = old_status[field]
   
   # Capture the current Verilog file in new mod dir and update current/chkpt.v.
+  parent = None if mod_num < 0 else actual_mod()
   mod_num += 1
   mod_dir = mod_path()
   os.mkdir(mod_dir)
-  os.system("cp " + verilog_file + " " + mod_dir + "/" + working_verilog_file_name)
+  # Files are captured in the object store, and are read-only (to prevent inadvertent modification, esp. in meld).
+  content_hash = object_store.store(verilog_file, mod_dir + "/" + working_verilog_file_name)
+  history_index.add_mod(refactoring_step, mod_num, parent, content_hash)
 
   # Capture messages.<api>.json and llm_response.txt if this was an LLM modification.
   if status.get("by") == "llm":
     api = status.get("api")
-    os.system("cp messages." + api + ".json llm_response.txt " + mod_dir)
+    for file_name in ["messages." + api + ".json", "llm_response.txt"]:
+      if os.path.exists(file_name):
+        object_store.store(file_name, mod_dir + "/" + file_name)
   
   # Write status.json.
   writeStatus(status)
@@ -1042,16 +2892,12 @@ def checkpoint(status, old_status = None, verilog_file = None):
   update_chkpt()
   update_feved()
 
-  # Make Verilog file read-only (to prevent inadvertent modification, esp. in meld).
-  # ("status.json" may still be updated with FEV status.)
-  os.system("chmod a-w " + mod_dir + "/" + working_verilog_file_name)
-
 
 # Create a reversion checkpoint as a symlink, or if the previous change was a reversion, update its symlink.
 def checkpoint_reversion(prev_mod):
   global mod_num
   # Prepare to create a new reversion checkpoint.
-  if os.path.islink(mod_path()):
+  if history_index.is_reversion(refactoring_step, mod_num):
     # Remove old reversion symlink.
     os.remove(mod_path())
   else:
@@ -1059,56 +2905,55 @@ def checkpoint_reversion(prev_mod):
     mod_num += 1
   # Create reversion symlink.
   os.symlink("mod_" + str(prev_mod), mod_path())
+  history_index.add_reversion(refactoring_step, mod_num, prev_mod)
   # Update current/chkpt.v and current/feved.v links to reflect this reversion.
   update_chkpt()
   update_feved()
 
 
+# Revert the working files to the given prior modification and record the reversion.
+def revert_to(prev_mod):
+  # Copy the checkpointed verilog, messages.<api>.json (if it exists), and llm_response.txt (if it exists).
+  # (Copy contents only, as the history files are read-only.)
+  shutil.copyfile(mod_path(prev_mod) + "/" + working_verilog_file_name, working_verilog_file_name)
+  for api in apis:
+    messages_json = "messages." + api + ".json"
+    if os.path.exists(mod_path(prev_mod) + "/" + messages_json):
+      shutil.copyfile(mod_path(prev_mod) + "/" + messages_json, messages_json)
+  if os.path.exists(mod_path(prev_mod) + "/llm_response.txt"):
+    shutil.copyfile(mod_path(prev_mod) + "/llm_response.txt", "llm_response.txt")
+
+  # Create a reversion checkpoint as a symlink, either as a new checkpoint or by updating the existing symlink.
+  checkpoint_reversion(prev_mod)
+
+
 
 ######################
 # Formatting/Parsing #
 ######################
 
+# A JSON string (which, in extended JSON, may contain newlines).
+json_string_re = re.compile(r'"(?:\\.|[^"\\])*"', re.DOTALL)
+# A newline (optionally followed by "+") in an extended JSON string.
+extended_json_newline_re = re.compile(r"\n\+?")
+# An escape sequence in a JSON string.
+json_escape_re = re.compile(r"\\(.)", re.DOTALL)
+
 # Process JSON with newlines in strings into proper JSON.
 def from_extended_json(ejson):
-  # Iterate over the characters of raw_contents, keeping track of whether we are within a string, and replacing newlines with '\n'.
+  # Replace newlines within strings with '\n'.
   # For backward-compatibility with an old syntax, we replace "\n+" as well as "\n" with '\n'.
-  json_str = ""
-  in_string = False
-  after_newline = False
-  for c in ejson:
-    if after_newline:
-      if c == '+':
-        after_newline = False
-        continue
-      after_newline = False
-    if c == '"':
-      in_string = not in_string
-    if c == '\n' and in_string:
-      c = '\\n'
-      after_newline = True
-    json_str += c
-  return json_str
+  return json_string_re.sub(lambda match: extended_json_newline_re.sub(r"\\n", match.group(0)), ejson)
 
 # Convert a JSON string into a more readable version with newlines in strings.
 def to_extended_json(json_str):
-  # Iterate over the characters of the JSON string, keeping track of whether we are within a string, and replacing '\n' with newlines.
-  ejson = ""
-  in_string = False
-  prev_c = None
-  for c in json_str:
-    if c == '"':
-      in_string = not in_string
-    if prev_c == '\\' and c == 'n' and in_string:
-      prev_c = None
-      c = '\n'
-    if prev_c != None:
-      ejson += prev_c
-    prev_c = c
-  if prev_c != None:
-    ejson += prev_c
-  return ejson
-
+  # Replace '\n' escapes within strings with newlines (leaving other escapes, such as '\\', alone). A newline before a
+  # "+" is followed by an extra "+" (which from_extended_json(..) drops).
+  def unescape(escape):
+    if escape.group(1) != "n":
+      return escape.group(0)
+    return "\n+" if escape.string.startswith("+", escape.end()) else "\n"
+  return json_string_re.sub(lambda match: json_escape_re.sub(unescape, match.group(0)), json_str)
 
 
 ##################
@@ -1116,40 +2961,118 @@ def to_extended_json(json_str):
 ##################
 
 
+# Normalize the "if" or "unless" conditions of a prompt into a list of [field, [values...]] (or None if not given).
+def normalize_prompt_conditions(conditions):
+  if conditions is None:
+    return None
+  # A field may have a string value rather than an array.
+  return [[field, [values] if type(values) == str else values] for field, values in conditions.items()]
+
+# Return a predicate function of status, indicating whether a prompt with the given normalized "if" and "unless"
+# conditions should be executed. A prompt with "if" conditions is executed only if any value of any field matches.
+# A prompt with "unless" conditions is executed unless some value of every field matches. ("" matches undefined.)
+def compile_prompt_conditions(if_conditions, unless_conditions):
+  def ok(status):
+    if if_conditions is not None and not any(status.get(field, "") in values for field, values in if_conditions):
+      return False
+    if unless_conditions and all(status.get(field, "") in values for field, values in unless_conditions):
+      return False
+    return True
+  return ok
+
+# Load prompts from the given prompts.json file.
+# prompts.json is a slight extension to JSON supporting newlines in strings. Any newlines within quotes are replaced with '\n'.
+# The parsed prompts, along with their normalized conditions, are cached in a compiled recipe file (<file>.cache, a
+# pickle) that is reused as long as prompts.json is unchanged (by modification time and size or, failing that,
+# content hash).
+# Return [prompts, prompts_by_desc, prompt_conditions], where:
+#   prompts: The list of prompts, each with an added "index" field.
+#   prompts_by_desc: A dictionary of prompts indexed by desc.
+#   prompt_conditions: A list of predicate functions of status for each prompt, indicating whether it should be executed
+#                      based on its "if" and "unless" conditions.
+def load_prompts(file_name):
+  cache_file = file_name + ".cache"
+  stat_key = [os.stat(file_name).st_mtime_ns, os.stat(file_name).st_size]
+  recipe = None
+  try:
+    with open(cache_file, "rb") as file:
+      recipe = pickle.load(file)
+    if recipe["version"] != prompt_recipe_version:
+      recipe = None
+  except Exception:
+    recipe = None
+
+  if recipe is None or recipe["stat"] != stat_key:
+    with open(file_name) as file:
+      raw_contents = file.read()
+    content_hash = hashlib.sha256(raw_contents.encode()).hexdigest()
+    if recipe is None or recipe["hash"] != content_hash:
+      # Compile the recipe.
+      prompts = json.loads(from_extended_json(raw_contents))
+      # Add an index field to prompts. Also provide a dictionary of prompts indexed by desc.
+      prompts_by_desc = {}
+      for id, prompt in enumerate(prompts):
+        prompt["index"] = id
+        desc = prompt["desc"]
+        if desc in prompts_by_desc:
+          print("Error: Duplicate prompt description: " + desc)
+          fail()
+        prompts_by_desc[desc] = prompt
+      conditions = [[normalize_prompt_conditions(prompt.get("if")), normalize_prompt_conditions(prompt.get("unless"))] for prompt in prompts]
+      recipe = {"version": prompt_recipe_version, "hash": content_hash, "prompts": prompts, "prompts_by_desc": prompts_by_desc, "conditions": conditions}
+    recipe["stat"] = stat_key
+    # Write the recipe (atomically). (It's just a cache, so it's okay if this fails.)
+    try:
+      tmp_file = cache_file + ".tmp" + str(os.getpid())
+      with open(tmp_file, "wb") as file:
+        pickle.dump(recipe, file)
+      os.replace(tmp_file, cache_file)
+    except OSError:
+      pass
+
+  prompt_conditions = [compile_prompt_conditions(if_conditions, unless_conditions) for if_conditions, unless_conditions in recipe["conditions"]]
+  return [recipe["prompts"], recipe["prompts_by_desc"], prompt_conditions]
+
+# Version of the compiled prompt recipe format (see load_prompts(..)). Increment when the format changes.
+prompt_recipe_version = 1
+
+
 # Initialize messages.<api>.json.
 # This is specific to the API, but we do this when initializing the refactoring step (before we know the API)
 # to enable human edits before the API call. So we create a different messages.<api>.json file for each possible
 # API.
+@traced("messages.init")
 def initialize_messages_json():
   status = readStatus()
   error = False
 
+  # Read the system message from <repo>/default_system_message.txt.
+  with open(repo_dir + "/default_system_message.txt") as file:
+    system_template = file.read()
+  prompt_template = prompts[prompt_id]["prompt"]
+
+  # Process the system message and prompt for every API with M5 (as a batch).
+  # Search prompt string for "m5_" and use M5 if found.
+  prompt_m5 = prompt_template.find("m5_") != -1
+  m5_jobs = []
+  for api in apis:
+    api_status = dict(status, api=api)
+    m5_jobs.append(["system_message", api, system_template, api_status])
+    if prompt_m5:
+      m5_jobs.append(["prompt", api, prompt_template, api_status])
+  rendered = iter(renderWithM5(m5_jobs))
+
   # For every API, initialize messages.<api>.json.
   for api in apis:
     try:
       status['api'] = api
       messages_json = "messages." + api + ".json"
 
-      # Read the system message from <repo>/default_system_message.txt.
-      with open(repo_dir + "/default_system_message.txt") as file:
-        system = file.read()
-      # Process with M5.
-      system = processWithM5("system_message", api, system, status)
+      system = next(rendered)
 
-      # Initialize messages.<api>.json.
+      # Initialize messages.<api>.json with the static parts of the request (see add_request_context(..)).
       with open(messages_json, "w") as message_file:
-        prompt = prompts[prompt_id]["prompt"]
-        # Search prompt string for "m5_" and use M5 if found.
-        if prompt.find("m5_") != -1:
-          prompt = processWithM5("prompt", "api", prompt, status)
-        # Add "needs" fields to the prompt.
-        if "needs" in prompts[prompt_id]:
-          prompt += "\n\nNote that the following \"extra fields\" have been determined to characterize the Verilog code:"
-          for field in prompts[prompt_id]["needs"]:
-            value = str(status.get(field, "UNKNOWN"))
-            if value == "UNKNOWN":
-              print("Error: The field \"" + field + "\" is needed by the prompt but is not in the status. Using \"UNKNOWN\".")
-            prompt += "\n   " + field + ": " + value
+        prompt = next(rendered) if prompt_m5 else prompt_template
         message_obj = {}
         # If prompt has a "background" field, add it (first) to the message.
         if "background" in prompts[prompt_id]:
@@ -1175,7 +3098,19 @@ def write_prompt_id():
     file.write('{"id": ' + str(prompt_id) + ', "desc": "' + prompts[prompt_id]["desc"] + '"}')
 
 
+# Find the ID of the next prompt following the given one whose "if" and "unless" conditions are satisfied by the given status.
+# Return None if there are no more prompts to execute.
+def next_prompt_id(id, old_status):
+  while True:
+    id += 1
+    if id >= len(prompts):
+      return None
+    if prompt_conditions[id](old_status):
+      return id
+
 # Initialize the conversion directory for the next refactoring step.
+# Return False (having done nothing) if there are no more refactoring steps.
+@traced("step.init")
 def init_refactoring_step():
   global refactoring_step, mod_num, prompt_id
 
@@ -1190,45 +3125,15 @@ def init_refactoring_step():
   else:
     old_status = readStatus()
     
+  # Find the next prompt that should be executed.
+  next_id = next_prompt_id(prompt_id, old_status)
+  if next_id is None:
+    print("All refactoring steps have been completed.")
+    return False
+  prompt_id = next_id
+
   refactoring_step += 1
   mod_num = -1
-
-  # Find the next prompt that should be executed.
-  ok = False
-  while not ok:
-    prompt_id += 1
-
-    # Check if conditions.
-    if_ok = True     # Prompt is okay to execute based on "if" conditions.
-    if "if" in prompts[prompt_id]:
-      if_ok = False
-      for field in prompts[prompt_id]["if"]:
-        # If the field is a string, make it an array of one string.
-        if type(prompts[prompt_id]["if"][field]) == str:
-          prompts[prompt_id]["if"][field] = [prompts[prompt_id]["if"][field]]
-        # If any of the values match, the prompt is okay.
-        for value in prompts[prompt_id]["if"][field]:
-          if value == old_status.get(field, ""):
-            if_ok = True
-            break
-    
-    # Check unless conditions.
-    unless_ok = True # Prompt is okay to execute based on "unless" conditions.
-    if "unless" in prompts[prompt_id]:
-      for field in prompts[prompt_id]["unless"]:
-        # If the field is a string, make it an array of one string.
-        if type(prompts[prompt_id]["unless"][field]) == str:
-          prompts[prompt_id]["unless"][field] = [prompts[prompt_id]["unless"][field]]
-        # If any of the values match, the prompt is not okay.
-        unless_ok = True
-        for value in prompts[prompt_id]["unless"][field]:
-          if value == old_status.get(field, ""):
-            unless_ok = False
-            break
-        if unless_ok:
-          break
-    
-    ok = if_ok and unless_ok
   
   # Update state in files.
 
@@ -1236,6 +3141,7 @@ def init_refactoring_step():
 
   # Make history/# directory and populate it.
   os.mkdir("history/" + str(refactoring_step))
+  history_index.begin_step(refactoring_step)
   os.system("cp prompt_id.txt history/" + str(refactoring_step) + "/")
   # Also, create an initial mod_0 directory populated with initial verilog and status.json indicating initial code.
   status = { "initial": True, "fev": "passed" }
@@ -1243,6 +3149,7 @@ def init_refactoring_step():
   # (mod_num now 0)
 
   initialize_messages_json()
+  return True
 
 
 
@@ -1255,48 +3162,181 @@ def init_refactoring_step():
 # M5
 #
 
-# Process text using M5, setting variables for sticky status fields.
-# Produces /tmp/m5/<what>.<api>.txt.m5 and /tmp/m5/<what>.<api>.txt.
+# Return the M5 variables (as a dict of name: value) for the given API and status: "api", "api_<field>" for the API's
+# properties, and "status_<field>" for fields of the status.
+def m5_variables(api, status):
+  variables = {"api": api}
+  for field in apis[api]:
+    variables["api_" + field] = str(apis[api][field])
+  for field in status:
+    variables["status_" + field] = str(status[field])
+  return variables
+
+# Return the m5_cache key for processing the given text with the given M5 variables. Only variables that are referenced
+# in the text (by name, e.g. as "$api_format" or "m5_api_format") are included, so variants that differ only in
+# unreferenced variables (e.g. APIs with the same format) share a rendering.
+def m5_cache_key(body, variables):
+  tokens = set(re.findall(r"\w+", body))
+  referenced = {name: value for name, value in variables.items() if name in tokens or "m5_" + name in tokens}
+  m5_bin = repo_dir + "/M5/bin/m5"
+  return DiskCache.key({"body": body, "variables": referenced, "m5": os.path.getmtime(m5_bin) if os.path.exists(m5_bin) else None})
+
+# Process text using M5, setting variables for sticky status fields. (See renderWithM5(..).)
 # Args:
 #   what: A string indicating what we are processing ("system_message", "prompt").
 #   body: The text to process.
 #   status: The current status object.
 def processWithM5(what, api, body, status):
+  return renderWithM5([[what, api, body, status]])[0]
+
+# Process a batch of texts using M5, as processWithM5(..). Each job is [what, api, body, status].
+# Results are memoized (in m5_cache) on the text and the variables it references, and identical jobs are processed once,
+# so typically, only the first refactoring step with a given prompt runs M5 at all. Remaining jobs run concurrently.
+# Return the processed texts, in the order of the jobs.
+@traced("m5")
+def renderWithM5(jobs):
+  keys = [m5_cache_key(body, m5_variables(api, status)) for what, api, body, status in jobs]
+  results = [m5_cache.get(key) for key in keys]
+  # Distinct jobs to run, as {key: job}.
+  to_run = {}
+  for key, job, result in zip(keys, jobs, results):
+    if result is None and key not in to_run:
+      to_run[key] = job
+  if to_run:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(to_run)) as pool:
+      outputs = dict(zip(to_run, pool.map(lambda job: runM5(*job), to_run.values())))
+    for key, [ok, output] in outputs.items():
+      if ok:
+        m5_cache.put(key, output)
+    results = [outputs[key][1] if result is None else result for key, result in zip(keys, results)]
+  return results
+
+# Run M5 on the given text, as processWithM5(..), but without memoization.
+# Produces <what>.<api>.txt.m5 and <what>.<api>.txt in a scratch workspace (published as tmp/m5.<what>.<api>).
+# Return [ok, processed text].
+@traced("m5.run")
+def runM5(what, api, body, status):
   # Pass fields of status to M5 as var(status_<field>, <value>).
   status_m5 = "m5_use(m5-local)"    # TODO: Requires local environment.
-  # Set M5 variables for the api and its properties.
-  status_m5 += "m5_var(api, ['" + api + "'])"
-  for field in apis[api]:
-    status_m5 += "m5_var(api_" + field + ", ['" + str(apis[api][field]) + "'])"
-  for field in status:
-    status_m5 += "m5_var(status_" + field + ", ['" + str(status[field]) + "'])"
+  # Set M5 variables for the api and its properties, and fields of status.
+  for name, value in m5_variables(api, status).items():
+    status_m5 += "m5_var(" + name + ", ['" + value + "'])"
   status_m5 = "m5_eval(" + status_m5 + ")"
   # Run M5.
-  # Delete(or not?) and create tmp/m5/.
-  #os.system("rm -rf tmp/m5")
-  if not os.path.exists("tmp/m5"):
-    os.mkdir("tmp/m5")
-  # Preppend m5_status to body.
-  body = status_m5 + body
-  # Write prompt to tmp/m5/prompt.txt.m5.
-  with open("tmp/m5/" + what + "." + api + ".txt.m5", "w") as file:
-    file.write(body)
-  # Run M5.
-  os.system(repo_dir + "/M5/bin/m5 --obj_dir tmp/m5 tmp/m5/" + what + "." + api + ".txt.m5 > tmp/m5/" + what + ".txt")
-  # Read <what>.txt.
-  with open("tmp/m5/" + what + ".txt") as file:
-    body = file.read()
-  return body
+  # (Each job has its own workspace, so jobs can run concurrently.)
+  with ScratchDir("m5." + what + "." + api) as scratch:
+    # Preppend m5_status to body, and write the prompt to <what>.<api>.txt.m5.
+    in_file = scratch.render(what + "." + api + ".txt.m5", status_m5 + body)
+    # Run M5.
+    with open(scratch.path(what + "." + api + ".txt"), "w") as out_file:
+      ok = subprocess.run([repo_dir + "/M5/bin/m5", "--obj_dir", scratch.path("obj"), in_file], stdout=out_file).returncode == 0
+    # Read <what>.<api>.txt.
+    with open(scratch.path(what + "." + api + ".txt")) as file:
+      body = file.read()
+  return [ok, body]
 
 
 #
 # LLM
 #
 
+# Read messages.<api>.json and the working Verilog for an LLM request, adding the "plan" (if any) to the messages.
+# Return [messages, verilog].
+def load_llm_request(api):
+  messages_json = "messages." + api + ".json"
+  with open(messages_json) as message_file:
+    with open(working_verilog_file_name) as verilog_file:
+      verilog = verilog_file.read()
+      # Strip leading and trailing whitespace, then add trailing newline.
+      verilog = verilog.strip() + "\n"
+      msg_file_str = message_file.read()
+      msg_json = from_extended_json(msg_file_str)
+      ## Dump the JSON to a file for debugging.
+      #with open("tmp/messages_debug.json", "w") as file:
+      #  file.write(msg_json)
+      messages = json.loads(msg_json)
+      add_request_context(messages, readStatus())
+  return [messages, verilog]
+
+# Add the volatile parts of an LLM request to its last (user) message: the "needs" fields of the prompt, then the plan
+# (if any). (The Verilog is added last, by the message bundler.) The static parts, the system message, background, and
+# prompt (from messages.<api>.json), come first, so they form a byte-identical prefix across refactoring steps and
+# modules that the API provider can cache (see OpenAI_API.process_response(..)).
+def add_request_context(messages, status):
+  # Add "needs" fields. (Unless already in the prompt, as they were in messages.<api>.json of earlier versions.)
+  if "needs" in prompts[prompt_id] and needs_preamble not in messages[-1]["content"]:
+    messages[-1]["content"] += "\n\n" + needs_preamble
+    for field in prompts[prompt_id]["needs"]:
+      value = str(status.get(field, "UNKNOWN"))
+      if value == "UNKNOWN":
+        print("Error: The field \"" + field + "\" is needed by the prompt but is not in the status. Using \"UNKNOWN\".")
+      messages[-1]["content"] += "\n   " + field + ": " + value
+  # Add "plan" field if given.
+  if "plan" in status:
+    messages[-1]["content"] += ("\n\nAnother agent has already made some progress and has established this plan:\n\n" + status["plan"])
+
+needs_preamble = "Note that the following \"extra fields\" have been determined to characterize the Verilog code:"
+
+# Validate an LLM response object (from response_to_obj(..)), reporting any problems.
+# Return [reject, extra_fields], where reject indicates that the response must be rejected and extra_fields is the
+# object containing the extra fields produced for the prompt (if any).
+def validate_llm_response(response_obj, model):
+  # For JSON, we use an "extra_fields" field to hold all the extra fields, otherwise these are flat with others.
+  use_extra_fields = apis[models[model]["api"]]["format"] == "json"
+  extra_fields = None  # The object containing extra_fields (and maybe other stuff).
+  reject = False
+
+  # "verilog" field is required.
+  if "verilog" not in response_obj:
+    print("\nError: API response is missing \"verilog\" field.")
+    print("Rejecting response.")
+    reject = True
+  elif not response_obj["verilog"]:
+    print("\nError: Failed to process \"verilog\" field in response.")
+    print("Rejecting response.")
+    reject = True
+  else:
+    # Check that this prompt produces all requested fields. If it does not, we force rejection.
+    if "must_produce" in prompts[prompt_id]:
+      if use_extra_fields and not "extra_fields" in response_obj:
+        print("Error: API response is missing \"extra_fields\" field.")
+        print("Rejecting response.")
+        reject = True
+      else:
+        # Make sure all extra_fields exist in response.
+        extra_fields = response_obj if not use_extra_fields else response_obj["extra_fields"]
+        for field in prompts[prompt_id]["must_produce"]:
+          if field not in extra_fields:
+            print("Error: API response is missing required field: " + field)
+            print("Rejecting response.")
+            reject = True
+  return [reject, extra_fields]
+
+# Return the status for a checkpoint of an LLM modification.
+# orig_status: The status of the prior checkpoint.
+def llm_status(response_obj, model, modified, extra_fields, orig_status):
+  status = { "by": "llm", "model": model, "api": models[model]["api"], "incomplete": response_obj.get("incomplete", False), "modified": modified, "initial": False }
+  if not modified:
+    # Reflect FEV and compile status from prior checkpoint.
+    status["compile"] = orig_status.get("compile")
+    status["sim"] = orig_status.get("sim")
+    status["fev"] = orig_status.get("fev")
+  # Record plan.
+  if "plan" in response_obj:
+    status["plan"] = response_obj["plan"]
+  # Apply combination of must_produce and may_produce fields to status.
+  for field in prompts[prompt_id].get("must_produce", []) + prompts[prompt_id].get("may_produce", []):
+    if field in extra_fields:
+      status[field] = extra_fields[field]
+  return status
+
 # Checkpoint any manual edits, run LLM, and checkpoint the result if successful. Return nothing.
 # messages: The messages.<api>.json object in OpenAI format.
 # verilog: The current Verilog file contents.
-def run_llm(messages, verilog, model="gpt-3.5-turbo"):
+# chunked: True to refactor the module in chunks (see run_chunked(..)), False not to, or None to do so (with confirmation)
+#          if the request is too large.
+@traced("llm")
+def run_llm(messages, verilog, model="gpt-3.5-turbo", chunked=None):
 
   # Run the LLM, passing the messages.<api>.json and verilog file contents.
 
@@ -1309,31 +3349,39 @@ def run_llm(messages, verilog, model="gpt-3.5-turbo"):
   press_any_key()
 
   # If there is already a response, prompt the user about possibly reusing it.
-  # TODO: Consider using a disk/DB memoization library to cache responses, such as https://grantjenks.com/docs/diskcache/.
+  # (Otherwise, identical requests are served from llm_cache.)
   reuse_llm_response = "n"
   if os.path.exists("llm_response.txt"):
     reuse_llm_response = prompt_user("There is already a response to this prompt. Would you like to reuse it [y/N]?")
 
-  # For JSON, we use an "extra_fields" field to hold all the extra fields, otherwise these are flat with others.
-  use_extra_fields = apis[models[model]["api"]]["format"] == "json"
   extra_fields = None  # The object containing extra_fields (and maybe other stuff).
 
   reject = False
   modified = True
+  # (pre_llm.v and llm.v are written to a scratch workspace, published as tmp/llm.)
+  scratch = ScratchDir("llm")
   with FileLocked(working_verilog_file_name):
     checkpoint_if_pending()
     # Capture working file as the version we'll send to the LLM.
-    os.system("cp " + working_verilog_file_name + " tmp/pre_llm.v")
-    # Make writable.
-    os.system("chmod a+w " + "tmp/pre_llm.v")
+    shutil.copyfile(working_verilog_file_name, scratch.path("pre_llm.v"))
     
+    cache_keys = []   # llm_cache keys of the request(s).
     if reuse_llm_response == "y":
       # Use llm_response.txt.
+      llm_api.last_cache_key = None
+      llm_api.last_usage = None
       with open("llm_response.txt") as file:
         response_str = file.read()
     else:
-      # Call the API.
-      response_str = llm_api.run(messages, verilog, model)
+      # Call the API (in chunks if the module is too large for a single request).
+      if chunked is None:
+        chunked = llm_api.too_large(messages, verilog, model) and \
+                  prompt_user("The module is too large to refactor reliably in a single " + model + " request. Refactor it in chunks?", ["y", "n"], "y") == "y"
+      if chunked:
+        response_str, cache_keys = run_chunked(messages, verilog, model)
+      else:
+        response_str = llm_api.run(messages, verilog, model)
+        cache_keys = [llm_api.last_cache_key]
       # Write llm_response.txt (unless refusal).
       if (response_str != ""):
         with open("llm_response.txt", "w") as file:
@@ -1345,31 +3393,7 @@ def run_llm(messages, verilog, model="gpt-3.5-turbo"):
     if not reject:
       # Process the response.
       response_obj = get_message_bundler_for_model(model).response_to_obj(response_str, verilog)
-
-      # "verilog" field is required.
-      if "verilog" not in response_obj:
-        print("\nError: API response is missing \"verilog\" field.")
-        print("Rejecting response.")
-        reject = True
-      elif not response_obj["verilog"]:
-        print("\nError: Failed to process \"verilog\" field in response.")
-        print("Rejecting response.")
-        reject = True
-      else:
-        # Check that this prompt produces all requested fields. If it does not, we force rejection.
-        if "must_produce" in prompts[prompt_id]:
-          if use_extra_fields and not "extra_fields" in response_obj:
-            print("Error: API response is missing \"extra_fields\" field.")
-            print("Rejecting response.")
-            reject = True
-          else:
-            # Make sure all extra_fields exist in response.
-            extra_fields = response_obj if not use_extra_fields else response_obj["extra_fields"]
-            for field in prompts[prompt_id]["must_produce"]:
-              if field not in extra_fields:
-                print("Error: API response is missing required field: " + field)
-                print("Rejecting response.")
-                reject = True
+      reject, extra_fields = validate_llm_response(response_obj, model)
 
     if not reject:
       # We haven't forced rejection.
@@ -1401,8 +3425,8 @@ def run_llm(messages, verilog, model="gpt-3.5-turbo"):
       # Are there any modifications to the Verilog?
       modified = code != verilog
 
-      # Write tmp/llm.v with updated (or not) Verilog.
-      with open("tmp/llm.v", "w") as file:
+      # Write llm.v with updated (or not) Verilog.
+      with open(scratch.path("llm.v"), "w") as file:
         file.write(code)
 
     # Unlock the working file.
@@ -1442,20 +3466,12 @@ def run_llm(messages, verilog, model="gpt-3.5-turbo"):
       
       # Checkpoint the LLM's change, whether modified or not.
       orig_status = readStatus()
-      status = { "by": "llm", "model": model, "api": api, "incomplete": response_obj.get("incomplete", False), "modified": modified, "initial": False }
-      if not modified:
-        # Reflect FEV and compile status from prior checkpoint.
-        status["compile"] = orig_status.get("compile")
-        status["fev"] = orig_status.get("fev")
-      # Record plan.
-      if "plan" in response_obj:
-        status["plan"] = response_obj["plan"]
-      # Apply combination of must_produce and may_produce fields to status.
-      for field in prompts[prompt_id].get("must_produce", []) + prompts[prompt_id].get("may_produce", []):
-        if field in extra_fields:
-          status[field] = extra_fields[field]
-        
-      checkpoint(status, orig_status, "tmp/llm.v")
+      status = llm_status(response_obj, model, modified, extra_fields, orig_status)
+      if llm_api.last_usage is not None:
+        status["tokens"] = llm_api.last_usage
+      # (So the response is not served from the cache again if it fails FEV. See forget_llm_response(..).)
+      status["llm_cache_keys"] = [cache_key for cache_key in cache_keys if cache_key is not None]
+      checkpoint(status, orig_status, scratch.path("llm.v"))
 
       # Now, checkpoint the user's changes, if there are any.
       checkpoint_if_pending()
@@ -1464,73 +3480,801 @@ def run_llm(messages, verilog, model="gpt-3.5-turbo"):
       os.remove("llm_response.txt")
     else:
       # Revert to the prior change.
-      copy_if_different("tmp/pre_llm.v", working_verilog_file_name)
+      copy_if_different(scratch.path("pre_llm.v"), working_verilog_file_name)
       print("Changes rejected. Restored to code prior to running LLM.")
+      reject = True
+
+  # Don't serve a rejected response from the cache if the same request is made again.
+  if reject:
+    for cache_key in cache_keys:
+      if cache_key is not None:
+        llm_cache.delete(cache_key)
+  scratch.close()
+
+
+# Run the LLM on a large module in chunks (see VerilogChunker). Each chunk is refactored by its own request, with the
+# other chunks omitted (except for their declarations), and these requests are made concurrently. The refactored chunks
+# are stitched together into a single response (to be FEVed as a whole).
+# Return [response_str, cache_keys], where response_str is the combined response, in the format of the model's API
+# (or "" if any chunk failed), and cache_keys are the llm_cache keys of the chunk requests.
+@traced("llm.chunked")
+def run_chunked(messages, verilog, model):
+  max_completion_tokens = llm_api.max_completion_tokens(model) or 8000
+  # Leave room in the response for the rest of the request (header and placeholders) and other fields.
+  chunker = VerilogChunker(verilog, max(500, (max_completion_tokens - llm_api.min_completion_overhead) // 2), lambda text: count_tokens(text, model))
+  if chunker.chunks is None or len(chunker.chunks) < 2:
+    print("Warning: The module could not be split into chunks. Running the LLM on the whole module.")
+    response_str = llm_api.run(messages, verilog, model)
+    return [response_str, [llm_api.last_cache_key]]
+  num_chunks = len(chunker.chunks)
+  print("Refactoring the module in " + str(num_chunks) + " chunks.")
+
+  # Make the requests concurrently.
+  chunk_verilog = ["\n".join(chunker.request(i)) + "\n" for i in range(num_chunks)]
+  cache_keys = []
+  usages = []   # The usage of each chunk's request (if from the API).
+  async def run_all():
+    requests = []
+    for i in range(num_chunks):
+      chunk_messages = copy.deepcopy(messages)
+      chunk_messages[-1]["content"] += "\n\nNote that this module is large, so it is being refactored in " + str(num_chunks) + " parts, by separate requests. " + \
+        "In this request, refactor only the code that is present in the \"verilog\" field. Each other part is replaced by a comment block beginning \"" + VerilogChunker.placeholder_prefix + "\", " + \
+        "listing its declarations for reference. These comment blocks must remain unchanged, and changes to the module header and \"endmodule\" should be avoided."
+      requests.append(llm_api.run_async(chunk_messages, chunk_verilog[i], model, cache_keys=cache_keys, usages=usages))
+    return await asyncio.gather(*requests)
+  llm_api.last_usage = None
+  responses = asyncio.run(run_all())
+  # Report the total usage of all chunks (rather than that of whichever chunk finished last).
+  llm_api.last_usage = llm_api.total_usage(usages)
+
+  # Process each response.
+  bundler = get_message_bundler_for_model(model)
+  response_objs = []
+  for i, response_str in enumerate(responses):
+    print("\nChunk " + str(i) + ":")
+    if response_str == "":
+      print("Error: No response for chunk " + str(i) + ".")
+      return ["", cache_keys]
+    response_obj = bundler.response_to_obj(response_str, chunk_verilog[i])
+    reject, extra_fields = validate_llm_response(response_obj, model)
+    if reject:
+      return ["", cache_keys]
+    response_objs.append(response_obj)
+
+  # Stitch the chunks.
+  lines, error = chunker.stitch([response_obj["verilog"].splitlines() for response_obj in response_objs])
+  if error is not None:
+    print("Error: Failed to stitch the refactored chunks: " + error)
+    return ["", cache_keys]
+
+  # Combine the responses.
+  combined = {"verilog": "\n".join(lines) + "\n"}
+  for field in ["overview", "notes", "issues", "plan"]:
+    parts = ["(Chunk " + str(i) + ") " + response_obj[field] for i, response_obj in enumerate(response_objs) if response_obj.get(field)]
+    if parts:
+      combined[field] = "\n".join(parts)
+  combined["incomplete"] = any(response_obj.get("incomplete") is True for response_obj in response_objs)
+  # Extra fields (from the first chunk providing each).
+  use_extra_fields = apis[models[model]["api"]]["format"] == "json"
+  extra_fields = {}
+  for response_obj in response_objs:
+    for field in prompts[prompt_id].get("must_produce", []) + prompts[prompt_id].get("may_produce", []):
+      value = (response_obj.get("extra_fields", {}) if use_extra_fields else response_obj).get(field)
+      if value is not None:
+        if field in extra_fields and extra_fields[field] != value:
+          print("Warning: Chunks disagree on \"" + field + "\". Using \"" + str(extra_fields[field]) + "\".")
+        extra_fields.setdefault(field, value)
+  if use_extra_fields:
+    if extra_fields or "must_produce" in prompts[prompt_id]:
+      combined["extra_fields"] = extra_fields
+  else:
+    combined.update(extra_fields)
+  return [bundler.obj_to_response(combined), cache_keys]
+
+# Send the current prompt to the LLM as concurrent requests for num_candidates candidates (using the models of model_list
+# in turn), and as each response arrives, merge and validate it and FEV it in its own scratch directory (tmp/spec/<n>).
+# Checkpoint the best candidate that passes FEV, which is either the first to pass (select="first", in which case
+# outstanding LLM requests are cancelled) or the one with the smallest diff vs. the current code (select="smallest").
+# Return True if a candidate was checkpointed.
+@traced("llm.speculative")
+def run_speculative(model_list, num_candidates, select="first"):
+  print("")
+  print("The following prompt will be sent as " + str(num_candidates) + " concurrent requests to " + "/".join(model_list) + " together with the Verilog and prior messages:")
+  print("")
+  print(load_llm_request(models[model_list[0]]["api"])[0][-1]["content"])
+  print("")
+  press_any_key()
+
+  passing = []   # Candidates that passed FEV, in the order they passed.
+  with FileLocked(working_verilog_file_name):
+    checkpoint_if_pending()
+    orig_file_name = most_recently_feved_verilog_file()
+    # (Candidates are evaluated in subdirectories of a scratch workspace, published as tmp/spec.)
+    spec = ScratchDir("spec")
+
+    # Request, merge, validate, and FEV candidate i.
+    async def evaluate(i):
+      model = model_list[i % len(model_list)]
+      label = "Candidate " + str(i) + " (" + model + ")"
+      messages, verilog = load_llm_request(models[model]["api"])
+      cache_keys = []
+      usages = []
+      response_str = await llm_api.run_async(messages, verilog, model, sample=i, cache_keys=cache_keys, usages=usages)
+      # Failing candidates are removed from the cache, so a later run of the same request samples afresh.
+      forget = lambda: forget_llm_response({"llm_cache_keys": [key for key in cache_keys if key is not None]})
+      if response_str == "":
+        print(label + ": No response.")
+        return
+      # (Merging is synchronous, so candidates are merged one at a time.)
+      response_obj = get_message_bundler_for_model(model).response_to_obj(response_str, verilog)
+      reject, extra_fields = validate_llm_response(response_obj, model)
+      if reject:
+        print(label + ": Response rejected.")
+        forget()
+        return
+      work_dir = spec.path(str(i))
+      os.makedirs(work_dir)
+      candidate_file = work_dir + "/" + working_verilog_file_name
+      with open(candidate_file, "w") as file:
+        file.write(response_obj["verilog"])
+      strip_temporary_comments(candidate_file)
+      with open(candidate_file) as file:
+        code = file.read()
+      modified = response_obj["verilog"] != verilog
+      checks = {}
+      if modified:
+        checks = await asyncio.to_thread(precheck_fev, orig_file_name, candidate_file, work_dir)
+        if "failed" in checks.values():
+          print(label + ": Pre-FEV checks failed.")
+          passed = False
+        else:
+          print(label + ": Running FEV (logging to " + work_dir + "/fev.log).")
+          passed = await asyncio.to_thread(run_fev, orig_file_name, candidate_file, True, work_dir)
+      else:
+        passed = True
+      diff_size = sum(1 for line in difflib.unified_diff(verilog.splitlines(), code.splitlines(), lineterm="", n=0) if line[:1] in "+-") if modified else 0
+      print(label + ": " + ("FEV passed" if passed else "FEV failed") + " (" + str(diff_size) + " diff lines).")
+      if not passed:
+        forget()
+      if passed:
+        passing.append({"index": i, "model": model, "response_str": response_str, "response_obj": response_obj,
+                        "extra_fields": extra_fields, "file": candidate_file, "modified": modified, "diff_size": diff_size,
+                        "checks": checks, "cache_keys": [key for key in cache_keys if key is not None],
+                        "usage": usages[0] if usages else None})
+        if select == "first":
+          # Done. Cancel outstanding requests.
+          llm_api.cancel()
+
+    async def evaluate_all():
+      return await asyncio.gather(*[evaluate(i) for i in range(num_candidates)], return_exceptions=True)
+    report_candidate_exceptions(asyncio.run(evaluate_all()))
+    spec.close()
+
+  if not passing:
+    print("No candidate passed FEV. (See tmp/spec/.)")
+    return False
+  winner = passing[0] if select == "first" else min(passing, key=lambda candidate: candidate["diff_size"])
+  print("Checkpointing candidate " + str(winner["index"]) + ".")
+
+  # Checkpoint the winner as an LLM modification that has passed FEV.
+  with open("llm_response.txt", "w") as file:
+    file.write(winner["response_str"])
+  orig_status = readStatus()
+  checkpoint(speculative_status(winner, num_candidates, orig_status), orig_status, winner["file"])
+  copy_if_different(winner["file"], working_verilog_file_name)
+  os.remove("llm_response.txt")
+  return True
+
+
+# Report the exceptions (other than cancellation) among the results of run_speculative(..)'s candidate evaluations (from
+# asyncio.gather(..., return_exceptions=True)), which would otherwise be lost.
+def report_candidate_exceptions(results):
+  for i, result in enumerate(results):
+    if isinstance(result, BaseException) and not isinstance(result, asyncio.CancelledError):
+      print("Error: Candidate " + str(i) + " failed with an exception: " + type(result).__name__ + ": " + str(result))
+
+# Return the status with which to checkpoint the given winning candidate of run_speculative(..), recording, as for a single
+# request (see run_llm(..) and fev_current(..)), its pre-FEV checks, token usage, and llm_cache keys.
+def speculative_status(winner, num_candidates, orig_status):
+  status = llm_status(winner["response_obj"], winner["model"], winner["modified"], winner["extra_fields"], orig_status)
+  status.update(winner["checks"])
+  status["fev"] = "passed"
+  status["candidates"] = num_candidates
+  if winner["usage"] is not None:
+    status["tokens"] = winner["usage"]
+  status["llm_cache_keys"] = winner["cache_keys"]
+  return status
 
 
 #
 # FEV
 #
 
-# Run SymbiYosys.
-def run_sby():
-  return subprocess.run(["sby", "-f", "tmp/fev.sby"])
-
-# Run EQY.
-def run_eqy():
-  return subprocess.run(["eqy", "-f", "tmp/fev.eqy"])
+# Run EQY on the given script (relative to cwd).
+# cwd: (opt) The directory in which to run (where the "fev" output directory is created).
+# log: (opt) A file to which to write output (rather than stdout).
+@traced("fev.eqy")
+def run_eqy(eqy_file, cwd=None, log=None):
+  return subprocess.run(["eqy", "-f", eqy_file], cwd=cwd, stdout=log, stderr=(subprocess.STDOUT if log else None))
 
 # Run FEV using Yosys on the given top-level module name and orig and modified files.
+# cwd, log: As for run_eqy(..).
+# log_file: (opt) A file to which Yosys should also write its log.
+# depth: (opt) The FEV depth (see fev_depth(..)).
 # Return the subprocess.CompletedProcess of the FEV command.
-def run_yosys_fev(module_name, orig_file_name, modified_file_name):
-  env = {"TOP_MODULE": module_name, "ORIGINAL_VERILOG_FILE": orig_file_name, "MODIFIED_VERILOG_FILE": modified_file_name}
-  return subprocess.run(["yosys", repo_dir + "/fev.tcl"], env=env)
+@traced("fev.yosys")
+def run_yosys_fev(module_name, orig_file_name, modified_file_name, cwd=None, log=None, log_file=None, depth=None):
+  env = {"TOP_MODULE": module_name, "ORIGINAL_VERILOG_FILE": os.path.abspath(orig_file_name), "MODIFIED_VERILOG_FILE": os.path.abspath(modified_file_name)}
+  if depth is not None:
+    env.update({"FEV_DEPTH": str(depth["depth"]), "FEV_RESET_CYCLES": str(depth["reset_cycles"])})
+  cmd = ["yosys", repo_dir + "/fev.tcl"] if log_file is None else ["yosys", "-l", os.path.abspath(log_file), repo_dir + "/fev.tcl"]
+  return subprocess.run(cmd, env=env, cwd=cwd, stdout=log, stderr=(subprocess.STDOUT if log else None))
+
+# The FEV engines of the portfolio (see run_fev_portfolio(..)). Each runs in its own directory, with its own script,
+# rendered from the given template, and its output logged to "log" in that directory.
+#   tools: The executables required by the engine.
+#   script: The template in repo_dir for the script (fev.eqy, fev.sby, or fev.tcl).
+#   solver: (for SBY) The smtbmc solver.
+#   cmd: The command, run in the engine's directory.
+fev_engines = {
+  "eqy":           {"tools": ["eqy"], "script": "fev.eqy", "cmd": ["eqy", "-f", "fev.eqy"]},
+  "sby-yices":     {"tools": ["sby", "yices-smt2"], "script": "fev.sby", "solver": "yices", "cmd": ["sby", "-f", "fev.sby"]},
+  "sby-boolector": {"tools": ["sby", "boolector"], "script": "fev.sby", "solver": "boolector", "cmd": ["sby", "-f", "fev.sby"]},
+  "sby-z3":        {"tools": ["sby", "z3"], "script": "fev.sby", "solver": "z3", "cmd": ["sby", "-f", "fev.sby"]},
+  "yosys":         {"tools": ["yosys"], "script": "fev.tcl", "cmd": ["yosys", "-l", "yosys.log", "fev.tcl"]}
+}
+fev_engine_timeout = 600   # Seconds before an engine of the portfolio is abandoned.
+fev_stats_file = "history/fev_engines.json"   # Per-engine timing for this module.
+fev_stats_lock = threading.Lock()
+
+# Render the given FEV script template from repo_dir for the given files (as absolute paths) and depth (see fev_depth(..)).
+# solver: (opt) For SBY, the smtbmc solver to use.
+def render_fev_script(template, orig_file_name, modified_file_name, depth, solver=None):
+  with open(repo_dir + "/" + template) as file:
+    script = file.read()
+  script = script.replace("<MODULE_NAME>", module_name)
+  script = script.replace("<DEPTH>", str(depth["depth"])).replace("<RESET_CYCLES>", str(depth["reset_cycles"]))
+  script = script.replace("<ORIGINAL_FILE>", os.path.abspath(orig_file_name))
+  script = script.replace("<MODIFIED_FILE>", os.path.abspath(modified_file_name))
+  if solver is not None:
+    script = re.sub(r"^smtbmc\b.*$", "smtbmc " + solver, script, flags=re.MULTILINE)
+  return script
+
+# Return the verdict of an FEV engine from its return code and output: True (passed), False (failed), or None
+# (inconclusive, e.g. a tool error, timeout, or unproven partition).
+# tool: The engine's tool (the first of its "tools"), "eqy", "sby", or "yosys". EQY reports its result with a summary line
+#       ("Successfully proved designs equivalent" or "Failed to prove equivalence ..."), SBY with "DONE (PASS|FAIL...)",
+#       and Yosys (fev.tcl) with the result of its "sat" proof.
+def fev_verdict(returncode, log_text, tool=None):
+  if tool == "eqy":
+    if returncode != 0 and re.search(r"\bFailed to prove equivalence\b", log_text):
+      return False
+    if returncode == 0 and re.search(r"\bSuccessfully proved designs equivalent\b", log_text):
+      return True
+    return None
+  if re.search(r"DONE \(FAIL|model found: FAIL!", log_text):
+    return False
+  if returncode == 0 and re.search(r"DONE \(PASS|no model found: SUCCESS!", log_text):
+    return True
+  return None
+
+def read_fev_stats():
+  try:
+    with open(fev_stats_file) as file:
+      return json.load(file)
+  except (FileNotFoundError, ValueError):
+    return {}
+
+# Record the given engine results ({engine: {"result": "passed"|"failed"|"inconclusive"|"timeout"|"killed", "seconds": #}})
+# in fev_stats_file as {engine: {"runs": #, "wins": #, "conclusive": #, "seconds": #, "timeouts": #}}, where "seconds" is
+# the total time of conclusive runs.
+def record_fev_stats(results, winner):
+  if not os.path.isdir(os.path.dirname(fev_stats_file)):
+    return
+  with fev_stats_lock:
+    stats = read_fev_stats()
+    for engine, result in results.items():
+      entry = stats.setdefault(engine, {"runs": 0, "wins": 0, "conclusive": 0, "seconds": 0.0, "timeouts": 0})
+      entry["runs"] += 1
+      if engine == winner:
+        entry["wins"] += 1
+      if result["result"] in ["passed", "failed"]:
+        entry["conclusive"] += 1
+        entry["seconds"] = round(entry["seconds"] + result["seconds"], 1)
+      elif result["result"] == "timeout":
+        entry["timeouts"] += 1
+    with open(fev_stats_file + ".tmp", "w") as file:
+      json.dump(stats, file, indent=2)
+    os.replace(fev_stats_file + ".tmp", fev_stats_file)
+
+# Return the names of the FEV engines whose tools are installed, fastest first (by mean conclusive time for this module;
+# engines without a conclusive run come first, so they are measured).
+def fev_portfolio_engines():
+  stats = read_fev_stats()
+  def mean_seconds(engine):
+    entry = stats.get(engine, {})
+    return entry["seconds"] / entry["conclusive"] if entry.get("conclusive") else 0.0
+  engines = [engine for engine, props in fev_engines.items() if all(shutil.which(tool) for tool in props["tools"])]
+  return sorted(engines, key=mean_seconds)
+
+# Run a portfolio of FEV engines concurrently on the given files, one per core (fastest first), taking the first
+# conclusive result and killing the others.
+# fev_dir: The directory in which to create the engines' directories (fev_dir/portfolio/<engine>).
+# depth: The FEV depth (see fev_depth(..)).
+# Return [passed, log_text, winner], where winner is the engine providing the verdict, or None if no engine was conclusive.
+@traced("fev.portfolio")
+def run_fev_portfolio(orig_file_name, modified_file_name, fev_dir, depth):
+  engines = fev_portfolio_engines()
+  if len(engines) == 0:
+    print("Error: No FEV engines are installed.")
+    return [False, "", None]
+  max_running = max(1, os.cpu_count() or 1)
+  env = {**os.environ, "TOP_MODULE": module_name, "ORIGINAL_VERILOG_FILE": os.path.abspath(orig_file_name), "MODIFIED_VERILOG_FILE": os.path.abspath(modified_file_name),
+         "FEV_DEPTH": str(depth["depth"]), "FEV_RESET_CYCLES": str(depth["reset_cycles"])}
+  pending = engines[:]
+  running = {}   # {engine: [proc, start time]}
+  results = {}
+  winner = None
+  verdict = None
+  log_text = ""
+  print("Running FEV engines: " + ", ".join(engines))
+  try:
+    while (pending or running) and winner is None:
+      # Launch engines on free cores.
+      while pending and len(running) < max_running:
+        engine = pending.pop(0)
+        props = fev_engines[engine]
+        engine_dir = fev_dir + "/portfolio/" + engine
+        shutil.rmtree(engine_dir, ignore_errors=True)
+        os.makedirs(engine_dir + "/tmp")
+        with open(engine_dir + "/" + props["script"], "w") as file:
+          file.write(render_fev_script(props["script"], orig_file_name, modified_file_name, depth, props.get("solver")))
+        with open(engine_dir + "/log", "w") as log:
+          # (A new session, so the engine's solver processes can be killed with it.)
+          proc = subprocess.Popen(props["cmd"], cwd=engine_dir, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        running[engine] = [proc, time.time()]
+      time.sleep(0.1)
+      for engine, [proc, start] in list(running.items()):
+        seconds = round(time.time() - start, 1)
+        if proc.poll() is None:
+          if seconds > fev_engine_timeout:
+            kill_process_group(proc)
+            del running[engine]
+            results[engine] = {"result": "timeout", "seconds": seconds}
+            print("FEV engine " + engine + " timed out.")
+          continue
+        del running[engine]
+        with open(fev_dir + "/portfolio/" + engine + "/log", errors="replace") as file:
+          engine_log = file.read()
+        passed = fev_verdict(proc.returncode, engine_log, fev_engines[engine]["tools"][0])
+        results[engine] = {"result": {True: "passed", False: "failed", None: "inconclusive"}[passed], "seconds": seconds}
+        print("FEV engine " + engine + ": " + results[engine]["result"] + " (" + str(seconds) + "s)")
+        if passed is not None and winner is None:
+          winner = engine
+          verdict = passed
+          log_text = engine_log
+  finally:
+    # Kill the remaining engines.
+    for engine, [proc, start] in running.items():
+      kill_process_group(proc)
+      results[engine] = {"result": "killed", "seconds": round(time.time() - start, 1)}
+  record_fev_stats(results, winner)
+  if winner is None:
+    print("Error: No FEV engine was conclusive. (Logs: " + fev_dir + "/portfolio/*/log)")
+    return [False, log_text, None]
+  print("FEV verdict from " + winner + ". (Log: " + fev_dir + "/portfolio/" + winner + "/log)")
+  return [verdict, log_text, winner]
+
+# Kill the given process and its process group (for processes started with start_new_session=True).
+def kill_process_group(proc):
+  try:
+    os.killpg(proc.pid, signal.SIGKILL)
+  except OSError:
+    pass
+  proc.wait()
+
+# Return the Yosys "sat" command used for FEV of the "miter" module (as in fev.tcl), dumping any counterexample to the given VCD file.
+# Reset is forced if the RESET_SIGNAL_NAME and RESET_ASSERTION_LEVEL env vars are given.
+# depth: (opt) {"depth": #, "reset_cycles": #} (see fev_depth(..)), defaulting to fev_default_depth.
+def yosys_sat_command(vcd_file, depth=None):
+  if depth is None:
+    depth = fev_default_depth
+  # Must init states to 0 because initialization will be inconsistent between orig and modified otherwise and will mismatch during reset.
+  reset_duration = depth["reset_cycles"]
+  seq_value = max(1, depth["depth"] - 1)
+  reset_signal_name = os.getenv("RESET_SIGNAL_NAME", "")
+  reset_assertion_level = os.getenv("RESET_ASSERTION_LEVEL", "")
+  reset_level = 0 if reset_assertion_level == "low" else 1
+  reset_cmds = ""
+  if reset_assertion_level != "":
+    for i in range(1, reset_duration + 1):
+      reset_cmds += " -set-at " + str(i) + " in_" + reset_signal_name + " " + str(reset_level)
+    for i in range(reset_duration + 1, seq_value + 2):
+      reset_cmds += " -set-at " + str(i) + " in_" + reset_signal_name + " " + str(1 - reset_level)
+  return "sat -show-all -seq " + str(seq_value) + " -prove-asserts -enable_undef -set-init-zero" + reset_cmds + " -dump_vcd " + vcd_file + " miter"
+
+# FEV depth.
+# The depth of bounded FEV (cycles from zero-initialized state, including reset) is derived from a structural analysis of
+# the original design. fev_default_depth is the floor, which the analysis can only raise, except for designs without
+# feedback through state elements, whose state is fully determined by recent inputs: combinational logic needs no
+# sequential depth, and pipelines need fev_reset_cycles of reset followed by enough cycles for inputs to propagate
+# through the deepest pipeline twice (within bounds). The fev_depth and fev_reset_cycles sticky status fields, if
+# present, override the analysis for the module.
+fev_default_depth = {"depth": 20, "reset_cycles": 5}   # The floor, and the depth if the design cannot be analyzed.
+fev_reset_cycles = 5
+fev_min_operational_cycles = 4
+fev_max_depth = 64
+fev_depth_memo = {}   # {sha256 of original file: depth}
+def fev_depth(orig_file_name):
+  status = readStatus()
+  if "fev_depth" in status:
+    return {"depth": int(status["fev_depth"]), "reset_cycles": int(status.get("fev_reset_cycles", fev_reset_cycles))}
+  key = file_sha256(orig_file_name)
+  if key not in fev_depth_memo:
+    depth = fev_default_depth
+    netlist = yosys_fev_server.netlist(module_name, orig_file_name) if shutil.which("yosys") else None
+    if netlist is not None and module_name in netlist.get("modules", {}):
+      flops, pipeline_depth, feedback = sequential_depth(netlist["modules"][module_name])
+      depth = derive_fev_depth(flops, pipeline_depth, feedback)
+      print("FEV depth: " + str(depth["depth"]) + " cycles, including " + str(depth["reset_cycles"]) + " of reset (" + str(flops) + " state elements, pipeline depth " + str(pipeline_depth) + (", with feedback" if feedback else ", without feedback") + ").")
+    fev_depth_memo[key] = depth
+  if "fev_reset_cycles" in status:
+    return {**fev_depth_memo[key], "reset_cycles": int(status["fev_reset_cycles"])}
+  return fev_depth_memo[key]
+
+# The FEV depth for a design with the given structure (from sequential_depth(..)).
+def derive_fev_depth(flops, pipeline_depth, feedback):
+  if flops == 0:
+    return {"depth": 2, "reset_cycles": 0}
+  operational = min(fev_max_depth - fev_reset_cycles, max(fev_min_operational_cycles, 2 * pipeline_depth + 2))
+  depth = fev_reset_cycles + operational
+  if feedback:
+    # The reachable state space may be arbitrarily deep, so never go below the floor.
+    depth = max(depth, fev_default_depth["depth"])
+  return {"depth": depth, "reset_cycles": fev_reset_cycles}
+
+# Analyze the given flattened Yosys JSON netlist module, returning [flops, pipeline_depth, feedback], where flops is the
+# number of state elements (flip-flops, latches, and memories), feedback is True if any cell's output reaches its own
+# input (which, for logic without combinational loops, is through state elements) or any state element can hold its
+# value (with an enable, as latches and memories), and pipeline_depth is the largest number of state elements on any
+# path through the logic (excluding cells on or after feedback loops).
+def sequential_depth(module):
+  state_re = re.compile(r"^\$(_(\w*DFF\w*|\w*DLATCH\w*|SR|FF)_.*|\w*dff\w*|ff|\w*dlatch\w*|sr|mem|mem_v2)$")
+  hold_re = re.compile(r"dffe|dlatch|sr|mem|aldff", re.IGNORECASE)   # (Applied to state elements.)
+  cells = list(module.get("cells", {}).values())
+  readers = {}   # {bit: [cell index]}
+  for i, cell in enumerate(cells):
+    for port, bits in cell.get("connections", {}).items():
+      if cell.get("port_directions", {}).get(port) == "input":
+        for bit in bits:
+          if isinstance(bit, int):   # (Not a constant.)
+            readers.setdefault(bit, []).append(i)
+  # Cell graph: an edge from each cell to each cell reading one of its outputs.
+  successors = [set() for cell in cells]
+  in_degree = [0] * len(cells)
+  for i, cell in enumerate(cells):
+    for port, bits in cell.get("connections", {}).items():
+      if cell.get("port_directions", {}).get(port) == "output":
+        for bit in bits:
+          for j in readers.get(bit, []):
+            if j not in successors[i]:
+              successors[i].add(j)
+              in_degree[j] += 1
+  # Longest paths, counting state elements, in topological order (Kahn's algorithm). Cells left unvisited are on or
+  # after a cycle.
+  depth = [1 if state_re.match(cell["type"]) else 0 for cell in cells]
+  queue = collections.deque(i for i in range(len(cells)) if in_degree[i] == 0)
+  visited = 0
+  while queue:
+    i = queue.popleft()
+    visited += 1
+    for j in successors[i]:
+      depth[j] = max(depth[j], depth[i] + (1 if state_re.match(cells[j]["type"]) else 0))
+      in_degree[j] -= 1
+      if in_degree[j] == 0:
+        queue.append(j)
+  flops = sum(1 for cell in cells if state_re.match(cell["type"]))
+  pipeline_depth = max([depth[i] for i in range(len(cells)) if in_degree[i] == 0] or [0])
+  hold = any(state_re.match(cell["type"]) and hold_re.search(cell["type"]) for cell in cells)
+  return [flops, pipeline_depth, visited < len(cells) or hold]
+
+# Return the depths at which to run bounded FEV for iterative deepening to the given depth, so shallow counterexamples
+# are found quickly.
+def fev_depth_schedule(depth):
+  reset_cycles = depth["reset_cycles"]
+  depths = [min(depth["depth"], reset_cycles + 2), reset_cycles + (depth["depth"] - reset_cycles) // 2, depth["depth"]]
+  return [{"depth": d, "reset_cycles": reset_cycles} for d in sorted(set(depths))]
+
+# Normalize RTLIL (from write_rtlil) for comparison of logic, removing source attributes and the module name, and
+# renumbering declared private (auto-generated) wire, cell, memory, and process names in order of appearance, as these
+# depend on source locations and on unrelated logic. (Other "$" tokens, such as cell types, are left alone.)
+def normalize_rtlil(rtlil):
+  lines = [line.strip() for line in rtlil.splitlines()]
+  lines = [line for line in lines if line != "" and not line.startswith("#") and not line.startswith("attribute \\src ") and not line.startswith("module ")]
+  ids = {}
+  for line in lines:
+    match = re.match(r"^(wire|cell|memory|process)\b.* (\$\S*)$", line)
+    if match:
+      ids.setdefault(match.group(2), "$" + str(len(ids)))
+  return re.sub(r"\$\S*", lambda match: ids.get(match.group(0), match.group(0)), "\n".join(lines))
+
+# Normalize Verilog code for comparison, removing comments and collapsing whitespace (outside of strings). Line breaks
+# are significant to the preprocessor (ending `define bodies and // comments), so they are kept (though blank lines and
+# indentation are not).
+def normalize_verilog(code):
+  # Split into strings, comments, and other code, replacing comments with whitespace (keeping their line breaks).
+  parts = [""]   # Alternating code and strings.
+  for token in re.split(r'("(?:\\.|[^"\\\n])*"|//[^\n]*|/\*.*?\*/)', code, flags=re.DOTALL):
+    if token.startswith('"'):
+      parts += [token, ""]
+    elif token.startswith("//") or token.startswith("/*"):
+      parts[-1] += " " + "\n" * token.count("\n")
+    else:
+      parts[-1] += token
+  # Collapse whitespace within lines, and blank lines, in code.
+  for i in range(0, len(parts), 2):
+    parts[i] = re.sub(r"[ \t\r\f\v]+", " ", parts[i])
+    parts[i] = re.sub(r" ?\n[ \n]*", "\n", parts[i])
+  return "".join(parts).strip()
+
+# Cheap checks before FEV, to reject malformed or clearly inequivalent code in well under a second, reserving formal
+# proof for plausible code:
+#   - compile: The modified code must parse and elaborate (in Yosys).
+#   - sim: A short random co-simulation (with Icarus Verilog) of a miter of the two designs must show no output
+#          mismatch. Each of sim_trials runs (with different seeds) simulates sim_cycles cycles from zero-initialized
+#          state (as for FEV), with reset (per RESET_SIGNAL_NAME/RESET_ASSERTION_LEVEL) asserted for the first 5 cycles.
+# work_dir: (opt) The directory in which to create the "sim" directory (by default, a scratch workspace, published as tmp/sim).
+# Return {"compile": "passed"|"failed", "sim": "passed"|"failed"|"skipped"} with only the checks that were run (none if
+# Yosys is not installed, and no "sim" if Icarus Verilog is not installed or the simulation was inconclusive), where "sim"
+# is "skipped" if the miter cannot be simulated meaningfully.
+@traced("fev.precheck")
+def precheck_fev(orig_file_name, modified_file_name, work_dir=None):
+  if not shutil.which("yosys"):
+    return {}
+  if work_dir is None:
+    with ScratchDir("sim") as scratch:
+      return precheck_fev_in(orig_file_name, modified_file_name, scratch.dir)
+  sim_dir = work_dir + "/sim"
+  os.makedirs(sim_dir, exist_ok=True)
+  return precheck_fev_in(orig_file_name, modified_file_name, sim_dir)
+
+# Run pre-FEV checks, as precheck_fev(..), in the given directory.
+def precheck_fev_in(orig_file_name, modified_file_name, sim_dir):
+  checks = {}
+  start = time.time()
+  compiled, log_text = yosys_fev_server.write_sim_miter(module_name, orig_file_name, modified_file_name, sim_dir + "/miter.v")
+  with open(sim_dir + "/yosys.log", "w") as file:
+    file.write(log_text)
+  if compiled is None:
+    return checks
+  checks["compile"] = "passed" if compiled else "failed"
+  if not compiled:
+    print("Error: The code failed to compile. (Log: " + sim_dir + "/yosys.log)")
+    return checks
+  if shutil.which("iverilog") and shutil.which("vvp"):
+    with open(sim_dir + "/miter.v") as file:
+      testbench, reason = sim_testbench(file.read())
+    if testbench is None:
+      checks["sim"] = "skipped"
+      print("Warning: Not simulated: " + reason)
+    else:
+      with open(sim_dir + "/tb.v", "w") as file:
+        file.write(testbench)
+      proc = subprocess.run(["iverilog", "-o", "sim.vvp", "tb.v", "miter.v"], cwd=sim_dir, capture_output=True, text=True)
+      if proc.returncode == 0:
+        checks["sim"] = "passed"
+        for seed in range(1, sim_trials + 1):
+          proc = subprocess.run(["vvp", "-n", "sim.vvp", "+seed=" + str(seed)], cwd=sim_dir, capture_output=True, text=True)
+          if "MISMATCH" in proc.stdout:
+            checks["sim"] = "failed"
+            print("Error: Random simulation found a mismatch (seed " + str(seed) + "): " + re.search(r"MISMATCH.*", proc.stdout).group(0))
+            break
+          if "PASSED" not in proc.stdout:
+            # Inconclusive.
+            del checks["sim"]
+            break
+  print("Pre-FEV checks: " + ", ".join(check + " " + result for check, result in checks.items()) + " (" + str(round(time.time() - start, 2)) + "s).")
+  return checks
+
+sim_cycles = 20   # (Matching the depth of FEV.)
+sim_trials = 8
+
+# Return [testbench, reason] for a Verilog testbench driving the "miter" module of the given (Yosys-generated) Verilog with
+# random inputs (see precheck_fev(..)), where testbench is None if the miter cannot be simulated meaningfully, for the
+# given reason. Clocks are the inputs that clock the miter's flip-flops: the first edge of each "@(posedge|negedge ...)"
+# event list (Yosys lists an asynchronous reset or set after the clock). A sequential design clocked other than by its
+# inputs (e.g. by a derived clock) is not simulated, as its flip-flops would never be clocked and simulation would pass
+# vacuously.
+def sim_testbench(miter_verilog):
+  module = re.search(r"^module miter\b.*?^endmodule", miter_verilog, re.MULTILINE | re.DOTALL)
+  if module is None:
+    return [None, "The miter module was not found."]
+  inputs = [[match.group(3), int(match.group(1)) - int(match.group(2)) + 1 if match.group(1) else 1]
+            for match in re.finditer(r"^\s*input\s+(?:\[(\d+):(\d+)\]\s+)?(\S+)\s*;", module.group(0), re.MULTILINE)]
+  if not all(re.match(r"^in_\w+$", name) for name, width in inputs):
+    return [None, "The miter has inputs that cannot be driven: " + ", ".join(name for name, width in inputs if not re.match(r"^in_\w+$", name))]
+  events = set(re.findall(r"@\(\s*(?:posedge|negedge)\s+([^\s),;]+)", module.group(0)))
+  clocks = [name for name, width in inputs if width == 1 and name in events]
+  if events - set(clocks):
+    return [None, "The design is clocked by signals other than its inputs (" + ", ".join(sorted(events - set(clocks))) + "), so its clock could not be identified."]
+  reset = "in_" + os.getenv("RESET_SIGNAL_NAME", "") if os.getenv("RESET_ASSERTION_LEVEL", "") != "" else None
+  reset_level = 0 if os.getenv("RESET_ASSERTION_LEVEL", "") == "low" else 1
+  lines = ["module sim_tb;"]
+  for name, width in inputs:
+    lines.append("  reg " + ("[" + str(width - 1) + ":0] " if width > 1 else "") + name + ";")
+  lines += [
+    "  wire trigger;",
+    "  integer seed, cycle;",
+    "  miter dut(" + ", ".join("." + name + "(" + name + ")" for name, width in inputs + [["trigger", 1]]) + ");",
+    "  task check;",
+    "    if (trigger === 1'b1) begin",
+    "      $display(\"MISMATCH at cycle %0d\", cycle);",
+    "      $finish;",
+    "    end",
+    "  endtask",
+    "  initial begin",
+    "    if (!$value$plusargs(\"seed=%d\", seed)) seed = 1;"
+  ]
+  lines += ["    " + clock + " = 0;" for clock in clocks]
+  lines.append("    for (cycle = 0; cycle < " + str(sim_cycles) + "; cycle = cycle + 1) begin")
+  for name, width in inputs:
+    if name in clocks:
+      continue
+    if name == reset:
+      lines.append("      " + name + " = cycle < 5 ? " + str(reset_level) + " : " + str(1 - reset_level) + ";")
+    else:
+      lines.append("      " + name + " = {" + ", ".join(["$random(seed)"] * ((width + 31) // 32)) + "};")
+  lines += ["      #1 check;"]
+  lines += ["      " + clock + " = 1;" for clock in clocks]
+  lines += ["      #1 check;"]
+  lines += ["      " + clock + " = 0;" for clock in clocks]
+  lines += [
+    "    end",
+    "    $display(\"PASSED\");",
+    "    $finish;",
+    "  end",
+    "endmodule",
+    ""
+  ]
+  return ["\n".join(lines), None]
+
+# Environment variables that are inputs to FEV (scripts and yosys_sat_command(..)), so they are part of fev_cache keys.
+fev_env_vars = ["RESET_SIGNAL_NAME", "RESET_ASSERTION_LEVEL"]
+
+# Return the fev_cache key for FEV of the given files using the given engine ("eqy", "yosys", or "portfolio") and depth.
+def fev_cache_key(orig_file_name, modified_file_name, engine, depth):
+  with open(orig_file_name) as file:
+    orig = normalize_verilog(file.read())
+  with open(modified_file_name) as file:
+    modified = normalize_verilog(file.read())
+  script = ""
+  for script_file in {"eqy": ["fev.eqy"], "yosys": ["fev.tcl"], "portfolio": ["fev.eqy", "fev.sby", "fev.tcl"]}[engine]:
+    with open(repo_dir + "/" + script_file) as file:
+      script += file.read()
+  return DiskCache.key({
+    "orig": hashlib.sha256(orig.encode()).hexdigest(),
+    "modified": hashlib.sha256(modified.encode()).hexdigest(),
+    "module": module_name,
+    "script": hashlib.sha256(script.encode()).hexdigest(),
+    "sat": yosys_sat_command("<VCD>", depth),
+    "env": {name: os.getenv(name, "") for name in fev_env_vars},
+    "engine": engine,
+    "depth": depth
+  })
 
 
 # Run FEV against the given files.
+# work_dir: (opt) A directory in which to create the FEV script and run FEV, logging output to <work_dir>/fev.log.
+#           By default, FEV runs in a fresh scratch workspace (published as tmp/fev; see ScratchDir), and output goes to
+#           stdout. FEV runs can run concurrently.
+# Verdicts are cached in fev_cache, so a proof is not repeated for the same (normalized) files, FEV script, and engine.
+# incremental: For Yosys FEV (not use_eqy), prove only the output cones that changed (see YosysFEVServer.prove_cones(..)).
+# portfolio: Run the portfolio of engines (see run_fev_portfolio(..)), ignoring use_eqy.
 # Return True if FEV passes, False if it fails.
-def run_fev(orig_file_name, working_verilog_file_name, use_eqy = True):
-
-  # Create fev.sby or fev.eqy.
-  fev_file = "fev.eqy" if use_eqy else "fev.sby"
-  # This is done by copying in <repo>/fev.sby and substituting "{MODULE_NAME}", "{ORIGINAL_FILE}", and "{MODIFIED_FILE}" using sed.
-  os.system(f"cp " + repo_dir + "/" + fev_file + " tmp")
-  os.system(f"sed -i 's/<MODULE_NAME>/{module_name}/g' tmp/" + fev_file)
-  # These paths must be absolute.
-  os.system(f"sed -i 's|<ORIGINAL_FILE>|{os.getcwd()}/{orig_file_name}|g' tmp/" + fev_file)
-  os.system(f"sed -i 's|<MODIFIED_FILE>|{os.getcwd()}/{working_verilog_file_name}|g' tmp/" + fev_file)
-  # To run the above manually in bash, as a one-liner from the conversion directory, providing <MODULE_NAME>, <ORIGINAL_FILE>, and <MODIFIED_FILE>:
-  #   cp ../fev.sby fev.sby && sed -i 's/<MODULE_NAME>/<module_name>/g' fev.sby && sed -i "s|<ORIGINAL_FILE>|$PWD/<original_file>|g" fev.sby && sed -i "s|<MODIFIED_FILE>|$PWD/<modified_file>|g" fev.sby
-
+@traced("fev")
+def run_fev(orig_file_name, working_verilog_file_name, use_eqy = True, work_dir = None, incremental = False, portfolio = False):
+  if work_dir is None:
+    with ScratchDir("fev") as scratch:
+      return run_fev_in(orig_file_name, working_verilog_file_name, use_eqy, scratch.dir, None, incremental, portfolio)
+  with open(work_dir + "/fev.log", "w") as log:
+    return run_fev_in(orig_file_name, working_verilog_file_name, use_eqy, work_dir, log, incremental, portfolio)
+
+# Run FEV, as run_fev(..), in the given directory, writing output to the given log file (or stdout if None).
+def run_fev_in(orig_file_name, working_verilog_file_name, use_eqy, fev_dir, log, incremental, portfolio):
+
+  depth = fev_depth(orig_file_name)
+
+  # Use a cached verdict if this proof was done before.
+  cache_key = fev_cache_key(orig_file_name, working_verilog_file_name, "portfolio" if portfolio else "eqy" if use_eqy else "yosys", depth)
+  cached = fev_cache.get(cache_key)
+  if cached is not None:
+    with open(fev_dir + "/fev.cached.log", "w") as file:
+      file.write(cached["log"])
+    print("FEV " + ("passed" if cached["passed"] else "failed") + " previously for these files. (Cached log: " + fev_dir + "/fev.cached.log)")
+    return cached["passed"]
+  if portfolio:
+    passed, log_text, winner = run_fev_portfolio(orig_file_name, working_verilog_file_name, fev_dir, depth)
+    if winner is not None:
+      fev_cache.put(cache_key, {"passed": passed, "log": log_text[-100000:]})
+    return passed
+
+  # (fev.tcl writes tmp/fev.vcd.)
+  os.makedirs(fev_dir + "/tmp", exist_ok=True)
   if use_eqy:
     # Run FEV using EQY.
-    proc = run_eqy()
+    # Render fev.eqy from <repo>/fev.eqy, substituting "<MODULE_NAME>", "<ORIGINAL_FILE>", "<MODIFIED_FILE>", etc.
+    with open(fev_dir + "/fev.eqy", "w") as file:
+      file.write(render_fev_script("fev.eqy", orig_file_name, working_verilog_file_name, depth))
+    proc = run_eqy("fev.eqy", fev_dir, log)
+    log_file = fev_dir + "/fev/logfile.txt"
+  else:
+    log_file = fev_dir + "/yosys.log"
+    proc = None
+    if shutil.which("yosys"):
+      # Use the persistent Yosys process.
+      prove = yosys_fev_server.prove_cones if incremental else yosys_fev_server.prove
+      passed, log_text = prove(module_name, orig_file_name, working_verilog_file_name, fev_dir + "/tmp/fev.vcd", depth)
+      with open(log_file, "w") as file:
+        file.write(log_text)
+      if log is None:
+        print(log_text)
+    else:
+      proc = run_yosys_fev(module_name, orig_file_name, working_verilog_file_name, fev_dir, log, log_file, depth)
+
+  # Cache the verdict if conclusive (not a tool or environment error).
+  log_text = ""
+  if os.path.exists(log_file):
+    with open(log_file, errors="replace") as file:
+      log_text = file.read()
+  if proc is not None:
+    verdict = fev_verdict(proc.returncode, log_text, "eqy" if use_eqy else "yosys")
+    passed = verdict is True
   else:
-    #proc = run_sby()
-    proc = run_yosys_fev(module_name, orig_file_name, working_verilog_file_name)
+    verdict = True if passed else fev_verdict(1, log_text, "yosys")
+  if verdict is not None:
+    fev_cache.put(cache_key, {"passed": passed, "log": log_text[-100000:]})
   
   # Return status.
   # TODO: If failed, bundle failure info for LLM, and call LLM (with approval).
-  return proc.returncode == 0
+  return passed
+
+# Strip temporary comments from the LLM and change New Task comments to Old Task in the given Verilog file.
+# We've found it sometimes convenient to ask the LLM to insert these so it doesn't forget what it has done.
+# The file is replaced (not modified in place, as it may be a link into the object store).
+def strip_temporary_comments(verilog_file):
+  with open(verilog_file) as file:
+    code = file.read()
+  stripped = temporary_comment_line_re.sub("", code)  # Whole line.
+  # Also remove these at the end of a line without deleting the line.
+  stripped = temporary_comment_re.sub("", stripped)
+  # Change "New Task" to "Old Task".
+  stripped = new_task_comment_re.sub("// LLM: Old Task:", stripped)
+  if stripped != code:
+    with open(verilog_file + ".tmp", "w") as file:
+      file.write(stripped)
+    os.replace(verilog_file + ".tmp", verilog_file)
+
+temporary_comment_line_re = re.compile(r"^[ \t]*//[ \t]*LLM:[ \t]*Temporary:.*\n?", re.MULTILINE)
+temporary_comment_re = re.compile(r"[ \t]*//[ \t]*LLM:[ \t]*Temporary:.*", re.MULTILINE)
+new_task_comment_re = re.compile(r"//[ \t]*LLM:[ \t]*New Task:")
 
 # Run FEV against the last successfully FEVed code (if not in this refactoring step, the original code for this step).
 # Checkpoint the code first and FEV vs. this checkpoint.
 # Update status.json.
 # use_eqy: Use EQY instead of SymbiYosys.
 # use_original: Use the original code (history/1/mod_0) instead of the most recently FEVed code.
-def fev_current(use_eqy = True, use_original = False):
+# incremental: Prove only the changed output cones (Yosys only; see run_fev(..)).
+# portfolio: Run a portfolio of FEV engines (see run_fev(..)).
+def fev_current(use_eqy = True, use_original = False, incremental = False, portfolio = False):
   
   checkpoint_if_pending()
 
   checkpointed_verilog_file = mod_path() + "/" + working_verilog_file_name
 
   # This is a good time to strip temporary comments from the LLM and change New Task comments to Old Task.
-  # We've found it sometimes convenient to ask the LLM to insert these so it doesn't forget what it has done.
-  os.system("sed -i '/^\s*\/\/\s*LLM:\s*Temporary:.*/d' " + checkpointed_verilog_file)  # Whole line.
-  # Also remove these at the end of a line without deleting the line.
-  os.system("sed -i 's/^\s*\/\/\s*LLM:\s*Temporary:.*//' " + checkpointed_verilog_file)
-  # Change "New Task" to "Old Task".
-  os.system("sed -i 's/\/\/\s*LLM:\s*New Task:/\/\/ LLM: Old Task:/' " + checkpointed_verilog_file)
+  # (This replaces the checkpointed file, so store the result.)
+  strip_temporary_comments(checkpointed_verilog_file)
+  history_index.set_hash(refactoring_step, mod_num, object_store.store(checkpointed_verilog_file, checkpointed_verilog_file))
 
   status = readStatus()
   # Get the most recently FEVed code (mod with status["fev"] == "passed").
@@ -1548,15 +4292,22 @@ def fev_current(use_eqy = True, use_original = False):
     status["fev"] = "passed"
     ret = True
   else:
+    # Run cheap checks first.
+    checks = precheck_fev(orig_file_name, checkpointed_verilog_file)
+    status.update(checks)
+    if "failed" in checks.values():
+      print("Error: Pre-FEV checks failed. Skipping FEV. Try again.")
+      status["fev"] = "failed"
     # Run FEV.
-    ret = run_fev(orig_file_name, checkpointed_verilog_file, use_eqy)
-
-    if ret:
+    elif run_fev(orig_file_name, checkpointed_verilog_file, use_eqy, incremental=incremental, portfolio=portfolio):
+      ret = True
       print("FEV passed.")
       status["fev"] = "passed"
     else:
       print("Error: FEV failed. Try again.")
       status["fev"] = "failed"
+  if status["fev"] == "failed":
+    forget_llm_response(status)
   writeStatus(status)
   # Update current/feved.v to link to newly-FEVed code.
   if status["fev"] == "passed":
@@ -1565,6 +4316,13 @@ def fev_current(use_eqy = True, use_original = False):
   return ret
 
 
+# Remove the cached LLM response(s) that produced a modification with the given status (if by the LLM), so a retry of the
+# same request (e.g. by --auto after FEV fails) gets a fresh response, rather than the same failing one.
+def forget_llm_response(status):
+  for cache_key in status.get("llm_cache_keys", []):
+    llm_cache.delete(cache_key)
+
+
 #
 # Diff
 #
@@ -1610,7 +4368,11 @@ def print_prompt():
   print("  ")
   print("  Enter one of the following commands:")
   print("    l/L/M: LLM. Send the current prompt to the LLM (o1-mini/gpt-4o/[M]odel-of-choice).")
+  print("    S: Speculative LLM. Send the current prompt as multiple concurrent requests and checkpoint a candidate that passes FEV.")
+  print("    K: Chunked LLM. Refactor a large module in chunks, with concurrent requests, and stitch the results.")
   print("    e/f/E: Run FEV (EQY/Yosys) on the current code (or [E]QY vs. original).")
+  print("    i: Incremental FEV. Run Yosys FEV, proving only the output logic cones that changed.")
+  print("    P: Portfolio FEV. Run all installed FEV engines/solvers concurrently and take the first conclusive result.")
   print("    y: Yes. Accept the current code as the completion of this refactoring step (if FEV already run and passed).")
   print("    u: Undo. Revert to a previous version of the code.")
   print("    U: Redo. Reapply a reverted code change (possible until next modification or exit).")
@@ -1648,6 +4410,8 @@ def reset_prompt(type, prev_prompt_id):
 
   # Delete the history directory.
   shutil.rmtree("history/" + str(refactoring_step))
+  history_index.drop_step(refactoring_step)
+  object_store.gc()
   # Decrement the refactoring step number.
   refactoring_step -= 1
   set_mod_num()
@@ -1669,6 +4433,139 @@ def reset_prompt(type, prev_prompt_id):
     writeStatus(status)
 
 
+# Return grep output reporting comments in the working Verilog file that must be addressed before a refactoring step
+# can be accepted (or "" if there are none).
+def unaddressed_comments():
+  grep_output = ""
+  for pattern in [r"LLM: (New|Old) Task:", r"//\s*User:"]:
+    grep_output += subprocess.run(["grep", "-E", pattern, working_verilog_file_name], capture_output=True, text=True).stdout
+  return grep_output
+
+# Accept the current modification as the completion of this refactoring step and begin the next.
+# Return False if there are no more refactoring steps.
+@traced("step.accept")
+def accept_refactoring_step():
+  # Capture working files in history/#/.
+  status = readStatus()
+  status["accepted"] = True
+  writeStatus(status)
+  # Next refactoring step.
+  return init_refactoring_step()
+
+
+#
+# Auto and Batch Modes
+#
+
+# Drive the conversion in the current directory without user interaction (--auto). For each refactoring step, run the
+# LLM and FEV, and accept the step once FEV passes and the LLM reports that the step is complete. After a failed
+# attempt, the code is reverted to the most recently FEVed modification and the LLM is run again.
+# This picks up from the current state of history/, so an interrupted job resumes where it stopped.
+# If candidates > 1, each LLM run is speculative (see run_speculative(..)).
+# Return the exit status: 0 if all refactoring steps are complete, 2 if a step could not be completed automatically.
+def run_auto(model, max_attempts, candidates=1):
+  api = models[model]["api"]
+  failures = 0   # Failed attempts in this refactoring step.
+  runs = 0       # LLM runs in this refactoring step.
+  while True:
+    status = readStatus()
+    if status.get("accepted"):
+      # Resuming after the final refactoring step was accepted.
+      if not init_refactoring_step():
+        return 0
+      failures = runs = 0
+      continue
+
+    # Accept the refactoring step if complete.
+    if status.get("fev") == "passed" and not status.get("incomplete", True) and not changes_pending():
+      if unaddressed_comments() == "":
+        print("\nAccepting refactoring step " + str(refactoring_step) + " (" + prompts[prompt_id]["desc"] + ").")
+        if not accept_refactoring_step():
+          return 0
+        failures = runs = 0
+        continue
+
+    if failures >= max_attempts or runs >= 3 * max_attempts:
+      print("\nError: Refactoring step " + str(refactoring_step) + " (" + prompts[prompt_id]["desc"] + ") could not be completed automatically.")
+      return 2
+
+    # Discard failed code before trying again.
+    if status.get("fev") == "failed":
+      prev_mod = most_recently_feved_mod()
+      print("Reverting to mod_" + str(prev_mod) + " to try again.")
+      revert_to(prev_mod)
+
+    # Run the LLM, then FEV its changes.
+    runs += 1
+    if candidates > 1:
+      if not run_speculative([model], candidates):
+        failures += 1
+      continue
+    prev_mod_num = mod_num
+    messages, verilog = load_llm_request(api)
+    run_llm(messages, verilog, model)
+    if mod_num == prev_mod_num:
+      # Response was rejected.
+      failures += 1
+    elif readStatus().get("fev") is None:
+      if not fev_current(True, portfolio=fev_portfolio):
+        failures += 1
+
+# Return the command line of an --auto worker of a --batch run, passing on the options of this run that apply to it.
+def batch_worker_command(model, max_attempts, candidates):
+  cmd = [sys.executable, os.path.realpath(__file__), "--auto", "--model", model, "--max-attempts", str(max_attempts), "--candidates", str(candidates)]
+  if fev_portfolio:
+    cmd.append("--fev-portfolio")
+  if args.predict:
+    cmd.append("--predict")
+  if args.edits:
+    cmd.append("--edits")
+  if args.no_stream:
+    cmd.append("--no-stream")
+  if args.no_trace:
+    cmd.append("--no-trace")
+  return cmd
+
+# Run --auto conversions for the module directories listed in the given manifest file, using a pool of the given number of
+# worker processes. The manifest lists one directory per line (relative to the manifest), ignoring blank lines and "#" comments.
+# Each job's output is logged to <dir>/auto.log, and results are recorded in <manifest>.status.json. Directories that
+# completed in a prior batch run are skipped, and others resume from their history.
+# Return the exit status: 0 if all modules completed, 2 otherwise.
+def run_batch(manifest, jobs, model, max_attempts, candidates=1):
+  manifest_dir = os.path.dirname(os.path.abspath(manifest))
+  with open(manifest) as file:
+    dirs = [line.strip() for line in file if line.strip() and not line.strip().startswith("#")]
+  status_file = manifest + ".status.json"
+  results = {}
+  if os.path.exists(status_file):
+    with open(status_file) as file:
+      results = json.load(file)
+
+  # Run one job, returning [dir, result].
+  def run_job(dir):
+    cmd = batch_worker_command(model, max_attempts, candidates)
+    start = time.time()
+    with open(os.path.join(manifest_dir, dir, "auto.log"), "a") as log:
+      proc = subprocess.run(cmd, cwd=os.path.join(manifest_dir, dir), stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+    result = {0: "done", 2: "stuck"}.get(proc.returncode, "error")
+    return [dir, {"result": result, "returncode": proc.returncode, "seconds": round(time.time() - start, 1)}]
+
+  todo = [dir for dir in dirs if results.get(dir, {}).get("result") != "done"]
+  print("Converting " + str(len(todo)) + " of " + str(len(dirs)) + " modules using " + str(jobs) + " workers.")
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+    for future in concurrent.futures.as_completed([pool.submit(run_job, dir) for dir in todo]):
+      dir, result = future.result()
+      results[dir] = result
+      print(result["result"] + ": " + dir + " (" + str(result["seconds"]) + "s)")
+      # Record results as we go, so they survive an interrupted batch.
+      with open(status_file, "w") as file:
+        json.dump(results, file, indent=2)
+
+  done = sum(1 for dir in dirs if results.get(dir, {}).get("result") == "done")
+  print(str(done) + " of " + str(len(dirs)) + " modules completed. See " + status_file + " and <dir>/auto.log.")
+  return 0 if done == len(dirs) else 2
+
+
 
 
 
@@ -1692,35 +4589,57 @@ apis = {
       { "system_role": "system",
         "format": "json",
         "structured": False,
+        "edits": False,
         "max_output_tokens": 4096,
       },
   "gpt4":
       { "system_role": "system",
         "format": "json",
         "structured": False,
+        "edits": False,
         "max_output_tokens": 4096,
       },
   "o-simple":
       { "system_role": "user",
         "format": "md",
         "structured": False,
+        "edits": False,
       },
   "o":
       { "system_role": "developer",
         "format": "json",
         "structured": True,
+        "edits": False,
+      },
+  # As "o", but responses provide edits rather than the full Verilog (see EditScript), reducing output tokens.
+  # Models using "o" use this API with --edits.
+  "o-edits":
+      { "system_role": "developer",
+        "format": "json",
+        "structured": True,
+        "edits": True,
       },
 }
+# Models may also provide (or override) properties of their API (see model_property(..)), and provide:
+#   context_window: The maximum number of tokens (input plus output) of a request.
+#   prediction: True if the model supports Predicted Outputs (see --predict).
+#   reasoning: True if the model spends (hidden) reasoning tokens, which count toward the completion token limit.
 models = {
-  "gpt-3.5-turbo": {"api": "gpt3"},
-  "gpt-4-turbo": {"api": "gpt4"},
-  "o1-mini": {"api": "o-simple"},
-  "o1-preview": {"api": "o-simple"},
-  "o1": {"api": "o"},
-  "o3-mini": {"api": "o"},
-  "gpt-4o": {"api": "o"},
-  "gpt-4o-mini": {"api": "o"},
+  "gpt-3.5-turbo": {"api": "gpt3", "context_window": 16385},
+  "gpt-4-turbo": {"api": "gpt4", "context_window": 128000},
+  "o1-mini": {"api": "o-simple", "context_window": 128000, "max_output_tokens": 65536, "reasoning": True},
+  "o1-preview": {"api": "o-simple", "context_window": 128000, "max_output_tokens": 32768, "reasoning": True},
+  "o1": {"api": "o", "context_window": 200000, "max_output_tokens": 100000, "reasoning": True},
+  "o3-mini": {"api": "o", "context_window": 200000, "max_output_tokens": 100000, "reasoning": True},
+  "gpt-4o": {"api": "o", "context_window": 128000, "max_output_tokens": 16384, "prediction": True},
+  "gpt-4o-mini": {"api": "o", "context_window": 128000, "max_output_tokens": 16384, "prediction": True},
 }
+# Default requests-per-minute and tokens-per-minute budgets for each model (used by AsyncOpenAI_API). These should
+# reflect your organization's rate limits, and can be given per model as "rpm" and "tpm" fields of models[model].
+default_rpm = 500
+default_tpm = 200000
+# The list of models available from the API is cached (in models_cache) for this many seconds.
+models_list_ttl = 60 * 60 * 24
 
 
 # The JSON schema for the LLM API, which is passed, e.g.:
@@ -1741,37 +4660,105 @@ json_schema = {
     "additionalProperties": False
   }
 }
+# The JSON schema for APIs with the "edits" property, where "verilog" is replaced by "edits" (see EditScript).
+edits_json_schema = copy.deepcopy(json_schema)
+edits_json_schema["name"] = "verilog_refactoring_edits"
+del edits_json_schema["schema"]["properties"]["verilog"]
+edits_json_schema["schema"]["properties"] = dict({
+  "edits": {
+    "type": "array",
+    "description": "Edits to apply, in order, to the given Verilog code.",
+    "items": {
+      "type": "object",
+      "properties": {
+        "kind": {"type": "string", "enum": ["replace", "regex"], "description": "\"replace\" to replace exact text, or \"regex\" to substitute for regular expression matches."},
+        "find": {"type": "string", "description": "The complete line(s) to replace (occurring once), or the regular expression."},
+        "replace": {"type": "string", "description": "The replacement text."},
+        "within": {"type": "string", "description": "Line(s) (occurring once) to which the edit is confined, or \"\" for the entire code."},
+      },
+      "required": ["kind", "find", "replace", "within"],
+      "additionalProperties": False
+    }
+  }
+}, **edits_json_schema["schema"]["properties"])
+edits_json_schema["schema"]["required"][0] = "edits"
 
 
 # Response fields.
 response_fields = {"overview", "verilog", "notes", "issues", "incomplete", "plan", "extra_fields"}    # ("incomplete" is sticky between LLM runs, so it has special treatment.)
-status_fields = {"by", "api", "compile", "fev", "modified", "incomplete", "accepted", "plan"}  # Status fields that are not sticky.
+status_fields = {"by", "api", "compile", "sim", "fev", "modified", "incomplete", "accepted", "plan", "candidates", "tokens", "llm_cache_keys"}  # Status fields that are not sticky.
 llm_status_fields = {"incomplete", "plan"}   # These are empty for a refactoring step and updated by LLM runs.
 # (Fields not listed above are sticky.)
 
 # TODO: We've overloaded the term "API". Change to "API Vendor"?
 # TODO: This should be dynamic, so we should look it up based on the chosen API.
-llm_api = OpenAI_API()
+llm_api = AsyncOpenAI_API()
 
 # TODO: It looks like all models support JSON output, and we can eliminate support for "md" responses.
 message_bundler = {
   "json": JsonMessageBundler(),
   "md": PseudoMarkdownMessageBundler(),
+  "edits": EditScriptMessageBundler(),
 }
 def get_message_bundler_for_model(model):
-  return message_bundler[apis[models[model]["api"]]["format"]]
+  return get_message_bundler_for_api(models[model]["api"])
 def get_message_bundler_for_api(api):
-  return message_bundler[apis[api]["format"]]
+  return message_bundler["edits" if apis[api].get("edits") else apis[api]["format"]]
 
 # Get the directory of this script.
 repo_dir = os.path.dirname(os.path.realpath(__file__))
 
+# The directory for caches shared by all conversion directories (overridden by the CONVERT_CACHE_DIR env var).
+cache_dir = os.getenv("CONVERT_CACHE_DIR", os.path.expanduser("~/.cache/conversion-to-TLV"))
+
+# Cache of the lists of models available from the API, keyed on the account (see OpenAI_API.available_models()).
+models_cache = DiskCache("models", max_bytes=1 << 20, max_age=60 * 60 * 24 * 30)
+# Cache of M5 renderings, keyed on the text and the M5 variables it references.
+m5_cache = DiskCache("m5", max_bytes=1 << 26, max_age=60 * 60 * 24 * 90)
+# Cache of LLM responses, keyed on the full request.
+llm_cache = DiskCache("llm", max_bytes=1 << 30, max_age=60 * 60 * 24 * 90)
+# Cache of FEV verdicts and logs, keyed on the normalized Verilog files, FEV script, and engine.
+fev_cache = DiskCache("fev", max_bytes=1 << 28, max_age=60 * 60 * 24 * 365)
+
+# The Yosys process used for Yosys FEV (started on first use).
+yosys_fev_server = YosysFEVServer()
+atexit.register(yosys_fev_server.stop)
+
+# Span tracing of the flow, recorded in history/#/mod_#/trace.json.
+tracer = Tracer()
+
 
 ###########################
 # Parse command-line args #
 ###########################
 
-# (None)
+arg_parser = argparse.ArgumentParser(description="Refactor a Verilog module and convert it to TL-Verilog using an LLM, with formal verification of each step.")
+arg_parser.add_argument("--auto", action="store_true", help="Run without user interaction, accepting each refactoring step when FEV passes and the LLM reports completion.")
+arg_parser.add_argument("--batch", metavar="MANIFEST", help="Run --auto conversions for the module directories listed in MANIFEST.")
+arg_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of modules to convert in parallel (with --batch).")
+arg_parser.add_argument("--model", default="gpt-4o", choices=list(models), help="The LLM model to use (with --auto/--batch).")
+arg_parser.add_argument("--max-attempts", type=int, default=3, help="Failed LLM attempts per refactoring step before giving up (with --auto/--batch).")
+arg_parser.add_argument("--candidates", type=int, default=1, help="Concurrent LLM candidates per attempt, checkpointing the first to pass FEV (with --auto/--batch).")
+arg_parser.add_argument("--predict", action="store_true", help="Pass the current Verilog to the LLM as a predicted output (for models that support it), to reduce latency.")
+arg_parser.add_argument("--edits", action="store_true", help="Have the LLM respond with a list of edits, rather than the full Verilog (for models using the \"o\" API).")
+arg_parser.add_argument("--no-stream", action="store_true", help="Wait for complete LLM responses, rather than streaming them.")
+arg_parser.add_argument("--fev-portfolio", action="store_true", help="Run FEV using a portfolio of concurrent engines (with --auto/--batch).")
+arg_parser.add_argument("--no-trace", action="store_true", help="Do not record span traces (history/#/mod_#/trace.json).")
+arg_parser.add_argument("--trace-summary", nargs="*", metavar="DIR", help="Summarize the span traces under the given directories (default: the current directory), and exit.")
+args = arg_parser.parse_args()
+auto_mode = args.auto
+fev_portfolio = args.fev_portfolio
+llm_api.stream = not args.no_stream
+llm_api.predict = args.predict
+if args.edits:
+  for model in models:
+    if models[model]["api"] == "o":
+      models[model]["api"] = "o-edits"
+tracer.enabled = not args.no_trace
+
+if args.trace_summary is not None:
+  Tracer.summarize(args.trace_summary or ["."])
+  sys.exit(0)
 
 
 ##################
@@ -1787,21 +4774,12 @@ if not os.path.exists(repo_dir + "/fev.sby") or not os.path.exists(repo_dir + "/
   print("Error: Conversion repository does not contain fev.sby or fev.eqy.")
   usage()
 
-# Read prompts.json.
-# prompts.json is a slight extension to JSON supporting newlines in strings. Any newlines within quotes are replaced with '\n'.
-with open(repo_dir + "/prompts.json") as file:
-  raw_contents = file.read()
-json_str = from_extended_json(raw_contents)
-prompts = json.loads(json_str)
-# Add an index field to prompts. Also provide a dictionary of prompts indexed by desc.
-prompts_by_desc = {}
-for id, prompt in enumerate(prompts):
-  prompt["index"] = id
-  desc = prompt["desc"]
-  if desc in prompts_by_desc:
-    print("Error: Duplicate prompt description: " + desc)
-    fail()
-  prompts_by_desc[desc] = prompt
+# Batch mode runs other processes in the module directories, so there's nothing more to do here.
+if args.batch:
+  sys.exit(run_batch(args.batch, args.jobs, args.model, args.max_attempts, args.candidates))
+
+# Read prompts.json (or its compiled recipe).
+prompts, prompts_by_desc, prompt_conditions = load_prompts(repo_dir + "/prompts.json")
 
 
 #
@@ -1853,10 +4831,17 @@ if not os.access(working_verilog_file_name, os.W_OK):
 # Determine which refactoring step we are on
 #
 
+# Index of history/.
+history_index = HistoryIndex("history")
+# Store of files checkpointed in history/.
+object_store = ObjectStore("history/objects")
+
 # Current state variables.
 refactoring_step = 0  # The current refactoring step (history/<refactoring_step>).
 mod_num = 0  # The current mod number (history/#/mod_<mod_num>).
 prompt_id = 0  # The current prompt ID (prompt_id.txt).
+# Record any remaining spans on exit.
+atexit.register(lambda: tracer.flush(mod_path()))
 
 if not os.path.exists("history"):
   # Initialize the conversion job.
@@ -1872,7 +4857,8 @@ else:
   # Determine the current state of the conversion process.
   # Find the current refactoring step.
   for step in os.listdir("history"):
-    refactoring_step = max(refactoring_step, int(step))
+    if step.isdigit():
+      refactoring_step = max(refactoring_step, int(step))
   # Find the current modification number.
   set_mod_num()
 
@@ -1906,6 +4892,9 @@ else:
 #             #
 ###############
 
+if auto_mode:
+  sys.exit(run_auto(args.model, args.max_attempts, args.candidates))
+
 # Perform the next refactoring step until the user exits.
 while True:
 
@@ -1923,7 +4912,7 @@ while True:
   while True:
     # Get the user's command as a single key press (without <Enter>) using pynput library.
     # TODO: Replay get_command(..) in favor of prompt_user(..).
-    key = get_command(["l", "L", "M", "e", "f", "E", "y", "u", "U", "c", "p", "h", "?", "x"])
+    key = get_command(["l", "L", "M", "S", "K", "e", "f", "E", "i", "P", "y", "u", "U", "c", "p", "h", "?", "x"])
 
     # Process the user's command.
     if key == "l" or key == "L" or key == "M":
@@ -1936,12 +4925,12 @@ while True:
       elif key == "M":
         # Print a list of models by number, and let the user choose one.
         print("Choose a model:")
-        for i in range(len(llm_api.models.data)):
-          if hasattr(llm_api.models.data[i], 'id'):
-            # Use letters for the models (a-zA-Z), so we can represent them in a single character.
-            ch = chr(ord('a') + i) if i < 26 else chr(ord('A') + i - 26)
-            supported_char = "*" if models.get(llm_api.models.data[i].id) != None else " "
-            print(f" {supported_char}{ch}: {llm_api.models.data[i].id}")
+        model_ids = list(llm_api.available_models())
+        for i in range(len(model_ids)):
+          # Use letters for the models (a-zA-Z), so we can represent them in a single character.
+          ch = chr(ord('a') + i) if i < 26 else chr(ord('A') + i - 26)
+          supported_char = "*" if models.get(model_ids[i]) != None else " "
+          print(f" {supported_char}{ch}: {model_ids[i]}")
         while True:
           model_char = prompt_user("Enter the model letter.")
           o = ord(model_char)
@@ -1950,10 +4939,10 @@ while True:
             model_num = o - ord('a')
           elif o >= ord('A') and o <= ord('Z'):
             model_num = o - ord('A') + 26
-          if model_num < 0 or model_num >= len(llm_api.models.data) or not hasattr(llm_api.models.data[i], 'id'):
+          if model_num < 0 or model_num >= len(model_ids):
             print("\nInvalid model ID. Choose again.")
           else:
-            model = llm_api.models.data[model_num].id
+            model = model_ids[model_num]
             if models.get(model) == None:
               print("\nError: Unsupported model.")
               print("\nChoose a different one.")
@@ -1979,28 +4968,36 @@ while True:
           print("Aborted. Choose a different command.")
           do_it = False
       if do_it:
-        with open(messages_json) as message_file:
-          with open(working_verilog_file_name) as verilog_file:
-            verilog = verilog_file.read()
-            # Strip leading and trailing whitespace, then add trailing newline.
-            verilog = verilog.strip() + "\n"
-            msg_file_str = message_file.read()
-            msg_json = from_extended_json(msg_file_str)
-            ## Dump the JSON to a file for debugging.
-            #with open("tmp/messages_debug.json", "w") as file:
-            #  file.write(msg_json)
-            messages = json.loads(msg_json)
-            # Add "plan" field if given.
-            status = readStatus()
-            if "plan" in status:
-              messages[-1]["content"] += ("\n\nAnother agent has already made some progress and has established this plan:\n\n" + status["plan"])
-            run_llm(messages, verilog, model)
+        messages, verilog = load_llm_request(api)
+        run_llm(messages, verilog, model)
+    elif key == "S":
+      # Speculatively run multiple LLM candidates concurrently and checkpoint one that passes FEV.
+      if llm_finished():
+        ch = prompt_user("LLM was already run and reported that the refactoring was complete. Run anyway?", {"y", "n"}, "n")
+        if ch != "y":
+          print("Aborted. Choose a different command.")
+          continue
+      ch = prompt_user("Sample which model(s): [l] o1-mini, [L] gpt-4o, or [b]oth?", ["l", "L", "b"], "L")
+      model_list = {"l": ["o1-mini"], "L": ["gpt-4o"], "b": ["o1-mini", "gpt-4o"]}[ch]
+      num_candidates = int(prompt_user("How many candidates?", [str(n) for n in range(2, 10)], "4"))
+      ch = prompt_user("Checkpoint the [f]irst candidate to pass FEV or the passing candidate with the [s]mallest diff?", ["f", "s"], "f")
+      run_speculative(model_list, num_candidates, "first" if ch == "f" else "smallest")
+    elif key == "K":
+      # Run the LLM on the module in chunks (for large modules).
+      ch = prompt_user("Use which model: [l] o1-mini or [L] gpt-4o?", ["l", "L"], "L")
+      model = {"l": "o1-mini", "L": "gpt-4o"}[ch]
+      messages, verilog = load_llm_request(models[model]["api"])
+      run_llm(messages, verilog, model, chunked=True)
     elif key == "e":
       fev_current(True)
     elif key == "f":
       fev_current(False)
     elif key == "E":
       fev_current(True, True)
+    elif key == "i":
+      fev_current(False, incremental=True)
+    elif key == "P":
+      fev_current(portfolio=True)
     elif key == "y":
       status = readStatus()
       # Can only accept changes that have been FEVed.
@@ -2009,9 +5006,7 @@ while True:
       do_it = False
       last_mod = most_recent_mod()
       # Scan the file for comments that should have been removed.
-      # Capture grep output to report problematic lines.
-      grep_output = os.popen("grep -E 'LLM: (New|Old) Task:' " + working_verilog_file_name).read()
-      grep_output += os.popen("grep -E '//\s*User:' " + working_verilog_file_name).read()
+      grep_output = unaddressed_comments()
       if diff(working_verilog_file_name, mod_path() + "/" + working_verilog_file_name):
         print("Code edits are pending. You must run FEV (or revert) before accepting the refactoring changes.")
       elif status.get("fev") != "passed":
@@ -2040,11 +5035,8 @@ while True:
       
       if do_it:
         # Accept the modification.
-        # Capture working files in history/#/.
-        status["accepted"] = True
-        writeStatus(status)
-        # Next refactoring step.
-        init_refactoring_step()
+        if not accept_refactoring_step():
+          exit(0)
         break
 
     elif key == "p":
@@ -2131,32 +5123,22 @@ while True:
         # Revert to a previous version of the code.
         print("Reverting to the previous version of the code.")
         show_diff(mod, prev_mod)
-        # Copy the checkpointed verilog, messages.<api>.json (if it exists), and llm_response.txt (if it exists).
-        os.system("cp " + mod_path(prev_mod) + "/" + working_verilog_file_name + " " + working_verilog_file_name)
-        if os.path.exists(mod_path(prev_mod) + "/" + messages_json):
-          os.system("cp " + mod_path(prev_mod) + "/" + messages_json + " " + messages_json)
-        if os.path.exists(mod_path(prev_mod) + "/llm_response.txt"):
-          os.system("cp " + mod_path(prev_mod) + "/llm_response.txt llm_response.txt")
-
-        # Create a reversion checkpoint as a symlink, either as a new checkpoint or by updating the existing symlink.
-        checkpoint_reversion(prev_mod)
+        revert_to(prev_mod)
 
     elif key == "U":
       # Redo a reverted code change.
-      if changes_pending() or not os.path.islink(mod_path()):
+      if changes_pending() or not history_index.is_reversion(refactoring_step, mod_num):
         print("Error: Changes have been made since the last reversion. Cannot redo.")
         continue
       # Get most recent change.
       mod = actual_mod()
       # Find all symlinks to this change for which the next sequential modification is a non-link directory. Each is a candidate for redoing.
       candidates = []
-      for mod_dir in os.listdir("history/" + str(refactoring_step)):
-        if os.path.islink("history/" + str(refactoring_step) + "/" + mod_dir) and os.readlink("history/" + str(refactoring_step) + "/" + mod_dir) == "mod_" + str(mod):
-          # This is a symlink to the current mod.
-          # Check if the next mod is a symlink.
-          m = int(mod_dir.split("_")[1])
-          if not os.path.islink("history/" + str(refactoring_step) + "/mod_" + str(m + 1)) and os.path.isdir("history/" + str(refactoring_step) + "/mod_" + str(m + 1)):
-            candidates.append(m)
+      for m in history_index.reversions_to(refactoring_step, mod):
+        # This is a symlink to the current mod.
+        # Check if the next mod is a symlink.
+        if m + 1 <= mod_num and not history_index.is_reversion(refactoring_step, m + 1):
+          candidates.append(m)
       
       # List all candidates.
       if len(candidates) == 0:
@@ -28,6 +28,17 @@ if { [info exists ::env(RESET_ASSERTION_LEVEL)]} {
     set reset_assertion_level $::env(RESET_ASSERTION_LEVEL)
 }
 
+# FEV_DEPTH: The number of cycles to check (including reset).
+set depth 20
+if { [info exists ::env(FEV_DEPTH)]} {
+    set depth $::env(FEV_DEPTH)
+}
+# FEV_RESET_CYCLES: The number of cycles of reset.
+set reset_duration 5
+if { [info exists ::env(FEV_RESET_CYCLES)]} {
+    set reset_duration $::env(FEV_RESET_CYCLES)
+}
+
 yosys read_verilog -sv $orig_file
 yosys hierarchy -top $top
 yosys proc
@@ -47,9 +58,7 @@ yosys miter -equiv -make_assert -flatten orig modified miter
 # Must init states to 0 because initialization will be inconsistent between orig and modified otherwise and will mismatch during reset.
 # (It would be better to disable checks during reset, but not sure how.)
 # Force reset input if there is one, based on RESET_ASSERTION_LEVEL. It would be better for testbench to do this based on $initstate.
-set reset_duration 5
-set operational_duration 15
-set seq_value [expr $reset_duration + $operational_duration - 1]
+set seq_value [expr {$depth > 1 ? $depth - 1 : 1}]
 set reset_level [expr {$reset_assertion_level == "low" ? 0 : 1}]
 set operational_level [expr {$reset_assertion_level == "low" ? 1 : 0}]
 set reset_cmds ""
@@ -61,6 +70,6 @@ if {$reset_assertion_level ne ""} {
         append reset_cmds " -set-at $i in_$reset_signal_name $operational_level"
     }
 }
-set sat_cmd "sat -show-all -seq 19 -prove-asserts -enable_undef -set-init-zero $reset_cmds -dump_vcd tmp/fev.vcd miter"
+set sat_cmd "sat -show-all -seq $seq_value -prove-asserts -enable_undef -set-init-zero $reset_cmds -dump_vcd tmp/fev.vcd miter"
 puts $sat_cmd
 yosys $sat_cmd
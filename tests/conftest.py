@@ -0,0 +1,78 @@
+# convert.py is an interactive script, so tests load its definitions (everything up to command-line parsing) as a module,
+# with caches redirected to a temporary directory.
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+convert_py = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "convert.py")
+
+
+@pytest.fixture(scope="session")
+def convert(tmp_path_factory):
+  os.environ["CONVERT_CACHE_DIR"] = str(tmp_path_factory.mktemp("cache"))
+  with open(convert_py) as file:
+    src = file.read()
+  src = src[:src.index("###########################\n# Parse command-line args #")]
+  module = types.ModuleType("convert")
+  module.__file__ = convert_py
+  exec(compile(src, convert_py, "exec"), module.__dict__)
+  return module
+
+
+# A stand-in for the openai package (which need not be installed), providing the exception classes handled by
+# AsyncOpenAI_API.
+@pytest.fixture
+def fake_openai(monkeypatch):
+  openai = types.ModuleType("openai")
+
+  class APIError(Exception):
+    def __init__(self, message="", response=None):
+      super().__init__(message)
+      self.response = response
+  openai.APIError = APIError
+  for name in ["RateLimitError", "APIConnectionError", "InternalServerError", "BadRequestError"]:
+    setattr(openai, name, type(name, (APIError,), {}))
+  monkeypatch.setitem(sys.modules, "openai", openai)
+  return openai
+
+
+# A fake asyncio chat completions client. Each call of chat.completions.create(..) records its parameters, and takes the
+# next of the given outcomes: an exception (raised), a number (seconds to hang), or a response (returned).
+class FakeClient:
+  def __init__(self, outcomes):
+    self.outcomes = list(outcomes)
+    self.calls = []
+    self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+  async def create(self, **params):
+    self.calls.append(params)
+    outcome = self.outcomes.pop(0)
+    if isinstance(outcome, Exception):
+      raise outcome
+    if isinstance(outcome, (int, float)):
+      await asyncio.sleep(outcome)
+      return None
+    return outcome
+
+
+# An API response with the given content and usage.
+def fake_response(content="{}", total_tokens=100):
+  usage = types.SimpleNamespace(prompt_tokens=total_tokens // 2, completion_tokens=total_tokens - total_tokens // 2, total_tokens=total_tokens,
+                                prompt_tokens_details=None, completion_tokens_details=None)
+  message = types.SimpleNamespace(content=content, refusal=None)
+  return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message, finish_reason="stop")], usage=usage)
+
+
+# An AsyncOpenAI_API using the given FakeClient, without streaming or delays between retries. (Call from within the event
+# loop, as the semaphore is bound to it.)
+def fake_async_api(convert, client):
+  api = convert.AsyncOpenAI_API()
+  api.stream = False
+  api.backoff_base = 0
+  api.async_client = client
+  api.loop = asyncio.get_running_loop()
+  api.semaphore = asyncio.Semaphore(api.max_concurrency)
+  return api
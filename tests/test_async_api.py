@@ -0,0 +1,131 @@
+import asyncio
+import types
+
+from conftest import FakeClient, fake_async_api, fake_response
+
+messages = [{"role": "user", "content": "Refactor."}]
+
+
+# Run a coroutine that must complete without suspending (as RateBudget.acquire(..) with a fake clock and sleep).
+def run_now(coro):
+  try:
+    coro.send(None)
+  except StopIteration as e:
+    return e.value
+  raise AssertionError("The coroutine suspended.")
+
+
+def test_rate_budget_waits(convert, monkeypatch):
+  clock = [1000.0]
+  sleeps = []
+
+  async def sleep(seconds):
+    sleeps.append(seconds)
+    clock[0] += seconds
+  monkeypatch.setattr(convert.time, "monotonic", lambda: clock[0])
+  monkeypatch.setattr(convert.asyncio, "sleep", sleep)
+
+  # Requests per minute.
+  budget = convert.RateBudget(2, 1000)
+  run_now(budget.acquire(100))
+  clock[0] += 10
+  run_now(budget.acquire(100))
+  run_now(budget.acquire(100))
+  assert sleeps == [50.0]
+  assert len(budget.window) == 2
+
+  # Tokens per minute, corrected by actual usage.
+  sleeps.clear()
+  budget = convert.RateBudget(100, 1000)
+  reservation = run_now(budget.acquire(800))
+  budget.adjust(reservation, 100)
+  run_now(budget.acquire(800))
+  assert sleeps == []
+  run_now(budget.acquire(800))
+  assert sleeps == [60.0]
+
+  # An oversized request does not wait forever.
+  sleeps.clear()
+  budget = convert.RateBudget(100, 1000)
+  run_now(budget.acquire(5000))
+  assert sleeps == [] and len(budget.window) == 1
+
+
+def test_retries(convert, fake_openai, capsys):
+  rate_limited = fake_openai.RateLimitError("Too many requests", response=types.SimpleNamespace(headers={"retry-after": "0.01"}))
+  response = fake_response()
+  client = FakeClient([rate_limited, 5, response])
+
+  async def run():
+    api = fake_async_api(convert, client)
+    api.timeout = 0.05
+    return await api.create_with_retries({"model": "gpt-4o", "messages": messages})
+  assert asyncio.run(run()) is response
+  assert len(client.calls) == 3
+  out = capsys.readouterr().out
+  assert "Warning: gpt-4o request failed (Too many requests). Retrying in 0.0s." in out
+  assert "Warning: gpt-4o request failed (TimeoutError). Retrying" in out
+
+
+def test_retries_exhausted(convert, fake_openai, capsys):
+  client = FakeClient([fake_openai.APIConnectionError("Connection reset"), fake_openai.InternalServerError("Overloaded"), fake_response()])
+
+  async def run():
+    api = fake_async_api(convert, client)
+    api.max_retries = 1
+    return await api.create_with_retries({"model": "gpt-4o", "messages": messages})
+  assert asyncio.run(run()) is None
+  assert len(client.calls) == 2
+  assert "Error: gpt-4o request failed after 2 attempts: Overloaded" in capsys.readouterr().out
+
+
+def test_other_errors_are_not_retried(convert, fake_openai):
+  client = FakeClient([fake_openai.APIError("Unauthorized"), fake_response()])
+
+  async def run():
+    return await fake_async_api(convert, client).create_with_retries({"model": "gpt-4o", "messages": messages})
+  assert asyncio.run(run()) is None
+  assert len(client.calls) == 1
+
+
+def test_throttled_model_does_not_block_others(convert, fake_openai):
+  response = fake_response()
+  client = FakeClient([response])
+
+  async def run():
+    api = fake_async_api(convert, client)
+    api.semaphore = asyncio.Semaphore(1)
+    # o1's budget is spent for the next minute.
+    api.budgets["o1"] = convert.RateBudget(1, 1000000)
+    await api.budgets["o1"].acquire(0)
+    throttled = asyncio.create_task(api.create_with_retries({"model": "o1", "messages": messages}))
+    await asyncio.sleep(0.01)
+    try:
+      return await asyncio.wait_for(api.create_with_retries({"model": "gpt-4o", "messages": messages}), 2)
+    finally:
+      assert not throttled.done()
+      throttled.cancel()
+  assert asyncio.run(run()) is response
+  assert [call["model"] for call in client.calls] == ["gpt-4o"]
+
+
+def test_cancel(convert, monkeypatch, fake_openai):
+  monkeypatch.setattr(convert, "prompts", [{}], raising=False)
+  monkeypatch.setattr(convert, "prompt_id", 0, raising=False)
+  client = FakeClient([30, 30])
+
+  async def run():
+    api = fake_async_api(convert, client)
+    monkeypatch.setattr(api, "validateModel", lambda model: None)
+    verilog = "module cancelled(input a, output b);\n  assign b = a;\nendmodule\n"
+    tasks = [asyncio.create_task(api.run_async([{"role": "system", "content": "Refactor."}, {"role": "user", "content": "## prompt\n\nDo it."}], verilog, "gpt-4o", sample))
+             for sample in [0, 1]]
+    await asyncio.sleep(0.05)
+    assert len(api.tasks) == 2
+    api.cancel()
+    results = await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), 2)
+    return [api, results]
+  api, results = asyncio.run(run())
+  assert all(isinstance(result, asyncio.CancelledError) for result in results)
+  assert api.tasks == set()
+  assert len(client.calls) == 2
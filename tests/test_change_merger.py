@@ -0,0 +1,21 @@
+verilog = "module increment(\n  input [7:0] in,\n  output [8:0] out\n);\n  assign out = in+1;\nendmodule\n"
+
+
+def test_expand_leading_ellipsis(convert):
+  body = "...\n  output [8:0] out\n);\n  assign out = in + 1;\nendmodule\n"
+  assert convert.ChangeMerger.merge_verilog_changes(body, verilog) == verilog.replace("in+1", "in + 1")
+
+
+def test_ellipsis_only(convert):
+  assert convert.ChangeMerger.merge_verilog_changes("...", verilog) == verilog
+
+
+def test_insufficient_context(convert):
+  merged, error = convert.ChangeMerger.merge_lines(["...", "  assign out = 0;", "endmodule"], verilog.splitlines())
+  assert merged is None
+  assert error["line"] == 1 and error["context"] == "after"
+
+
+def test_no_ellipsis_is_full_replacement(convert):
+  body = "module increment(input in, output out);\nendmodule\n"
+  assert convert.ChangeMerger.merge_verilog_changes(body, verilog) == body
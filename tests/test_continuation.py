@@ -0,0 +1,72 @@
+import types
+
+
+def response(content, finish_reason="stop", prompt_tokens=100, completion_tokens=50, cached_tokens=0):
+  usage = types.SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens,
+                                prompt_tokens_details=types.SimpleNamespace(cached_tokens=cached_tokens), completion_tokens_details=None)
+  message = types.SimpleNamespace(content=content, refusal=None)
+  return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message, finish_reason=finish_reason)], usage=usage)
+
+
+params = {"model": "gpt-4o", "messages": [{"role": "user", "content": "Refactor."}], "max_completion_tokens": 4000,
+          "response_format": {"type": "json_object"}, "prediction": {"type": "content", "content": "x"}}
+
+
+def test_max_completion_tokens(convert):
+  api = convert.OpenAI_API()
+  assert api.max_completion_tokens("gpt-4o") == 16384
+  # (From the model's api.)
+  assert api.max_completion_tokens("gpt-3.5-turbo") == convert.apis["gpt3"]["max_output_tokens"]
+  # Small Verilog gets the minimum budget, and large Verilog is capped at the model's limit.
+  assert api.max_completion_tokens("gpt-4o", "module m; endmodule\n") == api.min_completion_budget
+  assert api.max_completion_tokens("gpt-4o", "x" * 400000) == 16384
+  # Room is made for reasoning.
+  verilog = "x" * 40000
+  expected = int(convert.count_tokens(verilog, "o1") * api.completion_scale) + api.min_completion_overhead + api.reasoning_completion_tokens
+  assert api.max_completion_tokens("o1", verilog) == expected
+
+
+def test_no_continuation_unless_truncated(convert):
+  api = convert.OpenAI_API()
+  assert api.continuation_params(params, [response("done")]) is None
+
+
+def test_continuation_params(convert):
+  api = convert.OpenAI_API()
+  continuation = api.continuation_params(params, [response("{\"verilog\": \"module", "length")])
+  # Plain text, no prediction, with the partial response and a request to continue it.
+  assert "response_format" not in continuation and "prediction" not in continuation
+  assert continuation["messages"][:-2] == params["messages"]
+  assert continuation["messages"][-2] == {"role": "assistant", "content": "{\"verilog\": \"module"}
+  assert continuation["messages"][-1] == {"role": "user", "content": api.continuation_prompt}
+  assert continuation["max_completion_tokens"] == 16384
+
+
+def test_continuations_are_limited(convert):
+  api = convert.OpenAI_API()
+  truncated = [response("part " + str(i) + " ", "length") for i in range(api.max_continuations + 1)]
+  assert api.continuation_params(params, truncated[:-1]) is not None
+  assert api.continuation_params(params, truncated) is None
+
+
+def test_splice(convert):
+  api = convert.OpenAI_API()
+  text = "  assign out = in + 1;\n  assign"
+  # A continuation repeating the end of the text is spliced without the repetition.
+  assert api.splice(text, "in + 1;\n  assign valid = 1;\n") == "  assign out = in + 1;\n  assign valid = 1;\n"
+  # Short coincidental overlaps are not dropped.
+  assert api.splice("a = b;", "; c = d;") == "a = b;; c = d;"
+  assert api.splice("", "abc") == "abc"
+
+
+def test_combine_responses(convert):
+  api = convert.OpenAI_API()
+  first = response("{\"verilog\": \"module m;\\n  assign out = in + 1;", "length", 100, 4000, 80)
+  second = response("  assign out = in + 1;\\nendmodule\\n\"}", "stop", 4100, 20, 4000)
+  combined = api.combine_responses([first, second])
+  assert combined.choices[0].message.content == "{\"verilog\": \"module m;\\n  assign out = in + 1;\\nendmodule\\n\"}"
+  assert combined.choices[0].finish_reason == "stop"
+  assert combined.continuations == 1
+  assert (combined.usage.prompt_tokens, combined.usage.completion_tokens, combined.usage.total_tokens) == (4200, 4020, 8220)
+  assert combined.usage.prompt_tokens_details.cached_tokens == 4080
+  assert api.combine_responses([first]) is first
@@ -0,0 +1,48 @@
+import json
+import os
+import time
+
+
+def make_cache(convert, tmp_path, **kwargs):
+  cache = convert.DiskCache("test", max_bytes=kwargs.get("max_bytes", 1 << 20), max_age=kwargs.get("max_age", 3600))
+  cache.dir = str(tmp_path / "test")
+  return cache
+
+
+def test_key_is_order_independent(convert):
+  assert convert.DiskCache.key({"a": 1, "b": [1, 2]}) == convert.DiskCache.key({"b": [1, 2], "a": 1})
+  assert convert.DiskCache.key({"a": 1}) != convert.DiskCache.key({"a": 2})
+
+
+def test_put_get_delete(convert, tmp_path):
+  cache = make_cache(convert, tmp_path)
+  key = convert.DiskCache.key("x")
+  assert cache.get(key) is None
+  cache.put(key, {"passed": True})
+  assert cache.get(key) == {"passed": True}
+  cache.delete(key)
+  assert cache.get(key) is None
+  assert cache.stats() == {"hits": 1, "misses": 2}
+
+
+def test_expired_entries_are_misses(convert, tmp_path):
+  cache = make_cache(convert, tmp_path, max_age=10)
+  key = convert.DiskCache.key("old")
+  cache.put(key, "value")
+  old = time.time() - 100
+  os.utime(cache.entry_path(key), (old, old))
+  assert cache.get(key) is None
+  assert not os.path.exists(cache.entry_path(key))
+
+
+def test_evict_least_recently_used(convert, tmp_path):
+  cache = make_cache(convert, tmp_path)
+  keys = [convert.DiskCache.key(i) for i in range(3)]
+  for i, key in enumerate(keys):
+    cache.put(key, "x" * 100)
+    os.utime(cache.entry_path(key), (1000000 + i, time.time() - 100 + i))
+  cache.max_bytes = sum(os.path.getsize(cache.entry_path(key)) for key in keys[1:])
+  cache.evict()
+  assert [os.path.exists(cache.entry_path(key)) for key in keys] == [False, True, True]
+  with open(cache.entry_path(keys[2])) as file:
+    assert json.load(file)["value"] == "x" * 100
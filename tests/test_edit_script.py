@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+verilog = """module counter(
+  input clk,
+  input reset,
+  output reg [7:0] count
+);
+  always @(posedge clk) begin
+    if (reset)
+      count <= 0;
+    else
+      count <= count + 1;
+  end
+endmodule
+"""
+
+
+def test_exact_replace(convert):
+  code, error = convert.EditScript.apply([{"kind": "replace", "find": "count + 1", "replace": "count + 8'd1"}], verilog)
+  assert error is None
+  assert code == verilog.replace("count + 1", "count + 8'd1")
+
+
+def test_replace_ignoring_indentation(convert):
+  edit = {"find": "if (reset)\ncount <= 0;\n", "replace": "if (reset)\n      count <= 8'd0;\n"}
+  code, error = convert.EditScript.apply([edit], verilog)
+  assert error is None
+  assert code == verilog.replace("    if (reset)\n      count <= 0;\n", "if (reset)\n      count <= 8'd0;\n")
+
+
+def test_edits_apply_in_order(convert):
+  edits = [{"find": "count <= 0;", "replace": "count <= 8'd0;"}, {"find": "8'd0", "replace": "8'h00"}]
+  code, error = convert.EditScript.apply(edits, verilog)
+  assert error is None and "count <= 8'h00;" in code
+
+
+def test_regex_within(convert):
+  edit = {"kind": "regex", "within": "always @(posedge clk) begin", "find": r"\bclk\b", "replace": "clock"}
+  code, error = convert.EditScript.apply([edit], verilog)
+  assert error is None
+  # Only the "within" text is edited.
+  assert "always @(posedge clock) begin" in code and "input clk," in code
+
+
+def test_ambiguous(convert):
+  code, error = convert.EditScript.apply([{"find": "count <=", "replace": "x <="}], verilog)
+  assert code is None
+  assert error == "Edit 1 of 1: \"find\" text is ambiguous (found 2 times)."
+
+
+def test_not_found_reports_edit(convert):
+  edits = [{"find": "reset", "replace": "rst", "within": "input reset,"}, {"find": "count - 1", "replace": "count"}]
+  code, error = convert.EditScript.apply(edits, verilog)
+  assert code is None
+  assert error == "Edit 2 of 2: \"find\" text not found."
+
+
+def test_malformed(convert):
+  assert convert.EditScript.apply({"find": "x"}, verilog)[1] == "\"edits\" is not a list"
+  assert "unknown kind" in convert.EditScript.apply([{"kind": "delete", "find": "clk"}], verilog)[1]
+  assert "bad regular expression" in convert.EditScript.apply([{"kind": "regex", "find": "(", "replace": ""}], verilog)[1]
+  assert "has no matches" in convert.EditScript.apply([{"kind": "regex", "find": "xyz", "replace": ""}], verilog)[1]
+
+
+@pytest.fixture
+def bundler(convert, monkeypatch):
+  # (Response field names are validated against the current prompt, which is loaded at run time.)
+  monkeypatch.setattr(convert, "prompts", [{}], raising=False)
+  monkeypatch.setattr(convert, "prompt_id", 0, raising=False)
+  return convert.EditScriptMessageBundler()
+
+
+def test_bundler_applies_edits(bundler):
+  response = json.dumps({"overview": "Use a sized constant.", "edits": [{"find": "count <= 0;", "replace": "count <= 8'd0;"}]})
+  obj = bundler.response_to_obj(response, verilog)
+  assert obj["verilog"] == verilog.replace("count <= 0;", "count <= 8'd0;")
+  assert "edits" not in obj
+
+
+def test_bundler_failed_edits_omit_verilog(bundler):
+  obj = bundler.response_to_obj(json.dumps({"edits": [{"find": "nothing", "replace": ""}]}), verilog)
+  assert "verilog" not in obj
+
+
+def test_bundler_prefers_verilog(bundler):
+  modified = verilog.replace("counter", "counter2")
+  obj = bundler.response_to_obj(json.dumps({"verilog": modified, "edits": [{"find": "nothing", "replace": ""}]}), verilog)
+  assert obj["verilog"] == modified
@@ -0,0 +1,38 @@
+def test_normalize_verilog_ignores_comments_and_layout(convert):
+  a = "module m(input a, output b);  // A comment.\n\n    assign b = a; /* block\n comment */\nendmodule\n"
+  b = "module m(input a, output b);\nassign b = a;\nendmodule"
+  assert convert.normalize_verilog(a) == convert.normalize_verilog(b)
+
+
+def test_normalize_verilog_keeps_line_breaks(convert):
+  # A `define body ends at the line break, so joining lines would change its meaning.
+  a = "`define W 8\nwire [`W-1:0] x;\n"
+  b = "`define W 8 wire [`W-1:0] x;\n"
+  assert convert.normalize_verilog(a) != convert.normalize_verilog(b)
+  # A block comment spanning lines does not join them.
+  assert convert.normalize_verilog("`define W 8 /* a\nb */ wire x;") == "`define W 8\nwire x;"
+
+
+def test_normalize_verilog_preserves_strings(convert):
+  assert convert.normalize_verilog('initial $display("a  // b");') == 'initial $display("a  // b");'
+
+
+def test_fev_cache_key_depends_on_reset_env(convert, tmp_path, monkeypatch):
+  convert.module_name = "m"
+  (tmp_path / "orig.v").write_text("module m(input a, output b); assign b = a; endmodule\n")
+  (tmp_path / "mod.v").write_text("module m(input a, output b);\n  assign b = a;\nendmodule\n")
+  depth = {"depth": 20, "reset_cycles": 5}
+  key = lambda: convert.fev_cache_key(str(tmp_path / "orig.v"), str(tmp_path / "mod.v"), "yosys", depth)
+  monkeypatch.delenv("RESET_SIGNAL_NAME", raising=False)
+  monkeypatch.delenv("RESET_ASSERTION_LEVEL", raising=False)
+  no_reset = key()
+  monkeypatch.setenv("RESET_SIGNAL_NAME", "rst")
+  monkeypatch.setenv("RESET_ASSERTION_LEVEL", "high")
+  high = key()
+  monkeypatch.setenv("RESET_ASSERTION_LEVEL", "low")
+  low = key()
+  assert len({no_reset, high, low}) == 3
+  # Reformatting does not change the key.
+  (tmp_path / "mod.v").write_text("module m(input a,  output b);\n\n    assign b = a;  // Same.\nendmodule\n")
+  assert key() == low
+  assert convert.fev_cache_key(str(tmp_path / "orig.v"), str(tmp_path / "mod.v"), "yosys", {"depth": 30, "reset_cycles": 5}) != low
@@ -0,0 +1,62 @@
+def cell(type, inputs, outputs):
+  connections = {}
+  directions = {}
+  for ports, direction in [(inputs, "input"), (outputs, "output")]:
+    for port, bits in ports.items():
+      connections[port] = bits
+      directions[port] = direction
+  return {"type": type, "connections": connections, "port_directions": directions}
+
+
+def module(cells, inputs, outputs):
+  return {
+    "ports": {"in": {"direction": "input", "bits": inputs}, "out": {"direction": "output", "bits": outputs}},
+    "cells": {"c" + str(i): c for i, c in enumerate(cells)}
+  }
+
+
+pipeline = module([
+  cell("$dff", {"CLK": [1], "D": [2]}, {"Q": [3]}),
+  cell("$dff", {"CLK": [1], "D": [3]}, {"Q": [4]}),
+  cell("$not", {"A": [4]}, {"Y": [5]}),
+  cell("$dff", {"CLK": [1], "D": [5]}, {"Q": [6]}),
+], [1, 2], [6])
+
+# A counter, whose output is registered once: a shallow path from inputs, but deep state.
+counter = module([
+  cell("$dff", {"CLK": [1], "D": [10]}, {"Q": [11]}),
+  cell("$add", {"A": [11], "B": ["1"]}, {"Y": [10]}),
+  cell("$dff", {"CLK": [1], "D": [11]}, {"Q": [12]}),
+], [1], [12])
+
+
+def test_pipeline_is_feed_forward(convert):
+  assert convert.sequential_depth(pipeline) == [3, 3, False]
+  assert convert.derive_fev_depth(3, 3, False) == {"depth": convert.fev_reset_cycles + 8, "reset_cycles": convert.fev_reset_cycles}
+
+
+def test_counter_has_feedback(convert):
+  flops, pipeline_depth, feedback = convert.sequential_depth(counter)
+  assert flops == 2 and feedback
+  # Never below the previous fixed depth.
+  assert convert.derive_fev_depth(flops, pipeline_depth, feedback)["depth"] >= convert.fev_default_depth["depth"]
+
+
+def test_enabled_flop_holds_state(convert):
+  enabled = module([cell("$dffe", {"CLK": [1], "EN": [2], "D": [3]}, {"Q": [4]})], [1, 2, 3], [4])
+  assert convert.sequential_depth(enabled) == [1, 1, True]
+
+
+def test_combinational(convert):
+  comb = module([cell("$and", {"A": [1], "B": [2]}, {"Y": [3]})], [1, 2], [3])
+  assert convert.sequential_depth(comb) == [0, 0, False]
+  assert convert.derive_fev_depth(0, 0, False) == {"depth": 2, "reset_cycles": 0}
+
+
+def test_deep_feedback_design_is_bounded(convert):
+  assert convert.derive_fev_depth(100, 40, True)["depth"] == convert.fev_max_depth
+
+
+def test_depth_schedule(convert):
+  assert [d["depth"] for d in convert.fev_depth_schedule({"depth": 20, "reset_cycles": 5})] == [7, 12, 20]
+  assert convert.fev_depth_schedule({"depth": 2, "reset_cycles": 0}) == [{"depth": 1, "reset_cycles": 0}, {"depth": 2, "reset_cycles": 0}]
@@ -0,0 +1,112 @@
+import json
+import os
+import time
+
+# Log excerpts, as captured from each tool.
+eqy_passed = """EQY  9:14:02 [fev] read_gold: starting process "yosys -ql fev/gold.log fev/gold.ys"
+EQY  9:14:02 [fev] partition: finished (returncode=0)
+EQY  9:14:03 [fev] run: Proving equivalence of partition counter.
+EQY  9:14:03 [fev_counter] base: finished (returncode=0)
+EQY  9:14:03 [fev_counter] summary: Elapsed clock time [H:MM:SS (secs)]: 0:00:00 (0)
+EQY  9:14:03 [fev_counter] DONE (PASS, rc=0)
+EQY  9:14:03 [fev] run: Successfully proved equivalence of partition counter.
+EQY  9:14:03 [fev] Successfully proved designs equivalent
+"""
+eqy_failed = """EQY  9:15:11 [fev] run: Proving equivalence of partition counter.
+EQY  9:15:12 [fev_counter] summary: Elapsed clock time [H:MM:SS (secs)]: 0:00:01 (1)
+EQY  9:15:12 [fev_counter] DONE (FAIL, rc=2)
+EQY  9:15:12 [fev] run: Failed to prove equivalence of partition counter.
+EQY  9:15:12 [fev] Failed to prove equivalence of 1 out of 2 partitions.
+"""
+eqy_error = """EQY  9:16:40 [fev] read_gold: starting process "yosys -ql fev/gold.log fev/gold.ys"
+EQY  9:16:40 [fev] read_gold: ERROR: Can't open input file `/work/counter.v' for reading: No such file or directory
+EQY  9:16:40 [fev] read_gold: finished (returncode=1)
+EQY  9:16:40 [fev] ERROR: Yosys failed to read the gold design.
+"""
+sby_passed = """SBY  9:20:01 [fev] engine_0: ##   0:00:00  Checking assertions in step 9..
+SBY  9:20:01 [fev] engine_0: ##   0:00:00  Status: passed
+SBY  9:20:01 [fev] summary: engine_0 (smtbmc yices) returned pass
+SBY  9:20:01 [fev] DONE (PASS, rc=0)
+"""
+sby_failed = """SBY  9:21:09 [fev] engine_0: ##   0:00:00  BMC failed!
+SBY  9:21:09 [fev] engine_0: ##   0:00:00  Assert failed in miter: trigger.0
+SBY  9:21:09 [fev] summary: engine_0 (smtbmc z3) returned FAIL
+SBY  9:21:09 [fev] DONE (FAIL, rc=2)
+"""
+sby_timeout = """SBY  9:22:30 [fev] summary: engine_0 (smtbmc boolector) timed out
+SBY  9:22:30 [fev] DONE (TIMEOUT, rc=8)
+"""
+yosys_passed = """Solving problem with 1842 variables and 5127 clauses..
+SAT proof finished - no model found: SUCCESS!
+
+                  /$$$$$$      /$$$$$$$$     /$$$$$$$
+"""
+yosys_failed = """Solving problem with 1842 variables and 5127 clauses..
+SAT proof finished - model found: FAIL!
+
+   ______                   ___       ___       _ _            _ _
+"""
+yosys_error = """ERROR: Module `\\counter' not found!
+"""
+
+
+def test_eqy(convert):
+  assert convert.fev_verdict(0, eqy_passed, "eqy") is True
+  # (The failing partition's SBY run is logged among EQY's output.)
+  assert convert.fev_verdict(1, eqy_failed, "eqy") is False
+  assert convert.fev_verdict(1, eqy_error, "eqy") is None
+  # A summary line inconsistent with the return code is inconclusive.
+  assert convert.fev_verdict(1, eqy_passed, "eqy") is None
+  assert convert.fev_verdict(0, eqy_failed, "eqy") is None
+  # EQY's output is not mistaken for SBY's.
+  assert convert.fev_verdict(0, sby_passed, "eqy") is None
+
+
+def test_sby(convert):
+  assert convert.fev_verdict(0, sby_passed, "sby") is True
+  assert convert.fev_verdict(2, sby_failed, "sby") is False
+  assert convert.fev_verdict(8, sby_timeout, "sby") is None
+  assert convert.fev_verdict(1, sby_passed, "sby") is None
+
+
+def test_yosys(convert):
+  assert convert.fev_verdict(0, yosys_passed, "yosys") is True
+  # ("sat" without -verify exits normally on failure.)
+  assert convert.fev_verdict(0, yosys_failed, "yosys") is False
+  assert convert.fev_verdict(1, yosys_error, "yosys") is None
+  assert convert.fev_verdict(0, "", "yosys") is None
+
+
+def test_portfolio_first_result_wins(convert, monkeypatch, tmp_path):
+  engines = {
+    "broken": {"tools": ["sh"], "script": "fev.sby", "cmd": ["sh", "-c", "sleep 2; echo 'ERROR: no solver'; exit 1"]},
+    "slow":   {"tools": ["sh"], "script": "fev.sby", "cmd": ["sh", "-c", "sleep 30; echo 'DONE (PASS, rc=0)'"]},
+    "fast":   {"tools": ["sh"], "script": "fev.sby", "cmd": ["sh", "-c", "sleep 0.3; echo 'DONE (FAIL, rc=2)'; exit 2"]},
+    "queued": {"tools": ["sh"], "script": "fev.sby", "cmd": ["sh", "-c", "echo 'DONE (PASS, rc=0)'"]},
+    "missing": {"tools": ["no-such-fev-tool"], "script": "fev.sby", "cmd": ["no-such-fev-tool"]}
+  }
+  monkeypatch.setattr(convert, "fev_engines", engines)
+  monkeypatch.setattr(convert, "repo_dir", os.path.dirname(convert.__file__), raising=False)
+  monkeypatch.setattr(convert, "module_name", "counter", raising=False)
+  monkeypatch.setattr(convert.os, "cpu_count", lambda: 3)
+  monkeypatch.chdir(tmp_path)
+  os.makedirs("history")
+  (tmp_path / "orig.v").write_text("module counter; endmodule\n")
+  (tmp_path / "modified.v").write_text("module counter; endmodule\n")
+
+  start = time.time()
+  passed, log_text, winner = convert.run_fev_portfolio("orig.v", "modified.v", "fev", {"depth": 5, "reset_cycles": 1})
+  assert time.time() - start < 10
+  assert [passed, winner] == [False, "fast"]
+  assert "DONE (FAIL, rc=2)" in log_text
+  # Each engine ran in its own directory with its rendered script.
+  assert "counter" in (tmp_path / "fev/portfolio/fast/fev.sby").read_text()
+  assert not os.path.exists("fev/portfolio/missing")
+
+  # The slower engines were killed, and the engine without a free core never started.
+  stats = json.loads((tmp_path / convert.fev_stats_file).read_text())
+  assert set(stats) == {"broken", "slow", "fast"}
+  assert stats["fast"] == {**stats["fast"], "runs": 1, "wins": 1, "conclusive": 1}
+  assert stats["slow"] == {**stats["slow"], "runs": 1, "wins": 0, "conclusive": 0, "seconds": 0.0}
+  assert stats["broken"]["conclusive"] == 0 and stats["broken"]["seconds"] == 0.0
+  assert not os.path.exists("fev/portfolio/queued")
@@ -0,0 +1,50 @@
+import json
+
+verilog = "module m(input a, output b);\n" + "  assign b = a;\n" * 200 + "endmodule\n"
+
+
+def conversation():
+  return [
+    {"role": "system", "content": "You refactor Verilog."},
+    {"role": "user", "content": "## prompt\n\nSimplify the logic.\n\nMore detail.\n\n## verilog\n\n" + verilog},
+    {"role": "assistant", "content": json.dumps({"overview": "Simplified the assignments.", "verilog": verilog})},
+    {"role": "user", "content": "## prompt\n\nNow rename the signals."},
+  ]
+
+
+def test_summarize_turn_omits_code(convert):
+  api = convert.OpenAI_API()
+  summary = api.summarize_turn(conversation()[1]["content"], "gpt-4o")
+  assert summary == "prompt: Simplify the logic.\nverilog: (code omitted)"
+  summary = api.summarize_turn(conversation()[2]["content"], "gpt-4o")
+  assert summary == "overview: Simplified the assignments.\nverilog: (code omitted)"
+  summary = api.summarize_turn("Here it is:\n```\nmodule m;\nendmodule\n```", "gpt-4o")
+  assert summary == "message: Here it is:\n(code omitted)"
+
+
+def test_summarize_turn_is_bounded(convert):
+  api = convert.OpenAI_API()
+  summary = api.summarize_turn("## notes\n\n" + "word " * 10000, "gpt-4o")
+  assert convert.count_tokens(summary, "gpt-4o") <= api.max_summary_tokens + 2
+
+
+def test_fit_context_summarizes_before_eliding(convert, monkeypatch):
+  api = convert.OpenAI_API()
+  messages = conversation()
+  full = convert.count_message_tokens(messages, "gpt-4o")
+  monkeypatch.setitem(convert.models, "gpt-4o", dict(convert.models["gpt-4o"], context_window=full // 2 + api.min_completion_overhead + 1))
+  input_tokens, max_completion_tokens = api.fit_context(messages, "", "gpt-4o", None)
+  assert messages[1]["content"].startswith(api.summarized_turn)
+  assert api.elided_turn not in [message["content"] for message in messages]
+  assert messages[-1]["content"] == "## prompt\n\nNow rename the signals."
+  assert input_tokens == convert.count_message_tokens(messages, "gpt-4o")
+
+
+def test_fit_context_elides_if_summaries_do_not_fit(convert, monkeypatch):
+  api = convert.OpenAI_API()
+  messages = conversation()
+  elided = [messages[0], {"content": api.elided_turn}, {"content": api.elided_turn}, messages[-1]]
+  context_window = convert.count_message_tokens(elided, "gpt-4o") + api.min_completion_overhead + 1
+  monkeypatch.setitem(convert.models, "gpt-4o", dict(convert.models["gpt-4o"], context_window=context_window))
+  assert api.fit_context(messages, "", "gpt-4o", None) is not None
+  assert messages[1]["content"] == api.elided_turn and messages[2]["content"] == api.elided_turn
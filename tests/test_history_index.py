@@ -0,0 +1,43 @@
+import json
+import os
+
+
+def make_history(tmp_path):
+  history = tmp_path / "history"
+  step = history / "1"
+  for mod, status in [(0, {"fev": "passed"}), (1, {"modified": True, "fev": "failed"}), (2, {"modified": True})]:
+    (step / ("mod_" + str(mod))).mkdir(parents=True)
+    (step / ("mod_" + str(mod)) / "top.v").write_text("module top; // " + str(mod) + "\nendmodule\n")
+    (step / ("mod_" + str(mod)) / "status.json").write_text(json.dumps(status))
+  os.symlink("mod_0", str(step / "mod_3"))
+  return str(history)
+
+
+def test_rebuild_from_tree(convert, tmp_path):
+  index = convert.HistoryIndex(make_history(tmp_path))
+  assert index.max_mod(1) == 3
+  assert index.is_reversion(1, 3)
+  assert index.actual(1, 3) == 0
+  assert index.status(1, 3) == {"fev": "passed"}
+  assert index.entry(1, 2)["parent"] == 1
+  assert index.reversions_to(1, 0) == [3]
+  assert os.path.exists(index.index_file)
+
+
+def test_last_follows_reversions(convert, tmp_path):
+  index = convert.HistoryIndex(make_history(tmp_path))
+  assert index.last(1, 2, "feved") == 0
+  assert index.last(1, 2, "modified") == 2
+  # Mod 3 reverts to mod 0, which was not modified.
+  assert index.last(1, 3, "modified") is None
+  index.set_status(1, 2, {"modified": True, "fev": "passed"})
+  assert index.last(1, 2, "feved") == 2
+
+
+def test_journal_replay(convert, tmp_path):
+  history = make_history(tmp_path)
+  index = convert.HistoryIndex(history)
+  index.set_status(1, 1, {"modified": True, "fev": "passed"})
+  replayed = convert.HistoryIndex(history)
+  assert replayed.status(1, 1) == {"modified": True, "fev": "passed"}
+  assert replayed.last(1, 2, "feved") == 1
@@ -0,0 +1,48 @@
+import shutil
+
+import pytest
+
+orig = """module top(input clk, input [3:0] a, input [3:0] b, output reg [3:0] sum, output reg [3:0] diff);
+  always @(posedge clk) begin
+    sum <= a + b;
+    diff <= a - b;
+  end
+endmodule
+"""
+
+
+def test_normalize_rtlil_renumbers_private_names(convert):
+  a = "module \\top\n  attribute \\src \"a.v:3\"\n  wire width 4 $add$a.v:3$1_Y\n  cell $add $add$a.v:3$1\n  end\n"
+  b = "module \\other\n  attribute \\src \"b.v:9\"\n  wire width 4 $add$b.v:9$7_Y\n  cell $add $add$b.v:9$7\n  end\n"
+  assert convert.normalize_rtlil(a) == convert.normalize_rtlil(b)
+  # Cell types are not renumbered.
+  assert convert.normalize_rtlil(a) != convert.normalize_rtlil(b.replace("cell $add", "cell $sub"))
+
+
+@pytest.fixture
+def fev_server(convert, tmp_path):
+  if not shutil.which("yosys"):
+    pytest.skip("Yosys is not installed.")
+  convert.fev_cache.dir = str(tmp_path / "fev_cache")
+  server = convert.YosysFEVServer()
+  yield server
+  server.stop()
+
+
+def prove_cones(server, tmp_path, modified):
+  (tmp_path / "orig.v").write_text(orig)
+  (tmp_path / "top.v").write_text(modified)
+  return server.prove_cones("top", str(tmp_path / "orig.v"), str(tmp_path / "top.v"), str(tmp_path / "fev.vcd"))
+
+
+def test_prove_cones_equivalent_edit(fev_server, tmp_path, capsys):
+  passed, log = prove_cones(fev_server, tmp_path, orig.replace("a - b", "a + ~b + 4'd1"))
+  assert passed
+  assert "sum: unchanged" in log
+  assert "diff: proven" in log
+
+
+def test_prove_cones_inequivalent_edit(fev_server, tmp_path, capsys):
+  passed, log = prove_cones(fev_server, tmp_path, orig.replace("a - b", "b - a"))
+  assert not passed
+  assert "diff: FAILED" in log
@@ -0,0 +1,10 @@
+def test_forget_llm_response(convert, tmp_path):
+  convert.llm_cache.dir = str(tmp_path / "llm")
+  keys = [convert.DiskCache.key({"request": i}) for i in range(2)]
+  for key in keys:
+    convert.llm_cache.put(key, "response")
+  convert.forget_llm_response({"by": "llm", "fev": "failed", "llm_cache_keys": keys[:1]})
+  assert convert.llm_cache.get(keys[0]) is None
+  assert convert.llm_cache.get(keys[1]) == "response"
+  # Modifications not made by the LLM have no cache keys.
+  convert.forget_llm_response({"by": "human", "fev": "failed"})
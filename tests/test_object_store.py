@@ -0,0 +1,58 @@
+import os
+
+
+def objects(tmp_path):
+  return sorted(path.name for path in (tmp_path / "history/objects").glob("*/*"))
+
+
+def test_checkpoint_reset_gc(convert, monkeypatch, tmp_path):
+  monkeypatch.chdir(tmp_path)
+  os.makedirs("history")
+  os.makedirs("current")
+  for name, value in [("repo_dir", os.path.dirname(convert.__file__)), ("working_verilog_file_name", "counter.v"), ("module_name", "counter"),
+                      ("prompts", [{"desc": "First"}, {"desc": "Second"}]), ("prompt_id", 1), ("refactoring_step", 0), ("mod_num", -1),
+                      ("history_index", convert.HistoryIndex("history")), ("object_store", convert.ObjectStore("history/objects"))]:
+    monkeypatch.setattr(convert, name, value, raising=False)
+  # (The messages are not needed for this test.)
+  monkeypatch.setattr(convert, "initialize_messages_json", lambda: None)
+
+  def begin_step(verilog):
+    convert.refactoring_step += 1
+    convert.mod_num = -1
+    os.mkdir("history/" + str(convert.refactoring_step))
+    convert.history_index.begin_step(convert.refactoring_step)
+    (tmp_path / "counter.v").write_text(verilog)
+    convert.checkpoint({"initial": True, "fev": "passed"}, {})
+
+  # Step 1: the initial code and a manual edit.
+  begin_step("module counter; // v1\nendmodule\n")
+  (tmp_path / "counter.v").write_text("module counter; // v2\nendmodule\n")
+  convert.checkpoint({"by": "human", "modified": True})
+  # Step 2: begins with the same code (sharing its object), followed by an LLM modification.
+  begin_step("module counter; // v2\nendmodule\n")
+  (tmp_path / "counter.v").write_text("module counter; // v3\nendmodule\n")
+  (tmp_path / "messages.openai.json").write_text("[]")
+  (tmp_path / "llm_response.txt").write_text("{}")
+  convert.checkpoint({"by": "llm", "api": "openai", "modified": True})
+
+  v1, v2, v3, messages, response = [convert.file_sha256(file) for file in ["history/1/mod_0/counter.v", "history/1/mod_1/counter.v", "history/2/mod_1/counter.v",
+                                                                          "history/2/mod_1/messages.openai.json", "history/2/mod_1/llm_response.txt"]]
+  assert objects(tmp_path) == sorted([v1, v2, v3, messages, response])
+  assert os.path.samefile("history/1/mod_1/counter.v", "history/2/mod_0/counter.v")
+  assert convert.history_index.entry(2, 1)["hash"] == v3
+  # History files are read-only.
+  assert not os.stat("history/2/mod_1/counter.v").st_mode & 0o222
+
+  # Unaccept step 2, deleting its history and the objects referenced only from it.
+  convert.reset_prompt("u", 0)
+  assert convert.refactoring_step == 1 and convert.mod_num == 1
+  assert not os.path.exists("history/2")
+  assert objects(tmp_path) == sorted([v1, v2])
+  assert (tmp_path / "history/1/mod_0/counter.v").read_text() == "module counter; // v1\nendmodule\n"
+  assert (tmp_path / "history/1/mod_1/counter.v").read_text() == "module counter; // v2\nendmodule\n"
+  assert os.stat("history/1/mod_1/counter.v").st_nlink == 2
+  assert convert.readStatus()["accepted"] is False
+
+  # A second collection removes nothing more.
+  convert.object_store.gc()
+  assert objects(tmp_path) == sorted([v1, v2])
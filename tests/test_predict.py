@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+import json
+
+from conftest import FakeClient, fake_async_api, fake_response
+
+verilog = "module m(input a, output b);\n  assign b = a;\nendmodule\n"
+
+
+def prepare(convert, monkeypatch, api, model):
+  monkeypatch.setattr(convert, "prompts", [{}], raising=False)
+  monkeypatch.setattr(convert, "prompt_id", 0, raising=False)
+  monkeypatch.setattr(api, "validateModel", lambda model: None)
+  return api.prepare_request([{"role": "system", "content": "Refactor."}, {"role": "user", "content": "## prompt\n\nDo it."}], verilog, model)
+
+
+def test_prediction_is_the_current_verilog(convert, monkeypatch):
+  api = convert.AsyncOpenAI_API()
+  api.predict = True
+  params, cache_key = prepare(convert, monkeypatch, api, "gpt-4o")
+  # (The response as it would be if the Verilog were unchanged.)
+  assert params["prediction"]["type"] == "content" and json.loads(params["prediction"]["content"]) == {"verilog": verilog}
+  # "max_completion_tokens" is not sent with a prediction.
+  assert "max_completion_tokens" not in api.request_params(params) and "max_completion_tokens" in params
+  # The prediction does not affect the response, so not the cache key.
+  api.predict = False
+  assert prepare(convert, monkeypatch, api, "gpt-4o") == [{key: value for key, value in params.items() if key != "prediction"}, cache_key]
+
+
+def test_no_prediction_for_unsupported_models(convert, monkeypatch):
+  api = convert.AsyncOpenAI_API()
+  api.predict = True
+  assert "prediction" not in prepare(convert, monkeypatch, api, "o1")[0]
+  api.prediction_unsupported.add("gpt-4o")
+  assert "prediction" not in prepare(convert, monkeypatch, api, "gpt-4o")[0]
+
+
+def test_rejected_prediction_falls_back(convert, monkeypatch, fake_openai):
+  client = FakeClient([fake_openai.BadRequestError("prediction is not supported"), fake_response(), fake_openai.BadRequestError("bad")])
+
+  async def run():
+    api = fake_async_api(convert, client)
+    api.predict = True
+    params = prepare(convert, monkeypatch, api, "gpt-4o")[0]
+    first = await api.create_with_retries(params)
+    # Without a prediction, a bad request is not retried.
+    second = await api.create_with_retries(prepare(convert, monkeypatch, api, "gpt-4o")[0])
+    return [api, params, first, second]
+  api, params, first, second = asyncio.run(run())
+  assert first is not None and second is None
+  assert "prediction" in client.calls[0] and "max_completion_tokens" not in client.calls[0]
+  # The retry is made without the prediction (and so with the completion limit), as are later requests.
+  assert "prediction" not in client.calls[1] and client.calls[1]["max_completion_tokens"] == params["max_completion_tokens"]
+  assert api.prediction_unsupported == {"gpt-4o"}
+  assert len(client.calls) == 3 and "prediction" not in client.calls[2]
+
+
+def test_batch_workers_get_run_options(convert, monkeypatch):
+  monkeypatch.setattr(convert, "fev_portfolio", True, raising=False)
+  monkeypatch.setattr(convert, "args", argparse.Namespace(predict=True, edits=False, no_trace=True, no_stream=True), raising=False)
+  cmd = convert.batch_worker_command("gpt-4o", 3, 2)
+  assert cmd[2:] == ["--auto", "--model", "gpt-4o", "--max-attempts", "3", "--candidates", "2", "--fev-portfolio", "--predict", "--no-stream", "--no-trace"]
@@ -0,0 +1,119 @@
+import itertools
+import json
+import os
+
+prompts_json = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "prompts.json")
+
+
+# The original character-by-character conversion of extended JSON (for comparison).
+def old_from_extended_json(ejson):
+  json_str = ""
+  in_string = False
+  after_newline = False
+  for c in ejson:
+    if after_newline:
+      after_newline = False
+      if c == "+":
+        continue
+    if c == '"':
+      in_string = not in_string
+    if c == "\n" and in_string:
+      c = "\\n"
+      after_newline = True
+    json_str += c
+  return json_str
+
+
+# The original inline evaluation of a prompt's "if" and "unless" conditions (for comparison).
+def old_prompt_ok(prompt, status):
+  if_ok = True
+  if "if" in prompt:
+    if_ok = False
+    for field in prompt["if"]:
+      values = [prompt["if"][field]] if type(prompt["if"][field]) == str else prompt["if"][field]
+      if status.get(field, "") in values:
+        if_ok = True
+        break
+  unless_ok = True
+  if "unless" in prompt:
+    for field in prompt["unless"]:
+      values = [prompt["unless"][field]] if type(prompt["unless"][field]) == str else prompt["unless"][field]
+      unless_ok = status.get(field, "") not in values
+      if unless_ok:
+        break
+  return if_ok and unless_ok
+
+
+def test_extended_json_round_trip(convert):
+  obj = [{"desc": "Quotes", "prompt": "Use \"a\" and a lone \" quote.\nSecond line.\n\n+ Indented \"bullet\"."},
+         {"desc": "Escapes", "prompt": "A literal \\n, a backslash \\\\, a tab\t, and é.", "if": {"clocks": ["1", "2"]}}]
+  ejson = convert.to_extended_json(json.dumps(obj, indent=4))
+  assert "Use \\\"a\\\" and a lone \\\" quote.\nSecond line.\n\n++ Indented" in ejson
+  assert json.loads(convert.from_extended_json(ejson)) == obj
+  # Newlines outside of strings are untouched.
+  assert convert.from_extended_json("{\n  \"a\": \"x\ny\"\n}") == "{\n  \"a\": \"x\\ny\"\n}"
+
+
+def test_extended_json_legacy_continuation(convert):
+  assert json.loads(convert.from_extended_json("\"line 1\n+line 2\"")) == "line 1\nline 2"
+
+
+def test_real_prompts_parse_as_before(convert):
+  with open(prompts_json) as file:
+    raw = file.read()
+  assert json.loads(convert.from_extended_json(raw)) == json.loads(old_from_extended_json(raw))
+
+
+def test_conditions_match_old_behavior(convert, tmp_path):
+  with open(prompts_json) as file:
+    (tmp_path / "prompts.json").write_text(file.read())
+  prompts, prompts_by_desc, prompt_conditions = convert.load_prompts(str(tmp_path / "prompts.json"))
+  assert [prompts_by_desc[prompt["desc"]]["index"] for prompt in prompts] == list(range(len(prompts)))
+  # Every combination of the values (and absence) of each field used in conditions.
+  values = {}
+  for prompt in prompts:
+    for kind in ["if", "unless"]:
+      for field, field_values in prompt.get(kind, {}).items():
+        values.setdefault(field, {""}).update([field_values] if type(field_values) == str else field_values)
+  assert values, "prompts.json has no conditions"
+  fields = sorted(values)
+  checked = 0
+  for combination in itertools.product(*[sorted(values[field]) + ["other"] for field in fields]):
+    status = {field: value for field, value in zip(fields, combination) if value != ""}
+    for prompt, ok in zip(prompts, prompt_conditions):
+      assert ok(status) == old_prompt_ok(prompt, status), (prompt["desc"], status)
+      checked += 1
+  assert checked > len(prompts)
+
+
+def test_recipe_cache(convert, tmp_path):
+  file_name = str(tmp_path / "prompts.json")
+  with open(file_name, "w") as file:
+    file.write("[{\"desc\": \"One\", \"prompt\": \"First\nprompt.\", \"if\": {\"x\": \"1\"}}]")
+  prompts = convert.load_prompts(file_name)[0]
+  assert prompts == [{"desc": "One", "prompt": "First\nprompt.", "if": {"x": "1"}, "index": 0}]
+  assert os.path.exists(file_name + ".cache")
+
+  # The cached recipe is used while prompts.json is unchanged.
+  mtime = os.stat(file_name).st_mtime_ns
+  assert convert.load_prompts(file_name)[0] == prompts
+  with open(file_name + ".cache", "rb") as file:
+    cached = file.read()
+  assert convert.load_prompts(file_name)[0] == prompts
+  with open(file_name + ".cache", "rb") as file:
+    assert file.read() == cached
+
+  # A change (even of the same size, with the same modification time) invalidates the recipe.
+  with open(file_name, "w") as file:
+    file.write("[{\"desc\": \"Two\", \"prompt\": \"Other\nprompt.\", \"if\": {\"x\": \"2\"}}]")
+  os.utime(file_name, ns=(mtime, mtime + 1))
+  prompts, prompts_by_desc, prompt_conditions = convert.load_prompts(file_name)
+  assert prompts[0]["desc"] == "Two" and list(prompts_by_desc) == ["Two"]
+  assert prompt_conditions[0]({"x": "2"}) and not prompt_conditions[0]({"x": "1"})
+
+  # A touch without a change keeps the recipe (recompiling nothing), and a corrupt cache is ignored.
+  os.utime(file_name, ns=(mtime + 5, mtime + 5))
+  assert convert.load_prompts(file_name)[0] == prompts
+  with open(file_name + ".cache", "wb") as file:
+    file.write(b"garbage")
+  assert convert.load_prompts(file_name)[0] == prompts
@@ -0,0 +1,61 @@
+import json
+
+messages_json = """[
+  {"role": "system", "content": "You are a Verilog refactoring agent.
++Respond in JSON."},
+  {"role": "user", "content": "## background
+
+Clocks are named \\"clk\\".
+
+## prompt
+
+Rename the clock signals."}
+]
+"""
+
+
+# Build the request for the given status and Verilog as for an LLM run, returning the bytes of its messages.
+def request(convert, monkeypatch, api, status, verilog):
+  monkeypatch.setattr(convert, "readStatus", lambda mod=None: status)
+  with open(convert.working_verilog_file_name, "w") as file:
+    file.write(verilog)
+  messages, verilog = convert.load_llm_request("openai")
+  params = api.prepare_request(messages, verilog, "gpt-4o")[0]
+  return json.dumps(params["messages"]).encode()
+
+
+def common_prefix_length(a, b):
+  length = 0
+  while length < min(len(a), len(b)) and a[length] == b[length]:
+    length += 1
+  return length
+
+
+def test_consecutive_requests_share_prefix(convert, monkeypatch, tmp_path):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setattr(convert, "prompts", [{"desc": "Clocks", "prompt": "Rename the clock signals.", "needs": ["clocks"]}], raising=False)
+  monkeypatch.setattr(convert, "prompt_id", 0, raising=False)
+  monkeypatch.setattr(convert, "working_verilog_file_name", "counter.v", raising=False)
+  (tmp_path / "messages.openai.json").write_text(messages_json)
+  api = convert.OpenAI_API()
+  monkeypatch.setattr(api, "validateModel", lambda model: None)
+
+  # Consecutive requests of a refactoring step: another module, then a later modification with a plan.
+  first = request(convert, monkeypatch, api, {"clocks": "1"}, "module counter(input clk);\nendmodule\n")
+  second = request(convert, monkeypatch, api, {"clocks": "2", "plan": "Rename clk next."}, "module timer(input clock);\nendmodule\n")
+
+  # The static part (the system message, background, and prompt) is a byte-identical prefix, ending where the volatile
+  # fields begin.
+  static = json.dumps(json.loads(convert.from_extended_json(messages_json))).encode()[:-len("\"}]")]
+  assert first.startswith(static) and second.startswith(static)
+  assert first[:common_prefix_length(first, second)].decode().endswith(convert.needs_preamble.replace("\"", "\\\"") + "\\n   clocks: ")
+  assert b"clocks: 1" in first and b"clocks: 2" in second and b"Rename clk next." in second
+
+
+def test_needs_not_repeated(convert, monkeypatch, tmp_path):
+  monkeypatch.setattr(convert, "prompts", [{"desc": "Clocks", "prompt": "Rename.", "needs": ["clocks"]}], raising=False)
+  monkeypatch.setattr(convert, "prompt_id", 0, raising=False)
+  # (As in messages.<api>.json of earlier versions.)
+  messages = [{"role": "user", "content": "## prompt\n\nRename.\n\n" + convert.needs_preamble + "\n   clocks: 1"}]
+  convert.add_request_context(messages, {"clocks": "1"})
+  assert messages[0]["content"].count(convert.needs_preamble) == 1
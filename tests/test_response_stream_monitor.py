@@ -0,0 +1,77 @@
+import json
+
+verilog = "module m(input a, output b);\n  assign b = a;\nendmodule\n"
+
+
+# Feed the response to a new monitor in pieces of the given size, returning [monitor, first-error].
+def feed(convert, format, response, size, verilog_file_name=None):
+  monitor = convert.ResponseStreamMonitor(format, verilog, verilog_file_name)
+  error = None
+  for i in range(0, len(response), size):
+    error = monitor.feed(response[i:i + size])
+    if error is not None:
+      break
+  monitor.close()
+  return [monitor, error]
+
+
+def test_json_escapes_split_across_pieces(convert, tmp_path):
+  modified = verilog.replace("assign b = a;", "assign b = a;  // \"copy\" \\ é\t(tab)")
+  response = json.dumps({"overview": "Say \"verilog\": here.", "verilog": modified, "notes": "none"}, ensure_ascii=True)
+  assert "\\u00e9" in response
+  # Every split point, including within each escape sequence.
+  for size in [1, 2, 3, 5, 7]:
+    monitor, error = feed(convert, "json", response, size, str(tmp_path / "stream.v"))
+    assert error is None, size
+    assert "".join(monitor.verilog) == modified
+    assert monitor.verilog_done
+    assert (tmp_path / "stream.v").read_text() == modified
+
+
+def test_json_not_an_object(convert):
+  monitor, error = feed(convert, "json", "Here is the code:\n{\"verilog\": \"\"}", 4)
+  assert error == "The response is not a JSON object."
+
+
+def test_json_verilog_not_a_string(convert):
+  monitor, error = feed(convert, "json", "{\"verilog\": null}", 3)
+  assert error == "The \"verilog\" field is not a string."
+
+
+def test_md_headers(convert):
+  response = "## overview\n\nRenamed.\n\n## verilog\n\n```verilog\n" + verilog.replace("b = a", "b = ~~a") + "```\n\n## notes\n\nNone.\n"
+  for size in [1, 4, 11]:
+    monitor, error = feed(convert, "md", response, size)
+    assert error is None, size
+    assert monitor.started and monitor.verilog_done
+    assert "assign b = ~~a;" in "".join(monitor.verilog)
+
+
+def test_md_without_headers(convert):
+  monitor, error = feed(convert, "md", "Sure! " * 100, 10)
+  assert error == "The response does not begin with \"## <field>\" headers."
+  # A short preamble is permitted.
+  monitor, error = feed(convert, "md", "Sure!\n\n## verilog\n\n...\n\n## notes\n", 10)
+  assert error is None and monitor.verilog_done
+
+
+def test_early_abort_on_unmergeable_verilog(convert):
+  # "..." must be surrounded by lines of the original code.
+  bad = "module m(input a, output b);\n...\n  assign c = d;\n  assign e = f;\n"
+  response = json.dumps({"verilog": bad, "notes": "x" * 10000})
+  monitor, error = feed(convert, "json", response, 8)
+  assert error is not None and error.startswith("The \"verilog\" field cannot be merged")
+  # Aborted as soon as the field ended, without reading the rest of the response.
+  assert len(monitor.text) < len(response) - 9000
+
+
+def test_empty_verilog(convert):
+  monitor, error = feed(convert, "md", "## verilog\n\n\n## notes\n\nx\n", 5)
+  assert error == "The \"verilog\" field is empty."
+
+
+def test_reset(convert):
+  monitor, error = feed(convert, "json", json.dumps({"verilog": verilog}), 5)
+  monitor.reset()
+  assert monitor.text == "" and monitor.verilog == [] and not monitor.verilog_done
+  assert monitor.feed(json.dumps({"verilog": verilog})) is None and "".join(monitor.verilog) == verilog
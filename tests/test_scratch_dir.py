@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+
+def test_unkept_workspace_is_removed_on_success(convert, tmp_path):
+  parent = str(tmp_path / "tmp")
+  with convert.ScratchDir("merge", parent, keep=False) as scratch:
+    work_dir = scratch.dir
+    scratch.render("a.v", "module <NAME>; endmodule\n", {"<NAME>": "m"})
+    with open(scratch.path("a.v")) as file:
+      assert file.read() == "module m; endmodule\n"
+  assert not os.path.exists(work_dir)
+  assert os.listdir(parent) == []
+
+
+def test_unkept_workspace_is_kept_on_failure(convert, tmp_path):
+  parent = str(tmp_path / "tmp")
+  with pytest.raises(RuntimeError):
+    with convert.ScratchDir("merge", parent, keep=False) as scratch:
+      work_dir = scratch.dir
+      scratch.render("log", "oops\n")
+      raise RuntimeError("merge failed")
+  # Published for inspection.
+  assert os.path.realpath(parent + "/merge") == os.path.realpath(work_dir)
+  with open(parent + "/merge/log") as file:
+    assert file.read() == "oops\n"
+  # As is one marked failed.
+  with convert.ScratchDir("merge", parent, keep=False) as scratch:
+    second = scratch.dir
+    scratch.fail()
+  assert os.path.realpath(parent + "/merge") == os.path.realpath(second)
+  assert not os.path.exists(work_dir)
+
+
+def test_published_workspace_replaces_the_previous(convert, tmp_path):
+  parent = str(tmp_path / "tmp")
+  # Concurrent workspaces of the same kind are distinct.
+  first = convert.ScratchDir("fev", parent)
+  second = convert.ScratchDir("fev", parent)
+  first_dir, second_dir = first.dir, second.dir
+  assert first_dir != second_dir
+  first.close()
+  assert os.path.realpath(parent + "/fev") == os.path.realpath(first_dir)
+  second.close()
+  assert os.path.realpath(parent + "/fev") == os.path.realpath(second_dir)
+  assert not os.path.exists(first_dir)
+  assert sorted(os.listdir(parent)) == sorted(["fev", os.path.basename(second_dir)])
@@ -0,0 +1,38 @@
+def miter(inputs, body):
+  return "module miter(" + ", ".join(inputs + ["trigger"]) + ");\n" + \
+    "".join("  input " + name + ";\n" for name in inputs) + "  output trigger;\n" + body + "endmodule\n"
+
+
+def test_clock_found_from_flip_flops(convert):
+  testbench, reason = convert.sim_testbench(miter(["in_ck", "in_rst", "in_d"], (
+    "  reg q;\n"
+    "  always @(posedge in_ck, posedge in_rst)\n"
+    "    if (in_rst) q <= 1'h0;\n"
+    "    else q <= in_d;\n"
+  )))
+  assert reason is None
+  # The clock is toggled, not randomized, and the asynchronous reset is not taken as a clock.
+  assert "      in_ck = 1;" in testbench
+  assert "in_ck = {$random(seed)};" not in testbench
+  assert "in_rst = {$random(seed)};" in testbench
+
+
+def test_combinational(convert):
+  testbench, reason = convert.sim_testbench(miter(["in_a"], "  assign trigger = 1'h0;\n"))
+  assert testbench is not None and reason is None
+
+
+def test_unidentified_clock_is_not_simulated(convert):
+  testbench, reason = convert.sim_testbench(miter(["in_a"], (
+    "  reg q;\n"
+    "  wire gclk = in_a & q;\n"
+    "  always @(posedge gclk)\n"
+    "    q <= ~q;\n"
+  )))
+  assert testbench is None
+  assert "gclk" in reason
+
+
+def test_undrivable_inputs(convert):
+  testbench, reason = convert.sim_testbench(miter(["clk"], ""))
+  assert testbench is None and "clk" in reason
@@ -0,0 +1,27 @@
+import asyncio
+
+
+def test_candidate_exceptions_are_reported(convert, capsys):
+  convert.report_candidate_exceptions([None, RuntimeError("FEV thread died"), asyncio.CancelledError(), None, KeyError("verilog")])
+  out = capsys.readouterr().out
+  assert "Error: Candidate 1 failed with an exception: RuntimeError: FEV thread died" in out
+  assert "Error: Candidate 4 failed with an exception: KeyError: 'verilog'" in out
+  # Cancellation of the outstanding candidates (once one passes) is expected.
+  assert "Candidate 2" not in out and len(out.splitlines()) == 2
+
+
+def test_winner_status(convert, monkeypatch):
+  monkeypatch.setattr(convert, "prompts", [{"may_produce": ["clocks"]}], raising=False)
+  monkeypatch.setattr(convert, "prompt_id", 0, raising=False)
+  usage = {"in": 1000, "out": 200, "cached": 800}
+  winner = {"model": "gpt-4o", "response_obj": {"verilog": "...", "incomplete": False}, "modified": True, "extra_fields": {"clocks": "1"},
+            "checks": {"compile": "passed", "sim": "passed"}, "usage": usage, "cache_keys": ["abc"]}
+  status = convert.speculative_status(winner, 4, {"fev": "passed"})
+  assert status["by"] == "llm" and status["model"] == "gpt-4o" and status["clocks"] == "1"
+  assert status["compile"] == "passed" and status["sim"] == "passed" and status["fev"] == "passed"
+  assert status["tokens"] == usage and status["llm_cache_keys"] == ["abc"] and status["candidates"] == 4
+
+  # An unchanged (cached) winner reflects the prior checks and has no usage.
+  winner.update(modified=False, checks={}, usage=None)
+  status = convert.speculative_status(winner, 4, {"compile": "passed", "sim": "skipped", "fev": "passed"})
+  assert status["sim"] == "skipped" and "tokens" not in status
@@ -0,0 +1,64 @@
+import asyncio
+import subprocess
+import sys
+
+
+def events(convert):
+  tracer = convert.Tracer()
+  return tracer, tracer.events
+
+
+def test_sync_span_records_thread_cpu(convert):
+  tracer, recorded = events(convert)
+  with tracer.span("outer", engine="eqy"):
+    with tracer.span("inner"):
+      pass
+  assert [event["name"] for event in recorded] == ["inner", "outer"]
+  outer = recorded[1]
+  assert outer["cat"] == "outer" and outer["args"]["engine"] == "eqy"
+  assert "cpu_ms" in outer["args"] and "async" not in outer["args"]
+
+
+def test_async_span_records_wall_time(convert):
+  tracer, recorded = events(convert)
+
+  async def request(delay):
+    with tracer.span("llm.api"):
+      await asyncio.sleep(delay)
+
+  async def run():
+    await asyncio.gather(request(0.05), request(0.05))
+  asyncio.run(run())
+  assert len(recorded) == 2
+  for event in recorded:
+    # Awaited time is included, and the thread's CPU time (shared by both tasks) is not reported.
+    assert event["dur"] >= 40000
+    assert event["args"]["async"] is True and "cpu_ms" not in event["args"]
+  # Each task has its own trace ID.
+  assert recorded[0]["tid"] != recorded[1]["tid"]
+
+
+def test_traced_coroutine_function(convert, monkeypatch):
+  tracer, recorded = events(convert)
+  monkeypatch.setattr(convert, "tracer", tracer)
+
+  @convert.traced("work")
+  async def work():
+    await asyncio.sleep(0.02)
+    return 1
+  assert asyncio.run(work()) == 1
+  assert recorded[0]["name"] == "work" and recorded[0]["dur"] >= 15000
+
+
+def test_subprocess_usage_and_summary(convert, tmp_path, capsys):
+  tracer, recorded = events(convert)
+  with tracer.span("fev.eqy"):
+    subprocess.run([sys.executable, "-c", "x = bytearray(64 * 1024 * 1024); sum(range(10 ** 6))"], check=True)
+  args = recorded[0]["args"]
+  assert args["child_cpu_ms"] > 0
+  assert set(args) <= {"cpu_ms", "child_cpu_ms", "peak_child_rss_kb"}
+  tracer.flush(str(tmp_path))
+  assert tracer.events == [] and len(convert.Tracer.read(str(tmp_path / "trace.json"))["traceEvents"]) == 1
+  convert.Tracer.summarize([str(tmp_path)])
+  out = capsys.readouterr().out
+  assert "peak child rss" in out and "fev.eqy" in out
@@ -0,0 +1,7 @@
+def test_unaddressed_comments(convert, monkeypatch, tmp_path):
+  file_name = tmp_path / "my module's.v"
+  monkeypatch.setattr(convert, "working_verilog_file_name", str(file_name), raising=False)
+  file_name.write_text("module m;\n  // LLM: New Task: rename.\n  //User: why?\n  // A user: comment.\nendmodule\n")
+  assert convert.unaddressed_comments() == "  // LLM: New Task: rename.\n  //User: why?\n"
+  file_name.write_text("module m;\nendmodule\n")
+  assert convert.unaddressed_comments() == ""
@@ -0,0 +1,79 @@
+verilog = """module regs(
+  input clk,
+  input reset,
+  input [1:0] sel,
+  input [7:0] d,
+  output reg [7:0] q,
+  output reg [7:0] y
+);
+  wire [7:0] next = d + 1;
+  // Register.
+  always @(posedge clk)
+    if (reset)
+      q <= 0;
+    else if (sel == 0)
+      q <= next;
+    else
+      q <= d;
+  always @(*)
+    case (sel)
+      0: y = q;
+      1: y = d;
+      default:
+        if (reset) y = 0;
+        else y = next;
+    endcase
+  always @(posedge clk) begin
+    if (reset) q <= 0;
+  end
+  else_count_unused u_other(.a(d));
+endmodule
+"""
+
+
+def chunker(convert, max_tokens=1):
+  return convert.VerilogChunker(verilog, max_tokens, lambda text: len(text.split()))
+
+
+def test_items_keep_begin_less_if_else(convert):
+  prefix, items, suffix = chunker(convert).split()
+  assert prefix[-1] == ");"
+  assert suffix == ["endmodule"]
+  assert [item[0].strip() for item in items] == [
+    "wire [7:0] next = d + 1;",
+    "// Register.",
+    "always @(*)",
+    "always @(posedge clk) begin",
+    "else_count_unused u_other(.a(d));",
+  ]
+  # The begin-less if/else chain and the case statement are each a single item.
+  assert items[1][-1].strip() == "q <= d;"
+  assert items[2][-1].strip() == "endcase"
+
+
+def test_one_item_per_chunk_round_trips(convert):
+  c = chunker(convert)
+  assert len(c.chunks) == 5
+  lines, error = c.stitch([c.request(i) for i in range(len(c.chunks))])
+  assert error is None
+  assert "\n".join(lines) + "\n" == verilog
+
+
+def test_chunks_group_items_by_size(convert):
+  c = chunker(convert, max_tokens=1000)
+  assert len(c.chunks) == 1
+
+
+def test_not_a_single_module(convert):
+  two = verilog + verilog
+  assert convert.VerilogChunker(two, 1, len).chunks is None
+
+
+def test_total_usage(convert):
+  total = convert.OpenAI_API.total_usage([
+    {"in": 100, "out": 10, "cached": 50},
+    None,
+    {"in": 200, "out": 20, "cached": 0, "continuations": 1, "prediction": {"accepted": 5, "rejected": 1}},
+  ])
+  assert total == {"in": 300, "out": 30, "cached": 50, "continuations": 1, "prediction": {"accepted": 5, "rejected": 1}, "requests": 2}
+  assert convert.OpenAI_API.total_usage([None]) is None